@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         Мост API LMArena
 // @namespace    http://tampermonkey.net/
-// @version      2.5
+// @version      2.6
 // @description  Соединяет LMArena с локальным API-сервером через WebSocket для упрощённой автоматизации.
 // @author       Lianues
 // @match        https://lmarena.ai/*
@@ -18,8 +18,32 @@
     const SERVER_URL = "ws://localhost:5102/ws"; // Соответствует порту в api_server.py
     let socket;
     let isCaptureModeActive = false; // Флаг режима захвата идентификаторов
+    let isCapturePersistent = false; // Постоянный режим захвата (id_updater.py --pool): не отключается после захвата
     let reconnectAttempts = 0; // Счетчик попыток переподключения
     const MAX_RECONNECT_ATTEMPTS = 5; // Максимальное количество попыток переподключения
+    // Вывод полной нагрузки запросов в консоль. Сериализация длинной истории с base64-изображениями
+    // на каждом запросе заметно нагружает вкладку, поэтому включайте только для отладки.
+    const DEBUG_PAYLOADS = false;
+    // Кеш уже полученных историй диалога (message_templates) для дельта-кодирования.
+    // Порядок вытеснения (LRU) должен совпадать с серверным зеркалом в modules/prefix_cache.py.
+    const PREFIX_CACHE_CAPACITY = 32;
+    const prefixCache = new Map(); // cache_key -> массив шаблонов сообщений
+    // Выполняющиеся запросы: сервер может прервать их командой 'abort_request' (истёк срок или клиент отключился)
+    const activeRequests = new Map(); // request_id -> AbortController
+    // Разобранные события ответа копятся и отправляются серверу одним сообщением: 0 — раз в кадр анимации,
+    // иначе не чаще, чем раз в указанное число миллисекунд.
+    const STREAM_FLUSH_INTERVAL_MS = 0;
+    const FRAME_INTERVAL_MS = 16;
+    // Возобновление потоков после разрыва WebSocket: кадры ответа нумеруются и хранятся, пока сервер их
+    // не подтвердит. После переподключения вкладка сообщает свои запросы, сервер отвечает номером последнего
+    // полученного кадра, и вкладка досылает остальные. Пока соединения нет, fetch продолжает читать ответ в буфер.
+    const REPLAY_BUFFER_LIMIT = 4096; // Кадров на запрос; при переполнении запрос не сможет возобновиться
+    const FINISHED_STREAM_KEEP_MS = 60000; // Сколько хранить завершённый, но не подтверждённый поток
+    const streamStates = new Map(); // request_id -> { seq, frames, finished, resuming }
+    // Cookies и заголовки страницы для прямого транспорта сервера (upstream_transport: "direct" в config.jsonc).
+    // Отправляются при подключении и при каждом изменении cookies. HttpOnly-cookies скрипту недоступны.
+    const CREDENTIALS_CHECK_INTERVAL_MS = 30000;
+    let lastExportedCookie = null;
 
     // --- Основная логика ---
     function connect() {
@@ -31,12 +55,49 @@
             document.title = "✅ " + document.title;
             // Сбрасываем счетчик попыток при успешном подключении
             reconnectAttempts = 0;
+            // Сервер начинает новое соединение с пустым зеркалом кеша, поэтому очищаем и локальный кеш
+            prefixCache.clear();
+            socket.send(JSON.stringify({
+                type: "hello",
+                features: ["prefix_cache", "heartbeat", "structured_stream", "resume"],
+                prefix_cache_capacity: PREFIX_CACHE_CAPACITY
+            }));
+            exportCredentials(true);
+            // Запросы, которые продолжали выполняться без соединения, возобновляются: до ответа сервера
+            // новые кадры только накапливаются, чтобы не обогнать досылаемые
+            if (streamStates.size > 0) {
+                const requests = [];
+                for (const [requestId, state] of streamStates) {
+                    state.resuming = true;
+                    requests.push({
+                        request_id: requestId,
+                        first_seq: state.frames.length ? state.frames[0].seq : state.seq + 1
+                    });
+                }
+                console.log(`[Мост API] Возобновление выполняющихся запросов: ${requests.length}.`);
+                socket.send(JSON.stringify({ type: "resume", requests }));
+            }
         };
 
         socket.onmessage = async (event) => {
             try {
                 const message = JSON.parse(event.data);
 
+                // Пульс сервера: отвечаем сразу, чтобы сервер мог измерить RTT и заметить зависшую вкладку
+                if (message.type === "ping") {
+                    socket.send(JSON.stringify({ type: "pong", seq: message.seq }));
+                    if (message.acks) applyAcks(message.acks);
+                    return;
+                }
+                if (message.type === "ack") {
+                    applyAcks(message.acks || {});
+                    return;
+                }
+                if (message.type === "resume_ack") {
+                    completeResume(message.requests || {});
+                    return;
+                }
+
                 // Проверка, является ли сообщение командой, а не стандартным запросом чата
                 if (message.command) {
                     console.log(`[Мост API] ⬇️ Получена команда: ${message.command}`);
@@ -45,9 +106,25 @@
                         location.reload();
                     } else if (message.command === 'activate_id_capture') {
                         console.log("[Мост API] ✅ Режим захвата идентификаторов активирован. Пожалуйста, выполните операцию 'Retry' на странице.");
-                        isCaptureModeActive = true;
+                        isCapturePersistent = !!message.persistent;
                         // Визуальная подсказка для пользователя
-                        document.title = "🎯 " + document.title;
+                        if (!isCaptureModeActive) {
+                            document.title = "🎯 " + document.title;
+                        }
+                        isCaptureModeActive = true;
+                    } else if (message.command === 'deactivate_id_capture') {
+                        console.log("[Мост API] Режим захвата идентификаторов отключён.");
+                        if (isCaptureModeActive && document.title.startsWith("🎯 ")) {
+                            document.title = document.title.substring(2);
+                        }
+                        isCaptureModeActive = false;
+                        isCapturePersistent = false;
+                    } else if (message.command === 'abort_request') {
+                        const controller = activeRequests.get(message.request_id);
+                        if (controller) {
+                            console.log(`[Мост API] Запрос ${message.request_id.substring(0, 8)} прерван сервером.`);
+                            controller.abort();
+                        }
                     } else if (message.command === 'send_page_source') {
                         console.log("[Мост API] Получена команда на отправку исходного кода страницы, выполняется отправка...");
                         sendPageSource();
@@ -55,7 +132,7 @@
                     return;
                 }
 
-                const { request_id, payload } = message;
+                const { request_id, payload, structured } = message;
 
                 if (!request_id || !payload) {
                     console.error("[Мост API] Получено недействительное сообщение от сервера:", message);
@@ -63,24 +140,33 @@
                 }
                 
                 console.log(`[Мост API] ⬇️ Получен запрос чата ${request_id.substring(0, 8)}. Подготовка к выполнению fetch-запроса.`);
-                await executeFetchAndStreamBack(request_id, payload);
+                await executeFetchAndStreamBack(request_id, payload, !!structured);
 
             } catch (error) {
                 console.error("[Мост API] Ошибка при обработке сообщения от сервера:", error);
             }
         };
 
-        socket.onclose = () => {
+        socket.onclose = (event) => {
             console.warn("[Мост API] 🔌 Соединение с локальным сервером разорвано.");
             if (document.title.startsWith("✅ ")) {
                 document.title = document.title.substring(2);
             }
+
+            // 1012 (Service Restart): сервер перезапускается и передал порт новому процессу — переподключаемся сразу
+            if (event && event.code === 1012) {
+                console.log("[Мост API] Сервер перезапускается, переподключение к новому процессу...");
+                setTimeout(connect, 300);
+                return;
+            }
             
             // Проверяем, не превышен ли лимит попыток переподключения
             if (reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
                 reconnectAttempts++;
-                console.warn(`[Мост API] 🔄 Попытка переподключения ${reconnectAttempts}/${MAX_RECONNECT_ATTEMPTS} через 5 секунд...`);
-                setTimeout(connect, 5000);
+                // Выполняющиеся запросы сервер ждёт ограниченное время, поэтому с ними переподключаемся быстрее
+                const delay = streamStates.size > 0 ? 1000 : 5000;
+                console.warn(`[Мост API] 🔄 Попытка переподключения ${reconnectAttempts}/${MAX_RECONNECT_ATTEMPTS} через ${delay / 1000} с...`);
+                setTimeout(connect, delay);
             } else {
                 console.error("[Мост API] ❌ Достигнут лимит попыток переподключения. Сервер, вероятно, остановлен.");
                 console.log("[Мост API] 🛑 Скрипт прекращает попытки переподключения. Обновите страницу для повторного запуска.");
@@ -94,9 +180,189 @@
         };
     }
 
-    async function executeFetchAndStreamBack(requestId, payload) {
+    function exportCredentials(force = false) {
+        if (!socket || socket.readyState !== WebSocket.OPEN) return;
+        const cookie = document.cookie;
+        if (!force && cookie === lastExportedCookie) return;
+        lastExportedCookie = cookie;
+        socket.send(JSON.stringify({
+            type: "upstream_credentials",
+            cookie,
+            user_agent: navigator.userAgent,
+            accept_language: (navigator.languages || [navigator.language]).join(","),
+            origin: location.origin
+        }));
+    }
+
+    // Подтверждения сервера: { request_id: номер последнего полученного кадра }
+    function applyAcks(acks) {
+        for (const [requestId, acked] of Object.entries(acks)) {
+            const state = streamStates.get(requestId);
+            if (!state) continue;
+            while (state.frames.length && state.frames[0].seq <= acked) state.frames.shift();
+            if (state.finished && acked >= state.seq) streamStates.delete(requestId);
+        }
+    }
+
+    // Ответ сервера на resume: досылаем кадры после последнего полученного или прерываем закрытые запросы
+    function completeResume(results) {
+        for (const [requestId, state] of streamStates) {
+            if (!state.resuming) continue;
+            state.resuming = false;
+            const lastSeq = results[requestId];
+            if (lastSeq === null || lastSeq === undefined) {
+                // Сервер уже закрыл запрос (истёк срок ожидания или сервер перезапущен) — ответ никому не нужен
+                streamStates.delete(requestId);
+                const controller = activeRequests.get(requestId);
+                if (controller) controller.abort();
+                continue;
+            }
+            state.frames = state.frames.filter(frame => frame.seq > lastSeq);
+            for (const frame of state.frames) socket.send(JSON.stringify(frame));
+            if (state.finished && state.frames.length === 0) streamStates.delete(requestId);
+        }
+    }
+
+    function touchPrefixCache(key, templates) {
+        // Перемещение записи в конец Map соответствует move_to_end в серверном OrderedDict
+        prefixCache.delete(key);
+        prefixCache.set(key, templates);
+    }
+
+    // Восстанавливает полный список шаблонов из закешированного префикса и новых сообщений.
+    // Возвращает null при промахе кеша.
+    function resolveMessageTemplates(payload) {
+        const { prefix_ref, cache_key } = payload;
+        let templates = payload.message_templates || [];
+
+        if (prefix_ref) {
+            const cached = prefixCache.get(prefix_ref.key);
+            if (!cached || cached.length < prefix_ref.length) {
+                prefixCache.delete(prefix_ref.key);
+                return null;
+            }
+            touchPrefixCache(prefix_ref.key, cached);
+            templates = cached.slice(0, prefix_ref.length).concat(templates);
+        }
+
+        if (cache_key) {
+            touchPrefixCache(cache_key, templates);
+            while (prefixCache.size > PREFIX_CACHE_CAPACITY) {
+                prefixCache.delete(prefixCache.keys().next().value);
+            }
+        }
+        return templates;
+    }
+
+    // --- Разбор потока LMArena во вкладке (режим structured) ---
+    // Строки ответа: a0:"текст", a2:[изображения], ad:{"finishReason":...}; префикс b — участник B режима Battle.
+    // Вместо сырого текста сервер получает компактные типизированные события:
+    //   ["t", участник, текст]   — фрагмент текста (подряд идущие фрагменты одного участника склеиваются);
+    //   ["i", участник, url]     — изображение;
+    //   ["f", участник, причина] — завершение ответа участника;
+    //   ["r", текст]             — нераспознанные строки (ошибка LMArena, страница Cloudflare), сервер разбирает их сам.
+    function createStreamEventParser(requestId) {
+        const linePattern = /^([ab])([02d]):(.*)$/s;
+        let tail = ""; // Незавершённая строка из предыдущего блока
+        let pending = [];
+        let cancelScheduled = null;
+        let lastFlush = 0;
+
+        function push(event) {
+            const last = pending[pending.length - 1];
+            if (last && last[0] === event[0] && (event[0] === "r" || (event[0] === "t" && last[1] === event[1]))) {
+                last[last.length - 1] += event[event.length - 1];
+            } else {
+                pending.push(event);
+            }
+        }
+
+        function parseLine(line) {
+            if (!line) return;
+            const match = linePattern.exec(line);
+            if (match) {
+                const [, participant, kind, json] = match;
+                try {
+                    const value = JSON.parse(json);
+                    if (kind === "0") {
+                        if (typeof value === "string" && value) push(["t", participant, value]);
+                    } else if (kind === "2") {
+                        const image = Array.isArray(value) ? value[0] : null;
+                        if (image && image.type === "image" && image.image) push(["i", participant, image.image]);
+                    } else if (value && value.finishReason) {
+                        push(["f", participant, value.finishReason]);
+                    }
+                    return;
+                } catch (e) {
+                    // Некорректный JSON — передаём строку серверу как есть
+                }
+            }
+            push(["r", line + "\n"]);
+        }
+
+        function flush() {
+            if (cancelScheduled) {
+                cancelScheduled();
+                cancelScheduled = null;
+            }
+            lastFlush = performance.now();
+            if (pending.length === 0) return;
+            sendToServer(requestId, { events: pending });
+            pending = [];
+        }
+
+        function scheduleFlush() {
+            if (cancelScheduled || pending.length === 0) return;
+            const interval = STREAM_FLUSH_INTERVAL_MS > 0 ? STREAM_FLUSH_INTERVAL_MS : FRAME_INTERVAL_MS;
+            const elapsed = performance.now() - lastFlush;
+            // После паузы отправляем сразу: так первый фрагмент не ждёт, а в фоновой вкладке,
+            // где браузер замедляет таймеры, задержка не накапливается
+            if (elapsed >= interval) {
+                flush();
+            } else if (STREAM_FLUSH_INTERVAL_MS <= 0 && !document.hidden) {
+                const id = requestAnimationFrame(flush);
+                cancelScheduled = () => cancelAnimationFrame(id);
+            } else {
+                const id = setTimeout(flush, interval - elapsed);
+                cancelScheduled = () => clearTimeout(id);
+            }
+        }
+
+        return {
+            feed(text) {
+                const lines = (tail + text).split("\n");
+                tail = lines.pop();
+                for (const line of lines) parseLine(line);
+                scheduleFlush();
+            },
+            // Конец потока: разбираем последнюю строку и отправляем всё накопленное
+            finish() {
+                parseLine(tail);
+                tail = "";
+                flush();
+            },
+            flush,
+            dispose() {
+                if (cancelScheduled) {
+                    cancelScheduled();
+                    cancelScheduled = null;
+                }
+                pending = [];
+            },
+        };
+    }
+
+    async function executeFetchAndStreamBack(requestId, payload, structured = false) {
         console.log(`[Мост API] Текущий домен: ${window.location.hostname}`);
-        const { is_image_request, message_templates, target_model_id, session_id, message_id } = payload;
+        const { is_image_request, target_model_id, session_id, message_id } = payload;
+        const message_templates = resolveMessageTemplates(payload);
+
+        if (message_templates === null) {
+            // Сервер повторит запрос с полной историей
+            console.warn(`[Мост API] Промах кеша префиксов для запроса ${requestId.substring(0, 8)}, запрошена полная история.`);
+            sendToServer(requestId, { prefix_cache_miss: true, key: payload.prefix_ref.key });
+            return;
+        }
 
         // --- Использование информации о сессии, переданной от сервера ---
         if (!session_id || !message_id) {
@@ -157,12 +423,23 @@
             modelId: target_model_id,
         };
 
-        console.log("[Мост API] Окончательная нагрузка для отправки в API LMArena:", JSON.stringify(body, null, 2));
+        if (DEBUG_PAYLOADS) {
+            console.log("[Мост API] Окончательная нагрузка для отправки в API LMArena:", JSON.stringify(body, null, 2));
+        } else {
+            console.log(`[Мост API] Нагрузка для запроса ${requestId.substring(0, 8)} подготовлена: ${newMessages.length} сообщений.`);
+        }
+
+        const controller = new AbortController();
+        activeRequests.set(requestId, controller);
+        const parser = structured ? createStreamEventParser(requestId) : null;
+        const streamState = { seq: 0, frames: [], finished: false, resuming: false };
+        streamStates.set(requestId, streamState);
 
         // Устанавливаем флаг, чтобы перехватчик fetch знал, что это запрос от скрипта
         window.isApiBridgeRequest = true;
         try {
             const response = await fetch(apiUrl, {
+                signal: controller.signal,
                 method: httpMethod,
                 headers: {
                     'Content-Type': 'text/plain;charset=UTF-8', // LMArena использует text/plain
@@ -183,34 +460,73 @@
             while (true) {
                 const { value, done } = await reader.read();
                 if (done) {
+                    const rest = decoder.decode();
+                    if (parser) {
+                        if (rest) parser.feed(rest);
+                        parser.finish();
+                    } else if (rest) {
+                        sendToServer(requestId, rest);
+                    }
                     console.log(`[Мост API] ✅ Поток для запроса ${requestId.substring(0, 8)} успешно завершён.`);
                     // Отправляем [DONE] только после успешного завершения потока
                     sendToServer(requestId, "[DONE]");
                     break;
                 }
-                const chunk = decoder.decode(value);
-                // Пересылаем необработанные данные обратно на сервер
-                sendToServer(requestId, chunk);
+                // stream: true — многобайтовый символ UTF-8, разрезанный между блоками, собирается из двух частей
+                const chunk = decoder.decode(value, { stream: true });
+                if (parser) {
+                    parser.feed(chunk);
+                } else if (chunk) {
+                    // Пересылаем необработанные данные обратно на сервер
+                    sendToServer(requestId, chunk);
+                }
             }
 
         } catch (error) {
+            if (error.name === 'AbortError') {
+                // Сервер уже завершил запрос, ответ ему не нужен
+                console.warn(`[Мост API] Запрос ${requestId.substring(0, 8)} прерван.`);
+                streamStates.delete(requestId);
+                return;
+            }
             console.error(`[Мост API] ❌ Ошибка при выполнении fetch для запроса ${requestId.substring(0, 8)}:`, error);
+            // Уже разобранный текст отправляется до ошибки, чтобы сервер получил его в правильном порядке
+            if (parser) parser.flush();
             // При ошибке отправляем только сообщение об ошибке, без [DONE]
             sendToServer(requestId, { error: error.message });
         } finally {
+            if (parser) parser.dispose();
+            activeRequests.delete(requestId);
+            // Буфер хранится до подтверждения последнего кадра (или ограниченное время, если подтверждения нет)
+            streamState.finished = true;
+            if (streamStates.get(requestId) === streamState && streamState.frames.length === 0 && !streamState.resuming) {
+                streamStates.delete(requestId);
+            } else {
+                setTimeout(() => {
+                    if (streamStates.get(requestId) === streamState) streamStates.delete(requestId);
+                }, FINISHED_STREAM_KEEP_MS);
+            }
             // Сбрасываем флаг после завершения запроса, независимо от результата
             window.isApiBridgeRequest = false;
         }
     }
 
     function sendToServer(requestId, data) {
+        const message = {
+            request_id: requestId,
+            data: data
+        };
+        const state = streamStates.get(requestId);
+        if (state) {
+            // Кадр потока: нумеруется и хранится до подтверждения сервером
+            message.seq = ++state.seq;
+            state.frames.push(message);
+            if (state.frames.length > REPLAY_BUFFER_LIMIT) state.frames.shift();
+            if (state.resuming) return; // Будет отправлен после ответа сервера на resume
+        }
         if (socket && socket.readyState === WebSocket.OPEN) {
-            const message = {
-                request_id: requestId,
-                data: data
-            };
             socket.send(JSON.stringify(message));
-        } else {
+        } else if (!state) {
             console.error("[Мост API] Не удалось отправить данные, WebSocket-соединение не открыто.");
         }
     }
@@ -240,10 +556,12 @@
                 const messageId = match[2];
                 console.log(`[Перехватчик Моста API] 🎯 Захвачены идентификаторы в активном режиме! Отправка...`);
 
-                // Отключаем режим захвата, чтобы отправить только один раз
-                isCaptureModeActive = false;
-                if (document.title.startsWith("🎯 ")) {
-                    document.title = document.title.substring(2);
+                // Отключаем режим захвата, чтобы отправить только один раз (кроме постоянного режима пула)
+                if (!isCapturePersistent) {
+                    isCaptureModeActive = false;
+                    if (document.title.startsWith("🎯 ")) {
+                        document.title = document.title.substring(2);
+                    }
                 }
 
                 // Асинхронно отправляем захваченные идентификаторы на локальный скрипт id_updater.py
@@ -254,7 +572,9 @@
                 })
                 .then(response => {
                     if (!response.ok) throw new Error(`Сервер ответил статусом: ${response.status}`);
-                    console.log(`[Мост API] ✅ Идентификаторы успешно отправлены. Режим захвата автоматически отключён.`);
+                    console.log(isCapturePersistent
+                        ? `[Мост API] ✅ Идентификаторы успешно отправлены. Постоянный режим захвата остаётся активным.`
+                        : `[Мост API] ✅ Идентификаторы успешно отправлены. Режим захвата автоматически отключён.`);
                 })
                 .catch(err => {
                     console.error('[Мост API] Ошибка при отправке обновления идентификаторов:', err.message);
@@ -286,11 +606,13 @@
 
     // --- Запуск соединения ---
     console.log("========================================");
-    console.log("  Мост API LMArena v2.5 запущен.");
+    console.log("  Мост API LMArena v2.6 запущен.");
     console.log("  - Функциональность чата подключена к ws://localhost:5102");
     console.log("  - Захват идентификаторов отправляется на http://localhost:5103");
     console.log("========================================");
     
     connect(); // Устанавливаем WebSocket-соединение
+    // Обновлённые cookies (например, после продления сессии) передаются серверу для прямого транспорта
+    setInterval(() => exportCredentials(), CREDENTIALS_CHECK_INTERVAL_MS);
 
 })();
\ No newline at end of file
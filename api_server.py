@@ -12,6 +12,8 @@ import uuid
 import re
 import threading
 import random
+import hmac
+import math
 import mimetypes
 from datetime import datetime
 from contextlib import asynccontextmanager
@@ -21,39 +23,99 @@ import requests
 from packaging.version import parse as parse_version
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
 
 # --- Импорт внутренних модулей ---
 from modules.file_uploader import upload_to_file_bed
+from modules.image_preprocessor import ImagePreprocessor
+from modules.request_spool import RequestSpool, SpooledDataURI, materialize
+from modules.single_flight import SingleFlight, canonical_key
+from modules.request_profiler import RequestProfiler
+from modules.loop_monitor import LoopMonitor
+from modules.server_control import DrainingServer, InflightCounter, SUPPORTS_HANDOFF, create_listen_socket, notify_ready, spawn_successor
+from modules.broker import BrowserBroker, InMemoryBroker, BrokerHubServer, SocketBroker, BrowserUnavailable, load_or_create_broker_token
+from modules.upstream_transport import BrowserTransport, DirectHttpTransport, UpstreamRouter
+from modules.batch_runner import BatchManager, PriorityGate
+from modules.rate_limiter import QuotaRegistry, QuotaExceeded, QuotaLease, estimate_request_tokens, key_digest
+from modules.context_budget import ContextTooLarge, STRATEGIES, STRATEGY_OFF, fit_messages
+from modules.log_setup import setup_async_logging, stop_async_logging, apply_log_settings, is_request_sampled
+from modules.traffic_recorder import TrafficRecorder
+from modules import fast_json
 
 # --- Базовая конфигурация ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Логи форматируются и выводятся в фоновом потоке, чтобы не блокировать цикл событий.
+setup_async_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _req_log(request_id: str) -> bool:
+    """Писать ли подробные (info) логи для данного запроса: учитывает уровень логирования и выборку."""
+    return logger.isEnabledFor(logging.INFO) and is_request_sampled(request_id)
+
 # --- Глобальные состояния и конфигурация ---
 CONFIG = {}  # Хранит конфигурацию, загруженную из config.jsonc
-# browser_ws хранит WebSocket-соединение с единственным скриптом Tampermonkey.
-# Примечание: данная архитектура предполагает работу только с одной вкладкой браузера.
-# Для поддержки нескольких параллельных вкладок необходимо расширить до словаря для управления множеством соединений.
-browser_ws: WebSocket | None = None
-# response_channels хранит очередь ответов для каждого API-запроса.
-# Ключ — request_id, значение — asyncio.Queue.
-response_channels: dict[str, asyncio.Queue] = {}
+CONFIG_STAMP = None  # (время изменения, размер) загруженного config.jsonc
+# broker хранит всё состояние маршрутизации: подключённые вкладки браузера, каналы ответа запросов
+# и флаг обновления страницы для проверки на человекоподобность.
+# В режиме 'memory'/'hub' вкладки подключены к этому процессу, в режиме 'front' — к отдельному процессу-хабу.
+broker: BrowserBroker = InMemoryBroker()
+broker_hub: BrokerHubServer | None = None
+# Путь запроса до LMArena (upstream_transport): вкладка браузера через брокер или прямой HTTP с cookies страницы
+UPSTREAM = UpstreamRouter(BrowserTransport(lambda: broker, lambda: CONFIG), DirectHttpTransport(lambda: broker, lambda: CONFIG), lambda: CONFIG)
+# Реестр API-ключей с квотами (раздел api_keys в config.jsonc).
+API_KEY_QUOTAS = QuotaRegistry()
+# Учёт интерактивных запросов: пакетные задания (/v1/batches) уступают им очередь.
+PRIORITY_GATE = PriorityGate()
+batch_manager: BatchManager | None = None
+# Запись входящих кадров /ws для воспроизведения (traffic_replayer.py); None — запись выключена
+traffic_recorder: TrafficRecorder | None = None
+# Пул процессов для уменьшения изображений-вложений; None — предобработка выключена
+image_preprocessor: ImagePreprocessor | None = None
+# Выполняющиеся запросы, к которым могут подключаться идентичные (coalesce_identical_requests_models)
+SINGLE_FLIGHT = SingleFlight()
+# Выборочное профилирование запросов (profile_sample_rate, заголовок X-Profile-Token, /internal/profile)
+REQUEST_PROFILER = RequestProfiler(lambda: CONFIG)
+# Задержка цикла событий и обнаружение блокирующего кода (/internal/metrics)
+LOOP_MONITOR = LoopMonitor(lambda: CONFIG)
+# Плавная остановка и перезапуск: сервер uvicorn (None, если приложение запущено внешним uvicorn),
+# слушающий сокет и число выполняющихся клиентских запросов
+http_server: DrainingServer | None = None
+listen_socket = None
+socket_inherited = False  # Процесс запущен перезапуском и получил слушающий сокет от предыдущего
+INFLIGHT_REQUESTS = InflightCounter()
+draining = False   # Новые запросы отклоняются с 503, выполняющиеся дорабатывают
+reloading = False  # Идёт перезапуск с передачей сокета новому процессу
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")  # Адреса, с которых /internal/* доступны без API-ключа
+worker_wait_until = 0.0  # До этого момента (time.monotonic) запросы ждут подключения вкладки, а не получают 503
 last_activity_time = None  # Время последней активности
 idle_monitor_thread = None  # Поток мониторинга простоя
 main_event_loop = None  # Главный цикл событий
-# Новое: отслеживание обновления из-за проверки на человекоподобность
-IS_REFRESHING_FOR_VERIFICATION = False
 
 # --- Сопоставление моделей ---
 # MODEL_NAME_TO_ID_MAP теперь хранит более сложные объекты: { "model_name": {"id": "...", "type": "..."} }
 MODEL_NAME_TO_ID_MAP = {}
 MODEL_ENDPOINT_MAP = {}  # Новое: хранит сопоставление моделей с идентификаторами сессии/сообщения
+MODEL_ENDPOINT_MAP_MTIME = None  # Время изменения загруженного model_endpoint_map.json
 DEFAULT_MODEL_ID = None  # Идентификатор модели по умолчанию: None
 
+def reload_model_endpoint_map_if_changed():
+    """
+    Перечитывает model_endpoint_map.json, если файл изменился (например, id_updater.py --pool добавил эндпоинты).
+    Проверка — один вызов os.stat, поэтому выполняется на каждый запрос.
+    """
+    try:
+        mtime = os.stat('model_endpoint_map.json').st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime != MODEL_ENDPOINT_MAP_MTIME:
+        load_model_endpoint_map()
+
 def load_model_endpoint_map():
     """Загружает сопоставление моделей с конечными точками из model_endpoint_map.json."""
-    global MODEL_ENDPOINT_MAP
+    global MODEL_ENDPOINT_MAP, MODEL_ENDPOINT_MAP_MTIME
+    try:
+        MODEL_ENDPOINT_MAP_MTIME = os.stat('model_endpoint_map.json').st_mtime_ns
+    except OSError:
+        MODEL_ENDPOINT_MAP_MTIME = None
     try:
         with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
             content = f.read()
@@ -102,23 +164,44 @@ def _parse_jsonc(jsonc_string: str) -> dict:
 
     return json.loads("\n".join(no_comments_lines))
 
+def _config_stamp():
+    try:
+        stat = os.stat('config.jsonc')
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+def reload_config_if_changed():
+    """
+    Перечитывает config.jsonc, только если файл изменился (правка вручную, id_updater.py).
+    Проверка — один вызов os.stat, поэтому выполняется на каждый запрос вместо чтения и разбора файла.
+    """
+    if _config_stamp() != CONFIG_STAMP:
+        load_config()
+
 def load_config():
     """Загружает конфигурацию из config.jsonc, обрабатывая комментарии JSONC."""
-    global CONFIG
+    global CONFIG, CONFIG_STAMP
+    CONFIG_STAMP = _config_stamp()
     try:
         with open('config.jsonc', 'r', encoding='utf-8') as f:
             content = f.read()
         CONFIG = _parse_jsonc(content)
-        logger.info("Конфигурация успешно загружена из 'config.jsonc'.")
-        # Вывод состояния ключевых настроек
-        logger.info(f"  - Режим Таверны (Tavern Mode): {'✅ Включён' if CONFIG.get('tavern_mode_enabled') else '❌ Отключён'}")
-        logger.info(f"  - Режим обхода (Bypass Mode): {'✅ Включён' if CONFIG.get('bypass_enabled') else '❌ Отключён'}")
+        apply_log_settings(CONFIG.get("log_level"), CONFIG.get("log_request_sample_rate"))
+        # Конфигурация перечитывается на каждый запрос, поэтому подробности выводятся только на уровне DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Конфигурация успешно загружена из 'config.jsonc'.")
+            logger.debug(f"  - Режим Таверны (Tavern Mode): {'✅ Включён' if CONFIG.get('tavern_mode_enabled') else '❌ Отключён'}")
+            logger.debug(f"  - Режим обхода (Bypass Mode): {'✅ Включён' if CONFIG.get('bypass_enabled') else '❌ Отключён'}")
     except (FileNotFoundError, json.JSONDecodeError) as e:
         logger.error(f"Не удалось загрузить или разобрать 'config.jsonc': {e}. Используется конфигурация по умолчанию.")
         CONFIG = {}
 
 def load_model_map():
-    """Загружает сопоставление моделей из models.json, поддерживая формат 'id:type'."""
+    """
+    Загружает сопоставление моделей из models.json, поддерживая формат 'id:type'
+    и объектный формат {"id": ..., "type": ..., "context_tokens": ...}.
+    """
     global MODEL_NAME_TO_ID_MAP
     try:
         with open('models.json', 'r', encoding='utf-8') as f:
@@ -126,7 +209,14 @@ def load_model_map():
             
         processed_map = {}
         for name, value in raw_map.items():
-            if isinstance(value, str) and ':' in value:
+            if isinstance(value, dict):
+                model_id = value.get("id")
+                processed_map[name] = {
+                    "id": model_id if model_id and str(model_id).lower() != 'null' else None,
+                    "type": value.get("type", "text"),
+                    "context_tokens": value.get("context_tokens"),
+                }
+            elif isinstance(value, str) and ':' in value:
                 parts = value.split(':', 1)
                 model_id = parts[0] if parts[0].lower() != 'null' else None
                 model_type = parts[1]
@@ -234,10 +324,14 @@ def check_for_updates():
                 logger.info("Подготовка к применению обновления. Сервер будет закрыт через 5 секунд и запущен скрипт обновления.")
                 time.sleep(5)
                 update_script_path = os.path.join("modules", "update_script.py")
-                # Запуск независимого процесса с помощью Popen
-                subprocess.Popen([sys.executable, update_script_path])
-                # Грациозный выход из текущего процесса сервера
-                os._exit(0)
+                if http_server is not None and main_event_loop:
+                    # Скрипт обновления запускается, когда выполняющиеся запросы завершены и порт освобождён
+                    http_server.after_exit.append(lambda: subprocess.Popen([sys.executable, update_script_path]))
+                    main_event_loop.call_soon_threadsafe(http_server.request_drain)
+                else:
+                    # Запуск независимого процесса с помощью Popen
+                    subprocess.Popen([sys.executable, update_script_path])
+                    os._exit(0)
             else:
                 logger.error(f"Не удалось выполнить автоматическое обновление. Пожалуйста, скачайте вручную с https://github.com/{GITHUB_REPO}/releases/latest.")
             logger.info("="*60)
@@ -321,32 +415,96 @@ def save_available_models(new_models_list, models_path="available_models.json"):
 
 # --- Логика автоматического перезапуска ---
 def restart_server():
-    """Грациозно уведомляет клиентов о необходимости обновления и перезапускает сервер."""
+    """Перезапускает сервер без разрыва соединений (вызывается из потока мониторинга простоя)."""
     logger.warning("="*60)
     logger.warning("Обнаружен тайм-аут простоя сервера, подготовка к автоматическому перезапуску...")
     logger.warning("="*60)
-    
-    # 1. (Асинхронно) Уведомление браузера об обновлении
-    async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # Приоритетно отправляем команду 'reconnect', чтобы фронтенд знал, что это плановый перезапуск
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("Команда 'reconnect' отправлена в браузер.")
-            except Exception as e:
-                logger.error(f"Не удалось отправить команду 'reconnect': {e}")
-    
-    # Запуск асинхронной функции уведомления в главном цикле событий
-    # Используем `asyncio.run_coroutine_threadsafe` для обеспечения безопасности потоков
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
-        asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
-    
-    # 2. Задержка на несколько секунд, чтобы сообщение успело отправиться
-    time.sleep(3)
-    
-    # 3. Выполнение перезапуска
-    logger.info("Перезапуск сервера...")
-    os.execv(sys.executable, ['python'] + sys.argv)
+    if main_event_loop:
+        asyncio.run_coroutine_threadsafe(reload_server(), main_event_loop)
+
+async def drain_requests():
+    """
+    Режим завершения: новые запросы получают 503, выполняющиеся дорабатывают не дольше drain_timeout_seconds.
+    При перезапуске вкладки браузера по мере освобождения отключаются и переподключаются к новому процессу.
+    """
+    global draining
+    draining = True
+    timeout = CONFIG.get("drain_timeout_seconds", 300)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    if INFLIGHT_REQUESTS.count:
+        logger.warning(f"Завершение работы: ожидание {INFLIGHT_REQUESTS.count} выполняющихся запросов (не дольше {timeout} с).")
+    while True:
+        if reloading:
+            await broker.release_idle_workers()
+        if INFLIGHT_REQUESTS.count == 0:
+            break
+        if loop.time() >= deadline:
+            logger.warning(f"Срок завершения истёк, прерывается выполняющихся запросов: {INFLIGHT_REQUESTS.count}.")
+            break
+        await asyncio.sleep(0.25)
+    if reloading:
+        await broker.release_idle_workers()
+    logger.info("Выполняющиеся запросы завершены, сервер останавливается.")
+
+async def reload_server():
+    """
+    Перезапуск без простоя: новый процесс получает слушающий сокет и начинает принимать подключения,
+    после чего текущий процесс перестаёт их принимать и дорабатывает выполняющиеся запросы.
+    Без поддержки передачи сокета (Windows, запуск через внешний uvicorn) процесс перезапускается после доработки запросов.
+    """
+    global reloading, traffic_recorder
+    if reloading or draining:
+        return
+    refusal = _reload_refusal()
+    if refusal:
+        logger.error(f"Перезапуск отклонён: {refusal}")
+        return
+    reloading = True
+    # Пакетные задания и запись трафика продолжит новый процесс (результаты уже выполненных элементов сохранены)
+    if batch_manager:
+        await batch_manager.stop()
+    if traffic_recorder:
+        traffic_recorder.close()
+        traffic_recorder = None
+
+    if http_server is None:
+        logger.warning("Сервер запущен внешним uvicorn: перезапуск выполняется после доработки выполняющихся запросов.")
+        await drain_requests()
+        os.execv(sys.executable, ['python'] + sys.argv)
+
+    if SUPPORTS_HANDOFF and listen_socket is not None:
+        successor = await spawn_successor(listen_socket, CONFIG.get("reload_ready_timeout_seconds", 60))
+        if successor is None:
+            # Новый процесс не запустился — продолжаем работу в текущем
+            reloading = False
+            if batch_manager:
+                await batch_manager.start()
+            if CONFIG.get("traffic_recording_enabled", False):
+                traffic_recorder = TrafficRecorder(CONFIG.get("traffic_recording_path", "recordings/ws_traffic.lmbr"))
+            return
+        logger.info(f"Новый процесс сервера (PID {successor.pid}) готов, текущий процесс перестаёт принимать подключения.")
+        http_server.stop_accepting()
+    else:
+        http_server.after_exit.append(lambda: os.execv(sys.executable, ['python'] + sys.argv))
+    http_server.request_drain()
+
+def _reload_refusal() -> str | None:
+    """Причина, по которой перезапуск без простоя невозможен, или None."""
+    if broker_hub is not None:
+        # Новый процесс не сможет занять адрес хаба, пока его держит текущий, а фронты потеряют вкладки
+        return ("в режиме хаба (broker_mode: \"hub\") перезапуск не поддерживается: адрес брокера занят текущим процессом. "
+                "Остановите хаб (Ctrl+C) и запустите заново; фронты переподключатся сами.")
+    return None
+
+def _reject_if_draining():
+    """Во время завершения работы новые запросы отклоняются: клиент должен повторить их позже (или на другом сервере)."""
+    if draining:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервер перезапускается или останавливается, повторите запрос через несколько секунд.",
+            headers={"Retry-After": "2", "Connection": "close"},
+        )
 
 def idle_monitor():
     """Работает в фоновом потоке, отслеживает простой сервера."""
@@ -372,7 +530,7 @@ def idle_monitor():
             if idle_time > timeout:
                 logger.info(f"Время простоя сервера ({idle_time:.0f}с) превысило порог ({timeout}с).")
                 restart_server()
-                break  # Выходим из цикла, так как процесс будет заменён
+                break  # Выходим из цикла: работу продолжит новый процесс
                 
         # Проверяем каждые 10 секунд
         time.sleep(10)
@@ -381,9 +539,54 @@ def idle_monitor():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Функция жизненного цикла, выполняемая при запуске сервера."""
-    global idle_monitor_thread, last_activity_time, main_event_loop
+    global idle_monitor_thread, last_activity_time, main_event_loop, broker, broker_hub, batch_manager, traffic_recorder, image_preprocessor, worker_wait_until
     main_event_loop = asyncio.get_running_loop()  # Получаем главный цикл событий
     load_config()  # Сначала загружаем конфигурацию
+
+    # --- Выбор режима брокера ---
+    # Переменная окружения позволяет запускать хаб и фронты с одним и тем же config.jsonc
+    broker_mode = os.environ.get("LMARENA_BROKER_MODE") or CONFIG.get("broker_mode", "memory")
+    broker_address = os.environ.get("LMARENA_BROKER_ADDRESS") or CONFIG.get("broker_address", "127.0.0.1:5105")
+    broker_token = os.environ.get("LMARENA_BROKER_TOKEN") or CONFIG.get("broker_token") or None
+    record_ttl = CONFIG.get("request_record_ttl_seconds", 900)
+    if broker_mode == "front":
+        broker = SocketBroker(broker_address, token=broker_token, record_ttl=record_ttl)
+        logger.info(f"Режим брокера: FRONT (вкладки браузера подключены к хабу {broker_address}).")
+    else:
+        broker = InMemoryBroker(
+            record_ttl=record_ttl,
+            heartbeat_interval=CONFIG.get("heartbeat_interval_seconds", 5),
+            unhealthy_after_missed=CONFIG.get("heartbeat_unhealthy_after_missed", 2),
+            disconnect_after_missed=CONFIG.get("heartbeat_disconnect_after_missed", 6),
+            resume_grace=CONFIG.get("resume_grace_seconds", 20),
+        )
+        if broker_mode == "hub":
+            broker_hub = BrokerHubServer(
+                broker, broker_address, broker_token or load_or_create_broker_token(),
+                prefix_cache_enabled=lambda: CONFIG.get("prefix_cache_enabled", True),
+                structured_stream_enabled=lambda: CONFIG.get("structured_stream_enabled", True),
+            )
+            await broker_hub.start()
+    await broker.start()
+
+    if CONFIG.get("loop_monitor_enabled", True):
+        LOOP_MONITOR.start()
+
+    if CONFIG.get("traffic_recording_enabled", False):
+        traffic_recorder = TrafficRecorder(CONFIG.get("traffic_recording_path", "recordings/ws_traffic.lmbr"))
+
+    if CONFIG.get("image_preprocessing_enabled", True):
+        image_preprocessor = ImagePreprocessor(
+            settings=lambda: CONFIG,
+            workers=CONFIG.get("image_preprocess_workers", 2),
+            cache_bytes=int(CONFIG.get("image_cache_max_mb", 64)) * 1024 * 1024,
+        )
+        image_preprocessor.start()
+
+    # Пакетные задания: незавершённые после перезапуска продолжаются с места остановки
+    batch_manager = BatchManager(CONFIG.get("batch_storage_dir", "batches"), _execute_batch_item, PRIORITY_GATE, settings=lambda: CONFIG)
+    await batch_manager.start()
+    logger.info(f"Конфигурация загружена. Режим Таверны: {'✅' if CONFIG.get('tavern_mode_enabled') else '❌'}, режим обхода: {'✅' if CONFIG.get('bypass_enabled') else '❌'}.")
     
     # --- Вывод текущего режима работы ---
     mode = CONFIG.get("id_updater_last_mode", "direct_chat")
@@ -412,9 +615,25 @@ async def lifespan(app: FastAPI):
     if CONFIG.get("enable_idle_restart", False):
         idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
         idle_monitor_thread.start()
+
+    if socket_inherited:
+        # Вкладки переподключатся от предыдущего процесса по мере завершения его запросов — до тех пор запросы ждут их
+        worker_wait_until = time.monotonic() + CONFIG.get("drain_timeout_seconds", 300)
+    notify_ready()
         
     yield
     logger.info("Сервер завершает работу.")
+    await batch_manager.stop()
+    if broker_hub:
+        await broker_hub.stop()
+    await broker.stop()
+    await UPSTREAM.direct.close()
+    await LOOP_MONITOR.stop()
+    if traffic_recorder:
+        traffic_recorder.close()
+    if image_preprocessor:
+        image_preprocessor.stop()
+    stop_async_logging()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -482,7 +701,9 @@ async def _process_openai_message(message: dict) -> dict:
 
                 try:
                     # Для base64 извлекаем content_type
-                    if url.startswith("data:"):
+                    if isinstance(url, SpooledDataURI):
+                        content_type = url.content_type
+                    elif url.startswith("data:"):
                         content_type = url.split(';')[0].split(':')[1]
                     else:
                         # Для http URL пытаемся угадать content_type
@@ -497,7 +718,7 @@ async def _process_openai_message(message: dict) -> dict:
                     })
 
                 except (AttributeError, IndexError, ValueError) as e:
-                    logger.warning(f"Ошибка при обработке URL вложения: {url[:100]}... Ошибка: {e}")
+                    logger.warning(f"Ошибка при обработке URL вложения: {str(url)[:100]}... Ошибка: {e}")
 
         text_content = "\n\n".join(text_parts)
     elif isinstance(content, str):
@@ -512,6 +733,33 @@ async def _process_openai_message(message: dict) -> dict:
         "attachments": attachments
     }
 
+async def _shrink_image_attachments(messages: list, verbose: bool):
+    """
+    Уменьшает изображения-вложения (data URI в image_url) до лимитов из config.jsonc.
+    Все изображения запроса обрабатываются параллельно в пуле процессов; URL заменяются на месте.
+    """
+    image_urls = [
+        part["image_url"]
+        for message in messages if isinstance(message.get("content"), list)
+        for part in message["content"]
+        if isinstance(part, dict) and part.get("type") == "image_url" and isinstance(part.get("image_url"), dict)
+        and isinstance(part["image_url"].get("url"), (str, SpooledDataURI)) and part["image_url"]["url"].startswith("data:image/")
+    ]
+    if not image_urls:
+        return
+    results = await asyncio.gather(*(image_preprocessor.process(image_url["url"]) for image_url in image_urls))
+    for image_url, new_url in zip(image_urls, results):
+        if new_url is image_url["url"]:
+            continue
+        image_url["url"] = new_url
+        # Если изменился формат, исправляем расширение в имени файла (поле detail)
+        file_name = image_url.get("detail")
+        if isinstance(file_name, str) and os.path.splitext(file_name)[1]:
+            extension = mimetypes.guess_extension(new_url[5:new_url.index(';')]) or os.path.splitext(file_name)[1]
+            image_url["detail"] = os.path.splitext(file_name)[0] + extension
+    if verbose:
+        logger.info(f"Предобработка изображений: обработано вложений: {len(image_urls)}.")
+
 async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
     """
     Преобразует тело запроса OpenAI в упрощённую нагрузку для скрипта Tampermonkey, применяя режимы Таверны, обхода и Battle.
@@ -521,10 +769,13 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     #    - Преобразование нестандартной роли 'developer' в 'system' для повышения совместимости.
     #    - Разделение текста и вложений.
     messages = openai_data.get("messages", [])
+    normalized_count = 0
     for msg in messages:
         if msg.get("role") == "developer":
             msg["role"] = "system"
-            logger.info("Нормализация роли сообщения: преобразование 'developer' в 'system'.")
+            normalized_count += 1
+    if normalized_count and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Нормализация ролей: {normalized_count} сообщений 'developer' преобразовано в 'system'.")
             
     processed_messages = []
     for msg in messages:
@@ -611,7 +862,7 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     model_type = model_info.get("type", "text")
     if CONFIG.get("bypass_enabled") and model_type == "text":
         # Режим обхода всегда добавляет сообщение пользователя с позицией 'a'
-        logger.info("Режим обхода включён, добавляется пустое сообщение пользователя.")
+        logger.debug("Режим обхода включён, добавляется пустое сообщение пользователя.")
         message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
 
     # 6. Применение позиции участника (Participant Position)
@@ -620,7 +871,8 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
     target_participant = target_participant.lower()  # Убедимся, что это строчные буквы
 
-    logger.info(f"Установка позиций участников в соответствии с режимом '{mode}' (цель: {target_participant if mode == 'battle' else 'N/A'})...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Установка позиций участников в соответствии с режимом '{mode}' (цель: {target_participant if mode == 'battle' else 'N/A'})...")
 
     for msg in message_templates:
         if msg['role'] == 'system':
@@ -645,66 +897,117 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     }
 
 # --- Вспомогательные функции форматирования OpenAI (обеспечивают надёжную JSON-сериализацию) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
+# SSE-блоки формируются сразу в bytes (fast_json): StreamingResponse отдаёт их без повторного кодирования.
+_DONE_CHUNK = b"data: [DONE]\n\n"
+
+def format_openai_chunk(content: str, model: str, request_id: str, index: int = 0) -> bytes:
     """Форматирует в потоковый блок OpenAI."""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
         "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        "choices": [{"index": index, "delta": {"content": content}, "finish_reason": None}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    return b"data: " + fast_json.dumps_bytes(chunk) + b"\n\n"
 
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
-    """Форматирует в завершающий блок OpenAI."""
+def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop', index: int = 0, include_done: bool = True) -> bytes:
+    """Форматирует в завершающий блок OpenAI. При нескольких вариантах ответа [DONE] добавляется только к последнему."""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
         "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
+        "choices": [{"index": index, "delta": {}, "finish_reason": reason}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+    return b"data: " + fast_json.dumps_bytes(chunk) + (b"\n\n" + _DONE_CHUNK if include_done else b"\n\n")
 
-def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
+def format_openai_error_chunk(error_message: str, model: str, request_id: str, index: int = 0) -> bytes:
     """Форматирует в блок ошибки OpenAI."""
     content = f"\n\n[LMArena Bridge Error]: {error_message}"
-    return format_openai_chunk(content, model, request_id)
+    return format_openai_chunk(content, model, request_id, index=index)
 
-def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
-    """Формирует тело ответа OpenAI для непотокового режима."""
+def format_openai_non_stream_choices(contents: list[str], model: str, request_id: str, reasons: list[str]) -> dict:
+    """Формирует тело непотокового ответа OpenAI с несколькими вариантами (choices[i] — contents[i])."""
+    completion_tokens = sum(len(content) // 4 for content in contents)
     return {
         "id": request_id,
         "object": "chat.completion",
         "created": int(time.time()),
         "model": model,
         "choices": [{
-            "index": 0,
+            "index": index,
             "message": {"role": "assistant", "content": content},
             "finish_reason": reason,
-        }],
+        } for index, (content, reason) in enumerate(zip(contents, reasons))],
         "usage": {
             "prompt_tokens": 0,
-            "completion_tokens": len(content) // 4,
-            "total_tokens": len(content) // 4,
+            "completion_tokens": completion_tokens,
+            "total_tokens": completion_tokens,
         },
     }
 
-async def _process_lmarena_stream(request_id: str):
+def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
+    """Формирует тело ответа OpenAI для непотокового режима."""
+    return format_openai_non_stream_choices([content], model, request_id, [reason])
+
+def _resolve_deadlines(model_name: str | None, client_timeout: float | None = None) -> dict:
+    """
+    Сроки ответа для запроса: ожидание первого блока, максимальная пауза между блоками и общий срок.
+    Значения из config.jsonc можно переопределить для модели в model_deadlines; срок клиента
+    (заголовок X-Request-Timeout) может только сократить общий срок. 0 — без ограничения.
+    """
+    overrides = (CONFIG.get("model_deadlines") or {}).get(model_name) or {}
+
+    def setting(key: str, default: float) -> float | None:
+        return overrides.get(key, CONFIG.get(key, default)) or None
+
+    total = setting("total_response_timeout_seconds", 900)
+    if client_timeout:
+        total = min(total, client_timeout) if total else client_timeout
+    return {
+        "first_chunk": setting("first_chunk_timeout_seconds", 120),
+        "inter_chunk": setting("stream_response_timeout_seconds", 360),
+        "total": total,
+        "deadline_at": asyncio.get_running_loop().time() + total if total else None,
+    }
+
+def _parse_client_timeout(request: Request) -> float | None:
+    """Срок ответа, заданный клиентом: X-Request-Timeout или X-Stainless-Timeout (отправляет OpenAI SDK), в секундах."""
+    for header in ("x-request-timeout", "x-stainless-timeout"):
+        value = request.headers.get(header)
+        if value:
+            try:
+                timeout = float(value)
+            except ValueError:
+                logger.warning(f"Недопустимое значение заголовка {header}: '{value}', игнорируется.")
+                continue
+            if timeout > 0:
+                return timeout
+    return None
+
+async def _process_lmarena_stream(request_id: str, fanout: bool = False, deadlines: dict | None = None):
     """
     Основной внутренний генератор: обрабатывает поток сырых данных из браузера и выдаёт структурированные события.
-    Типы событий: ('content', str), ('finish', str), ('error', str)
+    Типы событий: ('content', str, index), ('finish', str, index), ('error', str, 0).
+    index — номер варианта ответа: при fanout=True ответы участников A и B режима Battle
+    разделяются на варианты 0 и 1, иначе всё относится к варианту 0.
+    deadlines — сроки ответа из _resolve_deadlines; по их истечении вкладке отправляется команда прерывания.
     """
-    global IS_REFRESHING_FOR_VERIFICATION
-    queue = response_channels.get(request_id)
+    queue = broker.get_channel(request_id)
     if not queue:
         logger.error(f"PROCESSOR [ID: {request_id[:8]}]: Не найден канал ответа.")
-        yield 'error', 'Внутренняя ошибка сервера: канал ответа не найден.'
+        yield 'error', 'Внутренняя ошибка сервера: канал ответа не найден.', 0
         return
 
     buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds", 360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    # Новое: регулярное выражение для извлечения URL изображений
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+    deadlines = deadlines or _resolve_deadlines(None)
+    loop = asyncio.get_running_loop()
+    received_any = False  # Получен ли от браузера хотя бы один блок
+    browser_finished = False  # Браузер сам завершил запрос ([DONE] или ошибка), прерывать его не нужно
+    # Текст (a0/b0), изображения (a2/b2) и завершение (ad/bd) с указанием участника
+    event_pattern = re.compile(
+        r'(?P<participant>[ab])(?:'
+        r'0:"(?P<text>(?:\\.|[^"\\])*)"'
+        r'|2:(?P<images>\[.*?\])'
+        r'|d:(?P<finish>\{.*?"finishReason".*?\}))'
+    )
     error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
     cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
     
@@ -712,21 +1015,30 @@ async def _process_lmarena_stream(request_id: str):
 
     try:
         while True:
+            # Действующий срок: до первого блока, между блоками или остаток общего срока — что наступит раньше
+            timeout, deadline_kind = (deadlines["inter_chunk"], 'inter_chunk') if received_any else (deadlines["first_chunk"], 'first_chunk')
+            if deadlines["deadline_at"] is not None:
+                remaining = max(0.0, deadlines["deadline_at"] - loop.time())
+                if timeout is None or remaining < timeout:
+                    timeout, deadline_kind = remaining, 'total'
             try:
                 raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
             except asyncio.TimeoutError:
-                logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Тайм-аут ожидания данных браузера ({timeout} секунд).")
-                yield 'error', f'Ответ превысил время ожидания ({timeout} секунд).'
+                if deadline_kind == 'first_chunk':
+                    message = f'Браузер не начал отвечать: превышено время ожидания первого блока ({deadlines["first_chunk"]} секунд).'
+                elif deadline_kind == 'inter_chunk':
+                    message = f'Ответ превысил время ожидания: пауза между блоками больше {deadlines["inter_chunk"]} секунд.'
+                else:
+                    message = f'Ответ превысил общее время ожидания ({deadlines["total"]} секунд).'
+                logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: {message}")
+                yield 'error', message, 0
                 return
+            received_any = True
 
             # --- Обработка проверки Cloudflare на человекоподобность ---
-            def handle_cloudflare_verification():
-                global IS_REFRESHING_FOR_VERIFICATION
-                if not IS_REFRESHING_FOR_VERIFICATION:
+            async def handle_cloudflare_verification():
+                if await broker.request_verification_refresh(request_id):
                     logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Первое обнаружение проверки на человекоподобность, отправка команды обновления.")
-                    IS_REFRESHING_FOR_VERIFICATION = True
-                    if browser_ws:
-                        asyncio.create_task(browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False)))
                     return "Обнаружена проверка на человекоподобность, отправлена команда обновления, пожалуйста, повторите попытку позже."
                 else:
                     logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Обнаружена проверка на человекоподобность, но обновление уже выполняется, ожидание.")
@@ -734,187 +1046,305 @@ async def _process_lmarena_stream(request_id: str):
 
             # 1. Проверка прямых ошибок от WebSocket
             if isinstance(raw_data, dict) and 'error' in raw_data:
+                browser_finished = True
                 error_msg = raw_data.get('error', 'Неизвестная ошибка браузера')
                 if isinstance(error_msg, str):
                     if '413' in error_msg or 'too large' in error_msg.lower():
                         friendly_error_msg = "Ошибка загрузки: размер вложения превышает ограничения сервера LMArena (обычно около 5 МБ). Попробуйте сжать файл или загрузить меньший."
                         logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: Обнаружена ошибка превышения размера вложения (413).")
-                        yield 'error', friendly_error_msg
+                        yield 'error', friendly_error_msg, 0
                         return
                     if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
-                        yield 'error', handle_cloudflare_verification()
+                        yield 'error', await handle_cloudflare_verification(), 0
                         return
-                yield 'error', error_msg
+                yield 'error', error_msg, 0
                 return
 
             # 2. Проверка сигнала [DONE]
             if raw_data == "[DONE]":
+                browser_finished = True
                 # Логика сброса состояния перенесена в websocket_endpoint, чтобы гарантировать сброс при восстановлении соединения
-                if has_yielded_content and IS_REFRESHING_FOR_VERIFICATION:
+                if has_yielded_content and broker.is_refreshing_for_verification:
                     logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Запрос успешен, состояние проверки на человекоподобность будет сброшено при следующем соединении.")
                 break
 
-            # 3. Накопление буфера и проверка содержимого
+            # 3. Типизированные события: вкладка сама разобрала поток LMArena (structured_stream_enabled)
+            if isinstance(raw_data, dict) and 'events' in raw_data:
+                unparsed = []
+                for event in raw_data['events']:
+                    kind = event[0]
+                    if kind == 'r':
+                        # Нераспознанные строки (ошибка LMArena, страница Cloudflare) проверяются так же, как сырой поток
+                        unparsed.append(event[1])
+                        continue
+                    choice_index = 1 if fanout and event[1] == 'b' else 0
+                    if kind == 't':
+                        has_yielded_content = True
+                        yield 'content', event[2], choice_index
+                    elif kind == 'i':
+                        yield 'content', f"![Image]({event[2]})", choice_index
+                    elif kind == 'f':
+                        yield 'finish', event[2], choice_index
+                if not unparsed:
+                    continue
+                raw_data = "".join(unparsed)
+
+            # 4. Накопление буфера и проверка содержимого
             buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
 
             if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                yield 'error', handle_cloudflare_verification()
+                yield 'error', await handle_cloudflare_verification(), 0
                 return
             
             if (error_match := error_pattern.search(buffer)):
                 try:
-                    error_json = json.loads(error_match.group(1))
-                    yield 'error', error_json.get("error", "Неизвестная ошибка от LMArena")
+                    error_json = fast_json.loads(error_match.group(1))
+                    yield 'error', error_json.get("error", "Неизвестная ошибка от LMArena"), 0
                     return
                 except json.JSONDecodeError: pass
 
-            # Приоритетная обработка текстового содержимого
-            while (match := text_pattern.search(buffer)):
-                try:
-                    text_content = json.loads(f'"{match.group(1)}"')
-                    if text_content:
-                        has_yielded_content = True
-                        yield 'content', text_content
-                except (ValueError, json.JSONDecodeError): pass
-                buffer = buffer[match.end():]
-
-            # Новое: обработка содержимого изображений
-            while (match := image_pattern.search(buffer)):
-                try:
-                    image_data_list = json.loads(match.group(1))
-                    if isinstance(image_data_list, list) and image_data_list:
-                        image_info = image_data_list[0]
-                        if image_info.get("type") == "image" and "image" in image_info:
-                            # Оборачиваем URL в Markdown-формат и выдаём как блок контента
-                            markdown_image = f"![Image]({image_info['image']})"
-                            yield 'content', markdown_image
-                except (json.JSONDecodeError, IndexError) as e:
-                    logger.warning(f"Ошибка при разборе URL изображения: {e}, буфер: {buffer[:150]}")
+            # Разбор событий участников строго в порядке появления в буфере.
+            # В режиме разветвления Battle события 'a' и 'b' относятся к разным вариантам ответа,
+            # поэтому завершение одного участника не должно "перепрыгивать" через текст другого.
+            while (match := event_pattern.search(buffer)):
+                participant = match.group('participant')
+                choice_index = 1 if fanout and participant == 'b' else 0
+                if match.group('text') is not None:
+                    try:
+                        text_content = fast_json.loads(f'"{match.group("text")}"')
+                        if text_content:
+                            has_yielded_content = True
+                            yield 'content', text_content, choice_index
+                    except (ValueError, json.JSONDecodeError): pass
+                elif match.group('images') is not None:
+                    # Обработка содержимого изображений
+                    try:
+                        image_data_list = fast_json.loads(match.group('images'))
+                        if isinstance(image_data_list, list) and image_data_list:
+                            image_info = image_data_list[0]
+                            if image_info.get("type") == "image" and "image" in image_info:
+                                # Оборачиваем URL в Markdown-формат и выдаём как блок контента
+                                markdown_image = f"![Image]({image_info['image']})"
+                                yield 'content', markdown_image, choice_index
+                    except (json.JSONDecodeError, IndexError) as e:
+                        logger.warning(f"Ошибка при разборе URL изображения: {e}, буфер: {buffer[:150]}")
+                else:
+                    try:
+                        finish_data = fast_json.loads(match.group('finish'))
+                        yield 'finish', finish_data.get("finishReason", "stop"), choice_index
+                    except (json.JSONDecodeError, IndexError): pass
                 buffer = buffer[match.end():]
 
-            if (finish_match := finish_pattern.search(buffer)):
-                try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
-
     except asyncio.CancelledError:
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Задача отменена.")
     finally:
-        if request_id in response_channels:
-            del response_channels[request_id]
-            logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Канал ответа очищен.")
+        if broker.get_channel(request_id) is not None:
+            if not browser_finished:
+                # Срок истёк, ответ содержал ошибку или клиент отключился — вкладке (или прямому запросу) незачем продолжать
+                UPSTREAM.abort(request_id)
+            broker.close_channel(request_id)
+            if _req_log(request_id):
+                logger.info(f"PROCESSOR [ID: {request_id[:8]}]: Канал ответа очищен.")
+
+async def _merge_branch_events(branches: list[tuple[str, int, Exception | None]], deadlines: dict | None = None):
+    """
+    Объединяет потоки событий ветвей запроса (n > 1) в один.
+    Выдаёт (тип события, данные, индекс варианта ответа, номер ветви); индексы вариантов ветвей идут подряд.
+    Ошибка или тайм-аут одной ветви не прерывают остальные.
+    """
+    if len(branches) == 1:
+        request_id, choice_count, _ = branches[0]
+        async for event_type, data, index in _process_lmarena_stream(request_id, fanout=choice_count > 1, deadlines=deadlines):
+            yield event_type, data, index, 0
+        return
+
+    queue = asyncio.Queue()
 
-async def stream_generator(request_id: str, model: str):
-    """Форматирует поток внутренних событий в SSE-ответ OpenAI."""
+    async def pump(branch_no: int, request_id: str, choice_count: int, dispatch_error, offset: int):
+        try:
+            if dispatch_error is not None:
+                await queue.put(('error', str(dispatch_error), offset, branch_no))
+                return
+            async for event_type, data, index in _process_lmarena_stream(request_id, fanout=choice_count > 1, deadlines=deadlines):
+                await queue.put((event_type, data, offset + index, branch_no))
+        except Exception as e:
+            logger.error(f"PROCESSOR [ID: {request_id[:8]}]: Ошибка ветви запроса: {e}", exc_info=True)
+            await queue.put(('error', str(e), offset, branch_no))
+        finally:
+            await queue.put(None)
+
+    tasks, offset = [], 0
+    for branch_no, (request_id, choice_count, dispatch_error) in enumerate(branches):
+        tasks.append(asyncio.create_task(pump(branch_no, request_id, choice_count, dispatch_error, offset)))
+        offset += choice_count
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is None:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        # Клиент отключился — отменяем оставшиеся ветви (их каналы закрываются в _process_lmarena_stream)
+        for task in tasks:
+            task.cancel()
+
+def _branch_choice_indices(branches: list[tuple[str, int, Exception | None]]) -> list[range]:
+    """Индексы вариантов ответа, принадлежащих каждой ветви."""
+    result, offset = [], 0
+    for _, choice_count, _ in branches:
+        result.append(range(offset, offset + choice_count))
+        offset += choice_count
+    return result
+
+async def stream_generator(branches: list[tuple[str, int, Exception | None]], model: str, deadlines: dict | None = None, events=None):
+    """
+    Форматирует поток внутренних событий в SSE-ответ OpenAI.
+    branches — ветви запроса (request_id, число вариантов, ошибка отправки): для n > 1 и разветвления
+    режима Battle варианты всех ветвей идут в одном потоке со сквозными индексами choices.
+    events — готовый поток событий (подписка на объединённый запрос); по умолчанию читаются ветви.
+    """
+    request_id = branches[0][0]
     response_id = f"chatcmpl-{uuid.uuid4()}"
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: Потоковый генератор запущен.")
+    if _req_log(request_id):
+        logger.info(f"STREAMER [ID: {request_id[:8]}]: Потоковый генератор запущен.")
     
-    finish_reason_to_send = 'stop'  # Причина завершения по умолчанию
+    branch_indices = _branch_choice_indices(branches)
+    choice_count = branch_indices[-1].stop
+    finish_reasons = ['stop'] * choice_count  # Причины завершения по умолчанию
 
-    async for event_type, data in _process_lmarena_stream(request_id):
+    async for event_type, data, index, branch_no in events or _merge_branch_events(branches, deadlines):
         if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
+            yield format_openai_chunk(data, model, response_id, index=index)
         elif event_type == 'finish':
             # Сохраняем причину завершения, но не завершаем немедленно, ждём [DONE] от браузера
-            finish_reason_to_send = data
+            finish_reasons[index] = data
             if data == 'content-filter':
                 warning_msg = "\n\nОтвет прерван, вероятно, из-за превышения контекста или внутренней цензуры модели (наиболее вероятно)."
-                yield format_openai_chunk(warning_msg, model, response_id)
+                yield format_openai_chunk(warning_msg, model, response_id, index=index)
         elif event_type == 'error':
             logger.error(f"STREAMER [ID: {request_id[:8]}]: Ошибка в потоке: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
-            return  # При ошибке немедленно завершаем
-
-    # Выполняется только после естественного завершения _process_lmarena_stream (т.е. получения [DONE])
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: Потоковый генератор завершён нормально.")
-
-async def non_stream_response(request_id: str, model: str):
-    """Агрегирует поток внутренних событий и возвращает единый JSON-ответ OpenAI."""
+            if len(branches) == 1:
+                yield format_openai_error_chunk(str(data), model, response_id)
+                yield format_openai_finish_chunk(model, response_id, reason='stop')
+                return  # При ошибке немедленно завершаем
+            # Ошибка одной ветви завершает только её варианты ответа
+            for choice_index in branch_indices[branch_no]:
+                yield format_openai_error_chunk(str(data), model, response_id, index=choice_index)
+
+    # Выполняется только после естественного завершения всех ветвей (т.е. получения [DONE])
+    for index, reason in enumerate(finish_reasons):
+        yield format_openai_finish_chunk(model, response_id, reason=reason, index=index, include_done=index == choice_count - 1)
+    if _req_log(request_id):
+        logger.info(f"STREAMER [ID: {request_id[:8]}]: Потоковый генератор завершён нормально.")
+
+async def non_stream_response(branches: list[tuple[str, int, Exception | None]], model: str, deadlines: dict | None = None, events=None):
+    """Агрегирует поток внутренних событий и возвращает единый JSON-ответ OpenAI. events — как в stream_generator."""
+    request_id = branches[0][0]
     response_id = f"chatcmpl-{uuid.uuid4()}"
-    logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Начало обработки непотокового ответа.")
+    if _req_log(request_id):
+        logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Начало обработки непотокового ответа.")
     
-    full_content = []
-    finish_reason = "stop"
+    branch_indices = _branch_choice_indices(branches)
+    choice_count = branch_indices[-1].stop
+    full_contents = [[] for _ in range(choice_count)]
+    finish_reasons = ["stop"] * choice_count
+    branch_errors = {}
     
-    async for event_type, data in _process_lmarena_stream(request_id):
+    async for event_type, data, index, branch_no in events or _merge_branch_events(branches, deadlines):
         if event_type == 'content':
-            full_content.append(data)
+            full_contents[index].append(data)
         elif event_type == 'finish':
-            finish_reason = data
+            finish_reasons[index] = data
             if data == 'content-filter':
-                full_content.append("\n\nОтвет прерван, вероятно, из-за превышения контекста или внутренней цензуры модели (наиболее вероятно).")
+                full_contents[index].append("\n\nОтвет прерван, вероятно, из-за превышения контекста или внутренней цензуры модели (наиболее вероятно).")
             # Не прерываем здесь, ждём сигнала [DONE] от браузера, чтобы избежать состояния гонки
         elif event_type == 'error':
             logger.error(f"NON-STREAM [ID: {request_id[:8]}]: Ошибка при обработке: {data}")
-            
+            branch_errors[branch_no] = data
+            if len(branches) > 1:
+                # Ошибка одной ветви попадает только в её варианты ответа
+                for choice_index in branch_indices[branch_no]:
+                    full_contents[choice_index].append(f"\n\n[LMArena Bridge Error]: {data}")
+                if len(branch_errors) < len(branches):
+                    continue
+            data = branch_errors.get(0, data)
+
             # Унифицируем коды ошибок для потоковых и непотоковых ответов
-            status_code = 413 if "вложения превышает" in str(data) else 500
+            if "вложения превышает" in str(data):
+                status_code, error_code = 413, "attachment_too_large"
+            elif "время ожидания" in str(data):
+                status_code, error_code = 504, "timeout"
+            else:
+                status_code, error_code = 500, "processing_error"
 
             error_response = {
                 "error": {
                     "message": f"[LMArena Bridge Error]: {data}",
                     "type": "bridge_error",
-                    "code": "attachment_too_large" if status_code == 413 else "processing_error"
+                    "code": error_code
                 }
             }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+            return Response(content=fast_json.dumps_bytes(error_response), status_code=status_code, media_type="application/json")
 
-    final_content = "".join(full_content)
-    response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
+    final_contents = ["".join(parts) for parts in full_contents]
+    response_data = format_openai_non_stream_choices(final_contents, model, response_id, finish_reasons)
     
-    logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Агрегация ответа завершена.")
-    return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
+    if _req_log(request_id):
+        logger.info(f"NON-STREAM [ID: {request_id[:8]}]: Агрегация ответа завершена.")
+    return Response(content=fast_json.dumps_bytes(response_data), media_type="application/json")
+
+async def _release_when_done(generator, *leases):
+    """Обёртка потокового генератора: освобождает слоты (квоты, приоритета), когда поток завершён или клиент отключился."""
+    try:
+        async for chunk in generator:
+            yield chunk
+    finally:
+        for lease in leases:
+            lease.release()
 
 # --- WebSocket-эндпоинт ---
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """Обрабатывает WebSocket-соединение от скрипта Tampermonkey."""
-    global browser_ws, IS_REFRESHING_FOR_VERIFICATION
+    """Обрабатывает WebSocket-соединение от скрипта Tampermonkey (каждая вкладка — отдельный обработчик)."""
+    if not isinstance(broker, InMemoryBroker):
+        # Во фронт-процессе браузеры должны подключаться к процессу-хабу
+        await websocket.close(code=1013)
+        logger.warning("Отклонено подключение браузера: процесс работает в режиме 'front', подключайте вкладки к хабу.")
+        return
+
+    if draining:
+        # Вкладка переподключится к новому процессу (или к этому серверу после его запуска)
+        await websocket.close(code=1012)
+        return
+
     await websocket.accept()
-    if browser_ws is not None:
-        logger.warning("Обнаружено новое подключение скрипта Tampermonkey, старое соединение будет заменено.")
-    
-    # Новое соединение означает завершение процесса проверки на человекоподобность (или его отсутствие)
-    if IS_REFRESHING_FOR_VERIFICATION:
-        logger.info("✅ Установлено новое WebSocket-соединение, состояние проверки на человекоподобность автоматически сброшено.")
-        IS_REFRESHING_FOR_VERIFICATION = False
-        
-    logger.info("✅ Скрипт Tampermonkey успешно подключился к WebSocket.")
-    browser_ws = websocket
+    worker = broker.attach_worker(websocket)
+    logger.info(f"✅ Скрипт Tampermonkey успешно подключился к WebSocket (вкладка {worker.worker_id}, всего вкладок: {len(broker.workers)}).")
+    if traffic_recorder:
+        traffic_recorder.record_connect(worker.worker_id)
     try:
         while True:
             # Ожидаем и принимаем сообщения от скрипта Tampermonkey
             message_str = await websocket.receive_text()
-            message = json.loads(message_str)
-            
-            request_id = message.get("request_id")
-            data = message.get("data")
-
-            if not request_id or data is None:
-                logger.warning(f"Получено недействительное сообщение от браузера: {message}")
-                continue
-
-            # Помещаем полученные данные в соответствующий канал ответа
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
-            else:
-                logger.warning(f"⚠️ Получен ответ для неизвестного или закрытого запроса: {request_id}")
+            message = fast_json.loads(message_str)
+            if traffic_recorder and message.get("type") != "upstream_credentials":
+                # Записывается исходный текст кадра, чтобы воспроизведение повторяло реальные границы блоков.
+                # Кадры с cookies страницы не записываются: файл записи не должен содержать учётные данные.
+                traffic_recorder.record_frame(worker.worker_id, message.get("request_id"), message_str)
+            await broker.handle_browser_message(worker, message, size=len(message_str))
 
     except WebSocketDisconnect:
-        logger.warning("❌ Клиент скрипта Tampermonkey отключился.")
+        logger.warning(f"❌ Клиент скрипта Tampermonkey отключился (вкладка {worker.worker_id}).")
     except Exception as e:
         logger.error(f"Неизвестная ошибка при обработке WebSocket: {e}", exc_info=True)
     finally:
-        browser_ws = None
-        # Очищаем все ожидающие каналы ответа, чтобы избежать зависания запросов
-        for queue in response_channels.values():
-            await queue.put({"error": "Браузер отключился во время операции"})
-        response_channels.clear()
-        logger.info("WebSocket-соединение очищено.")
+        if traffic_recorder:
+            traffic_recorder.record_disconnect(worker.worker_id)
+        # Завершаем ошибкой все ожидающие запросы этой вкладки, чтобы избежать их зависания
+        await broker.detach_worker(worker)
+        logger.info(f"WebSocket-соединение вкладки {worker.worker_id} очищено.")
 
 # --- Совместимые с OpenAI API эндпоинты ---
 @app.get("/v1/models")
@@ -945,13 +1375,13 @@ async def request_model_update():
     Принимает запрос от model_updater.py и отправляет команду через WebSocket,
     чтобы скрипт Tampermonkey отправил исходный код страницы.
     """
-    if not browser_ws:
+    if not broker.has_workers():
         logger.warning("MODEL UPDATE: Получен запрос на обновление, но браузер не подключён.")
         raise HTTPException(status_code=503, detail="Клиент браузера не подключён.")
     
     try:
         logger.info("MODEL UPDATE: Получен запрос на обновление, отправка команды через WebSocket...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        await broker.send_command("send_page_source")
         logger.info("MODEL UPDATE: Команда 'send_page_source' успешно отправлена.")
         return JSONResponse({"status": "success", "message": "Запрос на отправку исходного кода страницы отправлен."})
     except Exception as e:
@@ -972,10 +1402,11 @@ async def update_available_models_endpoint(request: Request):
         )
     
     logger.info("Получено содержимое страницы от скрипта Tampermonkey, начало извлечения доступных моделей...")
-    new_models_list = extract_models_from_html(html_content.decode('utf-8'))
+    # Разбор мегабайтов HTML и запись файла выполняются в потоке, чтобы не останавливать идущие ответы
+    new_models_list = await asyncio.to_thread(extract_models_from_html, html_content.decode('utf-8'))
     
     if new_models_list:
-        save_available_models(new_models_list)
+        await asyncio.to_thread(save_available_models, new_models_list)
         return JSONResponse({"status": "success", "message": "Файл доступных моделей обновлён."})
     else:
         logger.error("Не удалось извлечь данные моделей из HTML, предоставленного скриптом Tampermonkey.")
@@ -989,35 +1420,65 @@ async def chat_completions(request: Request):
     """
     Обрабатывает запросы на завершение чата.
     Принимает запросы в формате OpenAI, преобразует их в формат LMArena,
-    отправляет через WebSocket скрипту Tampermonkey и возвращает результат в потоковом режиме.
+    отправляет в LMArena (через скрипт Tampermonkey или напрямую, см. upstream_transport) и возвращает результат в потоковом режиме.
     """
     global last_activity_time
     last_activity_time = datetime.now()  # Обновляем время активности
-    logger.info(f"Получен API-запрос, время активности обновлено: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
-
+    request_id = str(uuid.uuid4())
+    verbose = _req_log(request_id)
+    if verbose:
+        logger.info(f"API CALL [ID: {request_id[:8]}]: Получен API-запрос, время активности обновлено: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    reload_config_if_changed()  # Подхватываем изменения конфигурации, чтобы гарантировать актуальность идентификаторов сессии
+    _reject_if_draining()
+    # Ключ проверяется до чтения тела, чтобы не выгружать на диск вложения неавторизованных запросов
+    key_quota = _authenticate(request)
+
+    # Слоты, которые живут до конца ответа: учёт выполняющихся запросов (для плавной остановки), файлы спула
+    # и профиль запроса (если запрос выбран для профилирования)
+    leases = [INFLIGHT_REQUESTS.enter()]
+    profile = REQUEST_PROFILER.maybe_start(request_id, request.headers)
+    if profile is not None:
+        leases.append(profile)
     try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Недействительное тело запроса JSON")
-
-    model_name = openai_req.get("model")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {})  # Ключевое исправление: возвращаем пустой словарь, если модель не найдена
-    model_type = model_info.get("type", "text")  # По умолчанию текст
-
-    # --- Новое: логика на основе типа модели ---
-    if model_type == 'image':
-        logger.info(f"Обнаружен тип модели '{model_name}' — 'image', обработка через основной интерфейс чата.")
-        # Для моделей изображений больше не вызываем отдельный обработчик, используем основную логику чата,
-        # так как _process_lmarena_stream теперь может обрабатывать данные изображений.
-        # Это означает, что генерация изображений теперь нативно поддерживает потоковые и непотоковые ответы.
-        pass  # Продолжаем с общей логикой чата
-    # --- Конец логики генерации изображений ---
-
-    # Если модель не для изображений, выполняем стандартную логику генерации текста
-    load_config()  # Загружаем последнюю конфигурацию в реальном времени, чтобы гарантировать актуальность идентификаторов сессии
-    # --- Проверка API-ключа ---
+        # Тело разбирается потоково: крупные data URI выгружаются во временные файлы и читаются только при отправке
+        if CONFIG.get("request_spool_enabled", True):
+            spool = RequestSpool(CONFIG.get("request_spool_dir") or None, int(CONFIG.get("request_spool_threshold_kb", 256)) * 1024)
+            leases.append(spool)
+            try:
+                openai_req = await spool.parse(request.stream())
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                raise HTTPException(status_code=400, detail="Недействительное тело запроса JSON")
+            if verbose and spool.handles:
+                logger.info(f"API CALL [ID: {request_id[:8]}]: Вложений выгружено во временные файлы: {len(spool.handles)} ({sum(h.size for h in spool.handles) // 1024} КБ).")
+        else:
+            try:
+                openai_req = fast_json.loads(await request.body())
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                raise HTTPException(status_code=400, detail="Недействительное тело запроса JSON")
+
+        if profile is not None:
+            profile.label = str(openai_req.get("model") or "")
+        response = await _dispatch_chat_request(openai_req, request_id, verbose, key_quota=key_quota, client_timeout=_parse_client_timeout(request), extra_leases=leases)
+    except BaseException:
+        for lease in leases:
+            lease.release()
+        raise
+    # Потоковый ответ освобождает слоты сам, по завершении генератора
+    if not isinstance(response, StreamingResponse):
+        for lease in leases:
+            lease.release()
+    return response
+
+def _authenticate(request: Request):
+    """
+    Проверяет API-ключ запроса. Поддерживаются единственный ключ api_key (без квот)
+    и набор ключей api_keys с индивидуальными квотами. Возвращает квоту ключа или None.
+    """
     api_key = CONFIG.get("api_key")
-    if api_key:
+    API_KEY_QUOTAS.configure(CONFIG.get("api_keys"))
+    key_quota = None
+    if api_key or API_KEY_QUOTAS:
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
             raise HTTPException(
@@ -1025,88 +1486,255 @@ async def chat_completions(request: Request):
                 detail="API-ключ не предоставлен. Укажите его в заголовке Authorization в формате 'Bearer YOUR_KEY'."
             )
         
-        provided_key = auth_header.split(' ')[1]
-        if provided_key != api_key:
+        provided_key = auth_header.split(' ', 1)[1].strip()
+        key_quota = API_KEY_QUOTAS.lookup(provided_key)
+        # Сравнение за постоянное время, чтобы не раскрывать ключ через тайминг
+        legacy_match = bool(api_key) and hmac.compare_digest(provided_key.encode('utf-8'), api_key.encode('utf-8'))
+        if key_quota is None and not legacy_match:
             raise HTTPException(
                 status_code=401,
                 detail="Предоставлен неверный API-ключ."
             )
+    return key_quota
 
-    # --- Улучшенная проверка соединения для устранения состояния гонки после проверки на человекоподобность ---
-    if IS_REFRESHING_FOR_VERIFICATION and not browser_ws:
+def _authorize_internal(request: Request):
+    """
+    Доступ к управляющим эндпоинтам /internal/*: при настроенных API-ключах нужен действительный ключ,
+    без них запросы принимаются только с локального адреса (127.0.0.1, ::1).
+    """
+    reload_config_if_changed()  # Только что заданный api_key действует сразу
+    _authenticate(request)
+    if CONFIG.get("api_key") or API_KEY_QUOTAS:
+        return
+    host = request.client.host if request.client else ""
+    if host not in LOOPBACK_HOSTS:
         raise HTTPException(
-            status_code=503,
-            detail="Ожидание обновления браузера для завершения проверки на человекоподобность, повторите попытку через несколько секунд."
+            status_code=403,
+            detail="Управляющие эндпоинты без API-ключа доступны только с локального адреса. Задайте api_key в config.jsonc.",
         )
 
-    if not browser_ws:
-        raise HTTPException(
-            status_code=503,
-            detail="Клиент скрипта Tampermonkey не подключён. Убедитесь, что страница LMArena открыта и скрипт активирован."
-        )
+def _key_owner(request: Request) -> str | None:
+    """Владелец пакетных заданий: SHA-256 API-ключа запроса (None, если авторизация не настроена). Вызывается после _authenticate."""
+    if not (CONFIG.get("api_key") or API_KEY_QUOTAS):
+        return None
+    return key_digest(request.headers.get('Authorization', '').split(' ', 1)[1].strip())
 
-    # --- Логика сопоставления моделей и идентификаторов сессий ---
-    session_id, message_id = None, None
-    mode_override, battle_target_override = None, None
+def _select_endpoints(model_name: str, count: int, verbose: bool) -> list[dict]:
+    """
+    Выбирает эндпоинты (сессии LMArena) для count параллельных вызовов модели.
+    Из пула сопоставлений берутся по возможности разные записи; если вызовов больше, чем записей,
+    записи используются повторно по кругу. Без сопоставления используется глобальный ID из config.jsonc.
+    """
+    reload_model_endpoint_map_if_changed()
+    selected_mappings = []
 
     if model_name and model_name in MODEL_ENDPOINT_MAP:
         mapping_entry = MODEL_ENDPOINT_MAP[model_name]
-        selected_mapping = None
 
         if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
-            logger.info(f"Для модели '{model_name}' случайным образом выбран один из списков сопоставлений.")
+            pool = random.sample(mapping_entry, len(mapping_entry))
+            selected_mappings = [pool[i % len(pool)] for i in range(count)]
+            if verbose:
+                logger.info(f"Для модели '{model_name}' случайным образом выбран один из списков сопоставлений.")
         elif isinstance(mapping_entry, dict):
-            selected_mapping = mapping_entry
-            logger.info(f"Для модели '{model_name}' найден единственный сопоставленный эндпоинт (старый формат).")
-        
-        if selected_mapping:
-            session_id = selected_mapping.get("session_id")
-            message_id = selected_mapping.get("message_id")
-            # Ключевое: получение информации о режиме
-            mode_override = selected_mapping.get("mode")  # Может быть None
-            battle_target_override = selected_mapping.get("battle_target")  # Может быть None
-            log_msg = f"Будет использован Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
-            if mode_override:
-                log_msg += f" (режим: {mode_override}"
-                if mode_override == 'battle':
-                    log_msg += f", цель: {battle_target_override or 'A'}"
+            selected_mappings = [mapping_entry] * count
+            if verbose:
+                logger.info(f"Для модели '{model_name}' найден единственный сопоставленный эндпоинт (старый формат).")
+
+    endpoints = []
+    for selected_mapping in selected_mappings:
+        session_id = selected_mapping.get("session_id")
+        if not session_id:
+            continue
+        # Ключевое: получение информации о режиме
+        endpoint = {
+            "session_id": session_id,
+            "message_id": selected_mapping.get("message_id"),
+            "mode": selected_mapping.get("mode"),  # Может быть None
+            "battle_target": selected_mapping.get("battle_target"),  # Может быть None
+            "fanout": selected_mapping.get("fanout"),  # Может быть None
+        }
+        if verbose:
+            log_msg = f"Будет использован Session ID: ...{session_id[-6:]}"
+            if endpoint["mode"]:
+                log_msg += f" (режим: {endpoint['mode']}"
+                if endpoint["mode"] == 'battle':
+                    log_msg += f", цель: {endpoint['battle_target'] or 'A'}"
                 log_msg += ")"
             logger.info(log_msg)
+        endpoints.append(endpoint)
 
-    # Если session_id всё ещё None, переходим к логике глобального отката
-    if not session_id:
+    # Если действительных сопоставлений нет, переходим к логике глобального отката
+    if not endpoints:
         if CONFIG.get("use_default_ids_if_mapping_not_found", True):
             session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
             # При использовании глобальных идентификаторов не устанавливаем переопределение режима
-            mode_override, battle_target_override = None, None
-            logger.info(f"Для модели '{model_name}' не найдено действительное сопоставление, используется глобальный Session ID по умолчанию: ...{session_id[-6:] if session_id else 'N/A'}")
+            endpoints = [{
+                "session_id": session_id,
+                "message_id": CONFIG.get("message_id"),
+                "mode": None,
+                "battle_target": None,
+                "fanout": None,
+            } for _ in range(count)]
+            if verbose:
+                logger.info(f"Для модели '{model_name}' не найдено действительное сопоставление, используется глобальный Session ID по умолчанию: ...{session_id[-6:] if session_id else 'N/A'}")
         else:
             logger.error(f"Модель '{model_name}' не имеет действительного сопоставления в 'model_endpoint_map.json', и откат к идентификаторам по умолчанию отключён.")
             raise HTTPException(
                 status_code=400,
                 detail=f"Для модели '{model_name}' не настроен отдельный идентификатор сессии. Добавьте действительное сопоставление в 'model_endpoint_map.json' или включите 'use_default_ids_if_mapping_not_found' в 'config.jsonc'."
             )
+    elif len(endpoints) < count:
+        # Часть записей пула без session_id — недостающие вызовы распределяются по действительным
+        endpoints = [dict(endpoints[i % len(endpoints)]) for i in range(count)]
 
     # --- Проверка окончательно определённой информации о сессии ---
-    if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
-        raise HTTPException(
+    for endpoint in endpoints:
+        session_id, message_id = endpoint["session_id"], endpoint["message_id"]
+        if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
+            raise HTTPException(
+                status_code=400,
+                detail="Окончательно определённые идентификаторы сессии или сообщения недействительны. Проверьте конфигурацию в 'model_endpoint_map.json' и 'config.jsonc' или запустите `id_updater.py` для обновления значений по умолчанию."
+            )
+    return endpoints
+
+async def _dispatch_chat_request(openai_req: dict, request_id: str, verbose: bool, key_quota=None, interactive: bool = True, client_timeout: float | None = None, extra_leases=()):
+    """
+    Общая часть обработки запроса чата (для /v1/chat/completions и пакетных заданий):
+    выбор сессии, проверка квот, преобразование и отправка в браузер, формирование ответа.
+    client_timeout — срок ответа, заданный клиентом (секунды с момента получения запроса).
+    extra_leases — слоты вызывающего (учёт запроса, файлы спула); при потоковом ответе освобождаются вместе с генератором.
+    """
+    model_name = openai_req.get("model")
+    # Общий срок отсчитывается от получения запроса, включая загрузку вложений и очередь
+    deadlines = _resolve_deadlines(model_name, client_timeout)
+    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {})  # Ключевое исправление: возвращаем пустой словарь, если модель не найдена
+    model_type = model_info.get("type", "text")  # По умолчанию текст
+
+    # --- Новое: логика на основе типа модели ---
+    if model_type == 'image':
+        if verbose:
+            logger.info(f"Обнаружен тип модели '{model_name}' — 'image', обработка через основной интерфейс чата.")
+        # Для моделей изображений больше не вызываем отдельный обработчик, используем основную логику чата,
+        # так как _process_lmarena_stream теперь может обрабатывать данные изображений.
+        # Это означает, что генерация изображений теперь нативно поддерживает потоковые и непотоковые ответы.
+        pass  # Продолжаем с общей логикой чата
+    # --- Конец логики генерации изображений ---
+
+    # --- Бюджет контекста: слишком длинный диалог отклоняется или сокращается до обращения к браузеру ---
+    try:
+        _apply_context_budget(openai_req, model_name, model_info, request_id)
+    except ContextTooLarge as e:
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: {e}")
+        return JSONResponse(
             status_code=400,
-            detail="Окончательно определённые идентификаторы сессии или сообщения недействительны. Проверьте конфигурацию в 'model_endpoint_map.json' и 'config.jsonc' или запустите `id_updater.py` для обновления значений по умолчанию."
+            content={"error": {"message": f"[LMArena Bridge Error]: {e}", "type": "invalid_request_error", "code": "context_length_exceeded"}}
         )
 
+    # Прямому транспорту (upstream_transport: "direct") с действующими cookies вкладка не нужна
+    if UPSTREAM.browser_required():
+        # После перезапуска вкладки переходят от предыдущего процесса не сразу: ждём их вместо ответа 503
+        while not broker.has_workers() and time.monotonic() < worker_wait_until:
+            await asyncio.sleep(0.2)
+
+        # --- Улучшенная проверка соединения для устранения состояния гонки после проверки на человекоподобность ---
+        if broker.is_refreshing_for_verification and not broker.has_workers():
+            raise HTTPException(
+                status_code=503,
+                detail="Ожидание обновления браузера для завершения проверки на человекоподобность, повторите попытку через несколько секунд."
+            )
+
+        if not broker.has_workers():
+            raise HTTPException(
+                status_code=503,
+                detail="Клиент скрипта Tampermonkey не подключён. Убедитесь, что страница LMArena открыта и скрипт активирован."
+            )
+
+    # --- Количество вариантов ответа (параметр n) ---
+    try:
+        n = int(openai_req.get("n") or 1)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Параметр 'n' должен быть целым числом.")
+    max_n = CONFIG.get("max_choices_per_request", 8)
+    if n < 1 or n > max_n:
+        raise HTTPException(status_code=400, detail=f"Параметр 'n' должен быть в диапазоне от 1 до {max_n} (см. 'max_choices_per_request' в config.jsonc).")
+
+    # --- Логика сопоставления моделей и идентификаторов сессий ---
+    endpoints = _select_endpoints(model_name, n, verbose)
+
     if not model_name or model_name not in MODEL_NAME_TO_ID_MAP:
         logger.warning(f"Запрошенная модель '{model_name}' отсутствует в models.json, будет использован идентификатор модели по умолчанию.")
 
-    request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
-    logger.info(f"API CALL [ID: {request_id[:8]}]: Создан канал ответа.")
+    # --- Разветвление режима Battle ---
+    # Один вызов LMArena в режиме Battle возвращает ответы двух участников; при разветвлении они
+    # отдаются клиенту как два варианта ответа (A, затем B). Приоритет: поле запроса > сопоставление > config.
+    for endpoint in endpoints:
+        endpoint["choice_count"] = 1
+        if (endpoint["mode"] or CONFIG.get("id_updater_last_mode", "direct_chat")) == 'battle':
+            battle_fanout = openai_req.get("battle_fanout")
+            if battle_fanout is None:
+                battle_fanout = endpoint["fanout"] if endpoint["fanout"] is not None else CONFIG.get("battle_fanout_enabled", False)
+            if battle_fanout:
+                endpoint["choice_count"] = 2
+                if verbose:
+                    logger.info(f"API CALL [ID: {request_id[:8]}]: Разветвление Battle: ответы участников A и B будут возвращены как два варианта.")
+
+    # --- Проверка квот ключа (до того, как запрос займёт браузер и LMArena) ---
+    # Каждая ветвь n > 1 — отдельный вызов LMArena, поэтому списывается n запросов и n потоков
+    lease = QuotaLease(None)
+    if key_quota is not None:
+        try:
+            lease = API_KEY_QUOTAS.acquire(key_quota, estimate_request_tokens(openai_req) * n, streams=n)
+        except QuotaExceeded as e:
+            logger.warning(f"API CALL [ID: {request_id[:8]}]: {e}")
+            return JSONResponse(
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+                content={"error": {"message": f"[LMArena Bridge Error]: {e}", "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}}
+            )
 
+    # --- Объединение одинаковых одновременных запросов ---
+    # Ведущий запрос создаёт Flight до загрузки вложений, чтобы повторы, пришедшие в это время, тоже его нашли
+    flight = None
+    if _coalescing_enabled(openai_req, model_name):
+        try:
+            coalesce_key = await _coalescing_key(openai_req, model_name, model_type, endpoints)
+            while flight is None:
+                existing = SINGLE_FLIGHT.get(coalesce_key)
+                if existing is None:
+                    flight = SINGLE_FLIGHT.create(coalesce_key)
+                elif await existing.wait_started():
+                    existing.joined += 1
+                    if verbose:
+                        logger.info(f"API CALL [ID: {request_id[:8]}]: Идентичный запрос уже выполняется (ID: {existing.branches[0][0][:8]}), ответ будет общим.")
+                    return await _flight_response(existing, openai_req, model_name, (lease, *extra_leases))
+                # Иначе ведущий не смог отправить запрос — пробуем сами
+        except BaseException:
+            lease.release()
+            raise
+
+    # Первая ветвь использует идентификатор запроса, остальные — производные от него
+    for branch_no, endpoint in enumerate(endpoints):
+        endpoint["request_id"] = request_id if branch_no == 0 else f"{request_id}-n{branch_no}"
+        broker.open_channel(endpoint["request_id"], endpoint=endpoint["session_id"])
+    if verbose:
+        logger.info(f"API CALL [ID: {request_id[:8]}]: Создан канал ответа" + (f" для каждой из {n} ветвей." if n > 1 else "."))
+    # Пока выполняется интерактивный запрос, пакетные задания не начинают новые элементы
+    priority_lease = PRIORITY_GATE.enter_interactive() if interactive else QuotaLease(None)
+
+    def close_channels():
+        for endpoint in endpoints:
+            broker.close_channel(endpoint["request_id"])
+
+    # Слот потока освобождается по завершении ответа; для потокового режима владение передаётся генератору
+    lease_handed_off = False
     try:
         # --- Предобработка вложений (включая загрузку в файловое хранилище) ---
         # Обрабатываем все вложения до взаимодействия с браузером. При ошибке немедленно возвращаем ошибку.
         messages_to_process = openai_req.get("messages", [])
+        if image_preprocessor:
+            # Сначала уменьшаем изображения: и в файловое хранилище, и в браузер уходят уже сжатые данные
+            await _shrink_image_attachments(messages_to_process, verbose)
         for message in messages_to_process:
             content = message.get("content")
             if isinstance(content, list):
@@ -1127,10 +1755,12 @@ async def chat_completions(request: Request):
                         upload_url = upload_url.replace('\\/', '/')
 
                         api_key = CONFIG.get("file_bed_api_key")
-                        file_name = original_filename or f"image_{uuid.uuid4()}.png"
+                        content_type = base64_url.content_type if isinstance(base64_url, SpooledDataURI) else base64_url[5:].split(';', 1)[0]
+                        file_name = original_filename or f"image_{uuid.uuid4()}{mimetypes.guess_extension(content_type) or '.png'}"
                         
-                        logger.info(f"Предобработка файлового хранилища: загрузка '{file_name}'...")
-                        uploaded_filename, error_message = await upload_to_file_bed(file_name, base64_url, upload_url, api_key)
+                        if verbose:
+                            logger.info(f"Предобработка файлового хранилища: загрузка '{file_name}'...")
+                        uploaded_filename, error_message = await upload_to_file_bed(file_name, materialize(base64_url), upload_url, api_key, check_existing=CONFIG.get("file_bed_dedup_check", True))
 
                         if error_message:
                             raise IOError(f"Ошибка загрузки в файловое хранилище: {error_message}")
@@ -1140,48 +1770,48 @@ async def chat_completions(request: Request):
                         final_url = f"{url_prefix}/uploads/{uploaded_filename}"
                         
                         part["image_url"]["url"] = final_url
-                        logger.info(f"URL вложения успешно заменён на: {final_url}")
-
-        # 1. Преобразование запроса (вложения уже обработаны)
-        lmarena_payload = await convert_openai_to_lmarena_payload(
-            openai_req,
-            session_id,
-            message_id,
-            mode_override=mode_override,
-            battle_target_override=battle_target_override
-        )
-        
-        # Ключевое дополнение: если модель — для изображений, явно указываем это скрипту Tampermonkey
-        if model_type == 'image':
-            lmarena_payload['is_image_request'] = True
-        
-        # 2. Формируем сообщение для отправки в браузер
-        message_to_browser = {
-            "request_id": request_id,
-            "payload": lmarena_payload
-        }
-        
-        # 3. Отправляем через WebSocket
-        logger.info(f"API CALL [ID: {request_id[:8]}]: Отправка нагрузки скрипту Tampermonkey через WebSocket.")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+                        if verbose:
+                            logger.info(f"URL вложения успешно заменён на: {final_url}")
+
+        # Ветви отправляются параллельно; брокер распределяет их по наименее загруженным вкладкам
+        branches = await asyncio.gather(*(
+            _dispatch_branch(openai_req, endpoint, model_type, verbose) for endpoint in endpoints
+        ))
+        if all(error is not None for _, _, error in branches):
+            # Ни одна ветвь не дошла до браузера — отвечаем так же, как для одиночного запроса
+            raise branches[0][2]
 
         # 4. Определяем тип ответа в зависимости от параметра stream
         is_stream = openai_req.get("stream", False)
 
+        if flight is not None:
+            # Ответ читается один раз в фоновой задаче; ведущий клиент — такой же подписчик, как и повторы
+            lease_handed_off = True
+            flight.start(branches, _merge_branch_events(branches, deadlines), leases=(lease, priority_lease, *extra_leases))
+            return await _flight_response(flight, openai_req, model_name, ())
+
         if is_stream:
             # Возвращаем потоковый ответ
+            lease_handed_off = True
             return StreamingResponse(
-                stream_generator(request_id, model_name or "default_model"),
+                _release_when_done(stream_generator(branches, model_name or "default_model", deadlines), lease, priority_lease, *extra_leases),
                 media_type="text/event-stream"
             )
         else:
             # Возвращаем непотоковый ответ
-            return await non_stream_response(request_id, model_name or "default_model")
+            return await non_stream_response(branches, model_name or "default_model", deadlines)
+    except BrowserUnavailable as e:
+        # Браузер отключился между проверкой и отправкой (или хаб брокера недоступен)
+        close_channels()
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"error": {"message": f"[LMArena Bridge Error]: {e}", "type": "browser_unavailable"}}
+        )
     except (ValueError, IOError) as e:
         # Обрабатываем ошибки обработки вложений
         logger.error(f"API CALL [ID: {request_id[:8]}]: Ошибка предобработки вложений: {e}")
-        if request_id in response_channels:
-            del response_channels[request_id]
+        close_channels()
         # Возвращаем форматированный JSON-ответ с ошибкой
         return JSONResponse(
             status_code=500,
@@ -1189,35 +1819,334 @@ async def chat_completions(request: Request):
         )
     except Exception as e:
         # Обрабатываем все остальные ошибки
-        if request_id in response_channels:
-            del response_channels[request_id]
+        close_channels()
         logger.error(f"API CALL [ID: {request_id[:8]}]: Критическая ошибка при обработке запроса: {e}", exc_info=True)
         # Убедимся, что возвращается форматированный JSON
         return JSONResponse(
             status_code=500,
             content={"error": {"message": str(e), "type": "internal_server_error"}}
         )
+    finally:
+        if not lease_handed_off:
+            lease.release()
+            priority_lease.release()
+            if flight is not None:
+                flight.fail()
+
+def _apply_context_budget(openai_req: dict, model_name: str | None, model_info: dict, request_id: str):
+    """
+    Проверяет, помещается ли диалог в контекст модели (context_tokens в models.json или
+    context_budget_default_tokens), за вычетом резерва на ответ (max_tokens запроса или context_budget_reserve_tokens).
+    Стратегия — поле "context_strategy" запроса или context_budget_strategy. Сокращённая история
+    записывается обратно в openai_req; ContextTooLarge — диалог не помещается.
+    """
+    limit = model_info.get("context_tokens") or CONFIG.get("context_budget_default_tokens") or 0
+    strategy = openai_req.get("context_strategy") or CONFIG.get("context_budget_strategy", "trim_oldest")
+    if strategy not in STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Параметр 'context_strategy' должен быть одним из: {', '.join(STRATEGIES)}.")
+    if not limit or strategy == STRATEGY_OFF:
+        return
+    reserve = openai_req.get("max_completion_tokens") or openai_req.get("max_tokens") or CONFIG.get("context_budget_reserve_tokens", 1024)
+    try:
+        # Резерв не больше половины контекста: клиенты часто передают max_tokens, сравнимый с размером контекста
+        budget = int(limit) - min(int(reserve), int(limit) // 2)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Параметры 'max_tokens' и 'context_tokens' должны быть целыми числами.")
+    messages, dropped, estimated = fit_messages(openai_req.get("messages", []), budget, strategy)
+    if dropped:
+        openai_req["messages"] = messages
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: Диалог не помещается в контекст модели '{model_name}' ({budget} токенов), удалено старых сообщений: {dropped}, осталось ~{estimated} токенов.")
+
+def _coalescing_enabled(openai_req: dict, model_name: str | None) -> bool:
+    """Объединять ли запрос с идентичными: поле "coalesce" в теле запроса > список моделей в config.jsonc."""
+    coalesce = openai_req.get("coalesce")
+    if coalesce is not None:
+        return bool(coalesce)
+    models = CONFIG.get("coalesce_identical_requests_models") or []
+    return "*" in models or model_name in models
+
+async def _coalescing_key(openai_req: dict, model_name: str | None, model_type: str, endpoints: list[dict]) -> str:
+    """
+    Ключ объединения — преобразованная нагрузка (до загрузки вложений в файловое хранилище, которая даёт
+    каждому запросу свои URL), модель и набор вариантов ответа. Параметры OpenAI, не попадающие в нагрузку
+    (temperature и т.п.), LMArena не использует, поэтому на ключ не влияют.
+    """
+    payload = await convert_openai_to_lmarena_payload(
+        openai_req, None, None,
+        mode_override=endpoints[0]["mode"],
+        battle_target_override=endpoints[0]["battle_target"]
+    )
+    return canonical_key(
+        payload,
+        model=model_name,
+        model_type=model_type,
+        choices=[endpoint["choice_count"] for endpoint in endpoints],
+    )
+
+async def _flight_response(flight, openai_req: dict, model_name: str | None, leases):
+    """Ответ клиенту из объединённого запроса: уже выданное начало, затем новые события по мере поступления."""
+    model = model_name or "default_model"
+    if openai_req.get("stream", False):
+        return StreamingResponse(
+            _release_when_done(stream_generator(flight.branches, model, events=flight.subscribe()), *leases),
+            media_type="text/event-stream"
+        )
+    try:
+        return await non_stream_response(flight.branches, model, events=flight.subscribe())
+    finally:
+        for lease in leases:
+            lease.release()
+
+async def _dispatch_branch(openai_req: dict, endpoint: dict, model_type: str, verbose: bool) -> tuple[str, int, Exception | None]:
+    """
+    Преобразует запрос для одного эндпоинта и отправляет его в LMArena (через вкладку браузера или напрямую, см. UPSTREAM).
+    Возвращает (request_id, число вариантов ответа, ошибка отправки или None): ошибка одной ветви n > 1
+    не отменяет остальные и возвращается клиенту в её вариантах ответа.
+    """
+    request_id = endpoint["request_id"]
+    # 1. Преобразование запроса (вложения уже обработаны)
+    lmarena_payload = await convert_openai_to_lmarena_payload(
+        openai_req,
+        endpoint["session_id"],
+        endpoint["message_id"],
+        mode_override=endpoint["mode"],
+        battle_target_override=endpoint["battle_target"]
+    )
+    
+    # Ключевое дополнение: если модель — для изображений, явно указываем это скрипту Tampermonkey
+    if model_type == 'image':
+        lmarena_payload['is_image_request'] = True
+    
+    # 2. Формируем сообщение для отправки в браузер
+    # Дельта-кодирование истории (кеш префиксов) выполняет брокер, так как он знает, какой вкладке уходит запрос
+    message_to_browser = {
+        "request_id": request_id,
+        "payload": lmarena_payload
+    }
+    
+    # 3. Отправляем через выбранный транспорт (WebSocket во вкладку или прямой HTTP-запрос)
+    if CONFIG.get("debug_log_payloads"):
+        # Полная нагрузка может занимать сотни КБ (история + base64-изображения), поэтому выводится только по явному флагу
+        logger.info(f"API CALL [ID: {request_id[:8]}]: Полная нагрузка для браузера: {fast_json.dumps(lmarena_payload)}")
+    try:
+        transport = await UPSTREAM.send(request_id, message_to_browser)
+        if verbose:
+            logger.info(f"API CALL [ID: {request_id[:8]}]: Нагрузка отправлена (транспорт: {transport}).")
+    except BrowserUnavailable as e:
+        broker.close_channel(request_id)
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: {e}")
+        return request_id, endpoint["choice_count"], e
+    return request_id, endpoint["choice_count"], None
+
+# --- Пакетные задания (/v1/batches) ---
+async def _execute_batch_item(body: dict, owner: str | None = None) -> tuple[int, dict]:
+    """
+    Выполняет один элемент пакетного задания как непотоковый запрос чата с низким приоритетом.
+    Элемент списывается с квоты ключа, создавшего задание; при её исчерпании элемент ждёт, а не проваливается.
+    """
+    # Пакетные задания не должны проваливаться из-за временного отсутствия браузера — ждём его подключения
+    # (если запрос может уйти прямым транспортом, вкладка не нужна)
+    while UPSTREAM.browser_required() and not broker.has_workers():
+        await asyncio.sleep(2)
+    while True:
+        reload_config_if_changed()
+        API_KEY_QUOTAS.configure(CONFIG.get("api_keys"))
+        key_quota = API_KEY_QUOTAS.lookup_digest(owner) if owner else None
+        request_id = str(uuid.uuid4())
+        try:
+            response = await _dispatch_chat_request({**body, "stream": False}, request_id, _req_log(request_id), key_quota=key_quota, interactive=False)
+        except HTTPException as e:
+            return e.status_code, {"error": {"message": f"[LMArena Bridge Error]: {e.detail}", "type": "bridge_error"}}
+        response_body = fast_json.loads(response.body)
+        if response.status_code == 429 and key_quota is not None and response_body.get("error", {}).get("type") == "rate_limit_exceeded":
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+            continue
+        return response.status_code, response_body
+
+def _public_batch(meta: dict) -> dict:
+    """Описание задания для клиента (без служебного поля владельца)."""
+    return {key: value for key, value in meta.items() if key != "owner"}
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """
+    Создаёт пакетное задание. Тело запроса — JSONL: по строке на запрос чата
+    (в формате OpenAI Batch {"custom_id", "body": {...}} или просто тело запроса).
+    Необязательный параметр ?concurrency=N переопределяет batch_concurrency из config.jsonc.
+    """
+    reload_config_if_changed()
+    _authenticate(request)
+    owner = _key_owner(request)
+    _reject_if_draining()
+    concurrency = request.query_params.get("concurrency")
+    try:
+        concurrency = int(concurrency) if concurrency else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Параметр concurrency должен быть целым числом.")
+    meta = await batch_manager.create(request.stream(), concurrency=concurrency, owner=owner)
+    return JSONResponse(_public_batch(meta))
+
+@app.get("/v1/batches")
+async def list_batches(request: Request):
+    """Список пакетных заданий ключа запроса (новые первыми)."""
+    _authenticate(request)
+    return {"object": "list", "data": [_public_batch(meta) for meta in batch_manager.list(_key_owner(request))]}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    """Состояние и прогресс пакетного задания."""
+    _authenticate(request)
+    meta = batch_manager.get(batch_id, _key_owner(request))
+    if not meta:
+        raise HTTPException(status_code=404, detail=f"Пакетное задание '{batch_id}' не найдено.")
+    return _public_batch(meta)
+
+@app.get("/v1/batches/{batch_id}/results")
+async def get_batch_results(batch_id: str, request: Request):
+    """
+    Отдаёт результаты в формате JSONL по мере готовности.
+    С параметром ?follow=true соединение остаётся открытым до завершения задания.
+    """
+    _authenticate(request)
+    if not batch_manager.get(batch_id, _key_owner(request)):
+        raise HTTPException(status_code=404, detail=f"Пакетное задание '{batch_id}' не найдено.")
+    follow = request.query_params.get("follow", "").lower() in ("1", "true", "yes")
+    return StreamingResponse(batch_manager.stream_results(batch_id, follow=follow), media_type="application/jsonl")
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    """Отменяет задание: новые элементы не запускаются, уже выполняющиеся завершаются."""
+    _authenticate(request)
+    meta = await batch_manager.cancel(batch_id, _key_owner(request))
+    if not meta:
+        raise HTTPException(status_code=404, detail=f"Пакетное задание '{batch_id}' не найдено.")
+    return _public_batch(meta)
 
 # --- Внутренний коммуникационный эндпоинт ---
 @app.post("/internal/start_id_capture")
-async def start_id_capture():
+async def start_id_capture(request: Request):
     """
     Принимает уведомление от id_updater.py и отправляет команду через WebSocket
     для активации режима захвата идентификаторов в скрипте Tampermonkey.
+    С телом {"persistent": true} захват остаётся активным во всех вкладках до вызова /internal/stop_id_capture.
     """
-    if not browser_ws:
+    try:
+        options = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        options = {}
+    persistent = bool(isinstance(options, dict) and options.get("persistent"))
+    if not broker.has_workers():
         logger.warning("ID CAPTURE: Получен запрос на активацию, но браузер не подключён.")
         raise HTTPException(status_code=503, detail="Клиент браузера не подключён.")
     
     try:
         logger.info("ID CAPTURE: Получен запрос на активацию, отправка команды через WebSocket...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
+        if persistent:
+            await broker.send_command("activate_id_capture", target="all", options={"persistent": True})
+        else:
+            await broker.send_command("activate_id_capture")
         logger.info("ID CAPTURE: Команда активации успешно отправлена.")
         return JSONResponse({"status": "success", "message": "Команда активации отправлена."})
     except Exception as e:
         logger.error(f"ID CAPTURE: Ошибка при отправке команды активации: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Не удалось отправить команду через WebSocket.")
 
+@app.get("/internal/health")
+async def health(request: Request):
+    """Состояние брокера и каждой вкладки браузера: пульс, RTT, пропущенные ping, число запросов в работе."""
+    _authorize_internal(request)
+    return {
+        "broker_mode": broker.mode,
+        "healthy_workers": broker.status()["workers"],
+        "refreshing_for_verification": broker.is_refreshing_for_verification,
+        "draining": draining,
+        "requests_in_flight": INFLIGHT_REQUESTS.count,
+        "upstream": UPSTREAM.status(),
+        "coalesced_flights": len(SINGLE_FLIGHT),
+        "event_loop": LOOP_MONITOR.summary(),
+        "workers": broker.worker_health(),
+    }
+
+@app.get("/internal/metrics")
+async def metrics(request: Request):
+    """Гистограмма задержки цикла событий и число его блокировок в формате Prometheus."""
+    _authorize_internal(request)
+    return Response(LOOP_MONITOR.prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/internal/reload")
+async def reload_endpoint(request: Request):
+    """Перезапуск сервера без простоя (то же, что SIGHUP): новый процесс принимает сокет, текущий дорабатывает запросы."""
+    _authorize_internal(request)
+    if reloading or draining:
+        return JSONResponse(status_code=409, content={"status": "error", "message": "Перезапуск или остановка уже выполняются."})
+    refusal = _reload_refusal()
+    if refusal:
+        return JSONResponse(status_code=409, content={"status": "error", "message": f"Перезапуск отклонён: {refusal}"})
+    asyncio.ensure_future(reload_server())
+    return JSONResponse({"status": "success", "message": "Перезапуск начат."})
+
+def _authorize_profiler(request: Request):
+    """Эндпоинты профилирования: заголовок X-Profile-Token со значением profile_token или доступ к /internal/*."""
+    if REQUEST_PROFILER.token_matches(request.headers.get("x-profile-token")):
+        return
+    _authorize_internal(request)
+
+@app.get("/internal/profile")
+async def profile_status(request: Request):
+    """Состояние профилирования запросов и список сохранённых профилей."""
+    _authorize_profiler(request)
+    return REQUEST_PROFILER.status()
+
+@app.post("/internal/profile")
+async def profile_toggle(request: Request):
+    """
+    Включает профилирование доли запросов без правки config.jsonc:
+    {"sample_rate": 0.1, "duration_seconds": 600}; {"sample_rate": null} — вернуть значение из config.jsonc.
+    """
+    _authorize_profiler(request)
+    try:
+        data = await request.json()
+        rate = data.get("sample_rate")
+        duration = data.get("duration_seconds")
+        REQUEST_PROFILER.set_override(None if rate is None else float(rate), float(duration) if duration else None)
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Ожидается JSON вида {\"sample_rate\": 0.1, \"duration_seconds\": 600}.")
+    logger.info(f"PROFILE: доля профилируемых запросов: {REQUEST_PROFILER.sample_rate}.")
+    return REQUEST_PROFILER.status()
+
+@app.get("/internal/profile/{name}")
+async def profile_download(name: str, request: Request):
+    """Файл профиля в формате свёрнутых стеков (flamegraph.pl, speedscope, inferno)."""
+    _authorize_profiler(request)
+    path = REQUEST_PROFILER.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Профиль не найден.")
+    return FileResponse(path, media_type="text/plain; charset=utf-8", filename=name)
+
+@app.get("/internal/channels")
+async def list_channels(request: Request):
+    """Список выполняющихся запросов брокера: вкладка, сессия, возраст, объём данных и состояние."""
+    _authorize_internal(request)  # request_id из списка позволяют перехватить поток через /ws
+    requests_in_flight = broker.registry.snapshot()
+    return {
+        "count": len(requests_in_flight),
+        "record_ttl_seconds": broker.record_ttl,
+        "requests": requests_in_flight,
+    }
+
+@app.post("/internal/stop_id_capture")
+async def stop_id_capture():
+    """Отключает постоянный режим захвата идентификаторов во всех вкладках (id_updater.py --pool)."""
+    if not broker.has_workers():
+        return JSONResponse({"status": "success", "message": "Браузер не подключён, отключать нечего."})
+    try:
+        await broker.send_command("deactivate_id_capture", target="all")
+        logger.info("ID CAPTURE: Постоянный режим захвата отключён.")
+        return JSONResponse({"status": "success", "message": "Команда отключения отправлена."})
+    except Exception as e:
+        logger.error(f"ID CAPTURE: Ошибка при отправке команды отключения: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Не удалось отправить команду через WebSocket.")
+
 # --- Точка входа программы ---
 if __name__ == "__main__":
     # Рекомендуется считывать порт из config.jsonc, здесь временно закодирован
@@ -1226,4 +2155,15 @@ if __name__ == "__main__":
     logger.info(f"   - Адрес прослушивания: http://127.0.0.1:{api_port}")
     logger.info(f"   - WebSocket-эндпоинт: ws://127.0.0.1:{api_port}/ws")
     
-    uvicorn.run(app, host="0.0.0.0", port=api_port)
\ No newline at end of file
+    # Слушающий сокет создаётся здесь (или принимается от предыдущего процесса при перезапуске),
+    # чтобы его можно было передать новому процессу без закрытия порта
+    listen_socket, socket_inherited = create_listen_socket("0.0.0.0", api_port)
+    if socket_inherited:
+        logger.info("   - Слушающий сокет получен от предыдущего процесса (перезапуск без простоя)")
+    http_server = DrainingServer(uvicorn.Config(app, host="0.0.0.0", port=api_port), on_drain=drain_requests, on_reload=reload_server)
+    try:
+        http_server.run(sockets=[listen_socket])
+    except KeyboardInterrupt:
+        pass
+    for callback in http_server.after_exit:
+        callback()
\ No newline at end of file
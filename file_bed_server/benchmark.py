@@ -0,0 +1,131 @@
+# file_bed_server/benchmark.py
+#
+# Нагрузочная проверка раздачи файлов файловым хранилищем: загружает набор случайных файлов заданных
+# размеров, а затем много одновременных клиентов в течение заданного времени запрашивают их так,
+# как это делают сборщики LMArena и CDN: целиком, с перепроверкой (If-None-Match) или по частям (Range).
+# Каждый ответ проверяется (статус, длина, содержимое при полной загрузке).
+#
+# Пример: python file_bed_server/benchmark.py --concurrency 64 --duration 10 --sizes 64k,1m,8m --mode mixed
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import statistics
+import time
+
+import aiohttp
+
+MODES = ("full", "revalidate", "range", "mixed")
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    multiplier = {"k": 1024, "m": 1024 * 1024}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+async def upload_files(http: aiohttp.ClientSession, server: str, api_key: str | None, sizes: list[int], per_size: int) -> list[dict]:
+    """Загружает случайные файлы и возвращает их описания: имя, размер, SHA-256."""
+    files = []
+    for size in sizes:
+        for _ in range(per_size):
+            data = os.urandom(size)
+            payload = {
+                "file_name": "bench.bin",
+                "file_data": "data:application/octet-stream;base64," + base64.b64encode(data).decode(),
+                "api_key": api_key,
+            }
+            async with http.post(f"{server}/upload", json=payload) as response:
+                response.raise_for_status()
+                result = await response.json()
+            files.append({"name": result["filename"], "size": size, "sha256": hashlib.sha256(data).hexdigest()})
+    return files
+
+
+async def fetch_once(http: aiohttp.ClientSession, server: str, file: dict, mode: str) -> dict:
+    headers = {}
+    expected_status, expected_length = 200, file["size"]
+    if mode == "revalidate":
+        headers["If-None-Match"] = f'"{file["sha256"]}"'
+        expected_status, expected_length = 304, 0
+    elif mode == "range":
+        start = random.randrange(file["size"])
+        end = min(file["size"] - 1, start + random.randrange(1, 256 * 1024))
+        headers["Range"] = f"bytes={start}-{end}"
+        expected_status, expected_length = 206, end - start + 1
+
+    started = time.monotonic()
+    digest = hashlib.sha256() if mode == "full" else None
+    received = 0
+    async with http.get(f"{server}/uploads/{file['name']}", headers=headers) as response:
+        async for chunk in response.content.iter_any():
+            received += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+        status = response.status
+    elapsed = time.monotonic() - started
+
+    error = None
+    if status != expected_status:
+        error = f"статус {status} вместо {expected_status}"
+    elif received != expected_length:
+        error = f"получено {received} байт вместо {expected_length}"
+    elif digest is not None and digest.hexdigest() != file["sha256"]:
+        error = "содержимое не совпадает"
+    return {"mode": mode, "status": status, "latency": elapsed, "bytes": received, "error": error}
+
+
+async def worker(http: aiohttp.ClientSession, server: str, files: list[dict], mode: str, deadline: float, results: list):
+    while time.monotonic() < deadline:
+        request_mode = random.choice(MODES[:3]) if mode == "mixed" else mode
+        try:
+            results.append(await fetch_once(http, server, random.choice(files), request_mode))
+        except aiohttp.ClientError as e:
+            results.append({"mode": request_mode, "status": 0, "latency": 0.0, "bytes": 0, "error": str(e)})
+
+
+async def run(args):
+    server = args.server.rstrip('/')
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        files = await upload_files(http, server, args.api_key, sizes, args.files_per_size)
+        print(f"Загружено файлов: {len(files)} ({', '.join(args.sizes.split(','))}). "
+              f"Клиентов: {args.concurrency}, режим: {args.mode}, длительность: {args.duration} с.")
+
+        results: list[dict] = []
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*(worker(http, server, files, args.mode, deadline, results) for _ in range(args.concurrency)))
+        elapsed = time.monotonic() - started
+
+    errors = [r for r in results if r["error"]]
+    total_bytes = sum(r["bytes"] for r in results)
+    print(f"\nЗапросов: {len(results)} за {elapsed:.2f} с — {len(results) / elapsed:.0f} запросов/с, "
+          f"{total_bytes / elapsed / 1024 / 1024:.1f} МБ/с, ошибок: {len(errors)}.")
+    for mode in MODES[:3]:
+        latencies = sorted(r["latency"] for r in results if r["mode"] == mode and not r["error"])
+        if latencies:
+            print(f"  {mode:<10} {len(latencies):>7} ответов, задержка: медиана {statistics.median(latencies) * 1000:.1f} мс, "
+                  f"p95 {percentile(latencies, 0.95) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+    for error in sorted({r["error"] for r in errors})[:10]:
+        print(f"  ⚠️ {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка раздачи файлов file_bed_server.")
+    parser.add_argument("--server", default="http://127.0.0.1:5180", help="адрес файлового хранилища")
+    parser.add_argument("--api-key", default="your_secret_api_key", help="API_KEY файлового хранилища")
+    parser.add_argument("--concurrency", type=int, default=32, help="число одновременных клиентов")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность нагрузки, с")
+    parser.add_argument("--sizes", default="64k,1m,8m", help="размеры файлов через запятую (суффиксы k, m)")
+    parser.add_argument("--files-per-size", type=int, default=4, help="сколько файлов каждого размера загрузить")
+    parser.add_argument("--mode", choices=MODES, default="mixed", help="full — целиком, revalidate — If-None-Match, range — части файла")
+    asyncio.run(run(parser.parse_args()))
@@ -1,13 +1,18 @@
 # file_bed_server/main.py
+import asyncio
 import base64
+import hashlib
+import mimetypes
 import os
+import re
+import threading
 import uuid
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import JSONResponse, Response, FileResponse
 from pydantic import BaseModel
 import logging
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -24,6 +29,124 @@ API_KEY = "your_secret_api_key"  # Простой ключ для аутенти
 CLEANUP_INTERVAL_MINUTES = 1 # Частота выполнения задачи очистки (в минутах)
 FILE_MAX_AGE_MINUTES = 10 # Максимальное время хранения файлов (в минутах)
 
+# --- Хранилище по содержимому ---
+# Файл называется SHA-256 своего содержимого (плюс расширение), поэтому повторная загрузка тех же данных
+# не пишет файл заново, а возвращает существующее имя и продлевает срок хранения.
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+blob_index: dict[str, str] = {}  # SHA-256 содержимого → имя файла в UPLOAD_DIR
+# Очистка работает в потоке планировщика: проверка срока и удаление файла выполняются под той же блокировкой,
+# что поиск в индексе с продлением срока и сохранение нового файла, иначе очистка может удалить файл,
+# имя которого только что вернули клиенту как уже сохранённое.
+storage_lock = threading.Lock()
+
+def scan_uploads():
+    """Восстанавливает индекс по файлам, оставшимся в директории загрузок после перезапуска."""
+    for filename in os.listdir(UPLOAD_DIR):
+        digest = filename[:64]
+        if DIGEST_PATTERN.fullmatch(digest) and not filename.endswith(".tmp"):
+            blob_index[digest] = filename
+
+# --- Раздача файлов ---
+# Имя файла — хеш содержимого, поэтому по одному URL всегда отдаются одни и те же байты: ответ можно
+# кешировать без перепроверки, а ETag — сам хеш. Небольшие файлы хранятся в памяти: LMArena запрашивает
+# файл сразу после загрузки, иногда несколько раз; крупные отдаются FileResponse (pathsend, если сервер его поддерживает).
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+HOT_CACHE_MAX_BYTES = 64 * 1024 * 1024      # Общий объём файлов в памяти
+HOT_CACHE_MAX_FILE_BYTES = 2 * 1024 * 1024  # Файлы крупнее отдаются с диска
+
+class HotCache:
+    """LRU-кеш содержимого файлов по имени, ограниченный общим объёмом (очистка вызывает discard из своего потока)."""
+
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.total_bytes = 0
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename: str) -> bytes | None:
+        with self._lock:
+            data = self._items.get(filename)
+            if data is not None:
+                self._items.move_to_end(filename)
+            return data
+
+    def put(self, filename: str, data: bytes):
+        if len(data) > self.max_file_bytes:
+            return
+        with self._lock:
+            if filename in self._items:
+                self._items.move_to_end(filename)
+                return
+            self._items[filename] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def discard(self, filename: str):
+        with self._lock:
+            data = self._items.pop(filename, None)
+            if data is not None:
+                self.total_bytes -= len(data)
+
+hot_cache = HotCache(HOT_CACHE_MAX_BYTES, HOT_CACHE_MAX_FILE_BYTES)
+
+def parse_single_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Разбирает заголовок Range с одним диапазоном байт. Возвращает (начало, конец включительно) или None,
+    если заголовок нужно проигнорировать и отдать файл целиком (другие единицы, несколько диапазонов,
+    ошибка формата). ValueError — диапазон начинается за концом файла (ответ 416).
+    """
+    units, _, spec = range_header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, dash, end_text = spec.strip().partition("-")
+    if not dash or not (start_text or end_text) or not all(text.isdigit() for text in (start_text, end_text) if text):
+        return None
+    if not start_text:
+        suffix = int(end_text)  # bytes=-N — последние N байт
+        if suffix == 0:
+            raise ValueError("пустой диапазон")
+        return max(0, size - suffix), size - 1
+    start = int(start_text)
+    if start >= size:
+        raise ValueError("диапазон за концом файла")
+    end = int(end_text) if end_text else size - 1
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def cached_file_response(data: bytes, request: Request, headers: dict, media_type: str) -> Response:
+    """Ответ из кеша в памяти с поддержкой Range и If-Range (как у FileResponse для файлов на диске)."""
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == headers["ETag"]):
+        try:
+            byte_range = parse_single_range(range_header, len(data))
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{len(data)}"})
+        if byte_range is not None:
+            start, end = byte_range
+            return Response(
+                data[start:end + 1], status_code=206, media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{len(data)}"},
+            )
+    return Response(data, media_type=media_type, headers=headers)
+
+def find_blob(digest: str) -> str | None:
+    """Имя сохранённого файла с таким содержимым; срок хранения файла продлевается."""
+    with storage_lock:
+        filename = blob_index.get(digest)
+        if filename is None:
+            return None
+        try:
+            os.utime(os.path.join(UPLOAD_DIR, filename))  # Очистка ориентируется на время изменения файла
+        except OSError:
+            blob_index.pop(digest, None)  # Файл удалён очисткой или вручную
+            return None
+        return filename
+
 # --- Функция очистки ---
 def cleanup_old_files():
     """Просматривает директорию загрузок и удаляет файлы, старше указанного времени."""
@@ -38,11 +161,19 @@ def cleanup_old_files():
             file_path = os.path.join(UPLOAD_DIR, filename)
             if os.path.isfile(file_path):
                 try:
-                    file_mtime = os.path.getmtime(file_path)
-                    if file_mtime < cutoff:
+                    # Блокировка берётся на каждый файл, чтобы не задерживать загрузки на время всего обхода
+                    with storage_lock:
+                        file_mtime = os.path.getmtime(file_path)
+                        if file_mtime >= cutoff:
+                            continue
                         os.remove(file_path)
-                        logger.info(f"Удалён устаревший файл: {filename}")
-                        deleted_count += 1
+                        hot_cache.discard(filename)
+                        if blob_index.get(filename[:64]) == filename:
+                            blob_index.pop(filename[:64], None)
+                    logger.info(f"Удалён устаревший файл: {filename}")
+                    deleted_count += 1
+                except FileNotFoundError:
+                    pass  # Удалён вручную во время обхода
                 except OSError as e:
                     logger.error(f"Ошибка при удалении файла '{file_path}': {e}")
     except Exception as e:
@@ -60,6 +191,8 @@ scheduler = BackgroundScheduler(timezone="UTC")
 async def lifespan(app: FastAPI):
     """Запускает фоновые задачи при старте сервера и останавливает их при завершении."""
     # Запуск планировщика и добавление задачи
+    scan_uploads()
+    logger.info(f"В хранилище найдено файлов: {len(blob_index)}.")
     scheduler.add_job(cleanup_old_files, 'interval', minutes=CLEANUP_INTERVAL_MINUTES)
     scheduler.start()
     logger.info(f"Фоновая задача очистки файлов запущена, выполняется каждые {CLEANUP_INTERVAL_MINUTES} минут.")
@@ -75,9 +208,6 @@ if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
     logger.info(f"Директория загрузок '{UPLOAD_DIR}' создана.")
 
-# --- Монтирование статической директории для доступа к файлам ---
-app.mount(f"/Uploads", StaticFiles(directory=UPLOAD_DIR), name="Uploads")
-
 # --- Определение модели Pydantic ---
 class UploadRequest(BaseModel):
     file_name: str
@@ -89,6 +219,7 @@ class UploadRequest(BaseModel):
 async def upload_file(request: UploadRequest, http_request: Request):
     """
     Принимает файл, закодированный в base64, сохраняет его и возвращает доступный URL.
+    Файл с таким же содержимым не записывается повторно: возвращается уже сохранённое имя.
     """
     # Простая аутентификация по API-ключу
     if API_KEY and request.api_key != API_KEY:
@@ -101,28 +232,42 @@ async def upload_file(request: UploadRequest, http_request: Request):
         # 2. Декодирование base64-данных
         file_data = base64.b64decode(encoded_data)
         
-        # 3. Генерация уникального имени файла для избежания конфликтов
+        # 3. Уже сохранённое содержимое не записывается повторно
+        digest = hashlib.sha256(file_data).hexdigest()
+        existing_filename = find_blob(digest)
+        if existing_filename:
+            logger.info(f"Файл '{request.file_name}' уже сохранён как '{existing_filename}', срок хранения продлён.")
+            return JSONResponse(
+                status_code=200,
+                content={"success": True, "filename": existing_filename, "digest": digest, "deduplicated": True}
+            )
+
+        # 4. Имя файла — хеш содержимого
         file_extension = os.path.splitext(request.file_name)[1]
         if not file_extension:
             # Попытка определить расширение по mime-типу из заголовка
-            import mimetypes
             mime_type = header.split(';')[0].split(':')[1]
             guessed_extension = mimetypes.guess_extension(mime_type)
             file_extension = guessed_extension if guessed_extension else '.bin'
 
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
+        unique_filename = f"{digest}{file_extension}"
         file_path = os.path.join(UPLOAD_DIR, unique_filename)
 
-        # 4. Сохранение файла
-        with open(file_path, "wb") as f:
+        # 5. Сохранение файла: запись во временный файл и переименование, чтобы по URL не отдавался недописанный файл
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
             f.write(file_data)
+        with storage_lock:
+            os.replace(temp_path, file_path)
+            blob_index[digest] = unique_filename
+        hot_cache.put(unique_filename, file_data)  # Файл будет запрошен сразу после загрузки
         
-        # 5. Возврат успешного ответа с уникальным именем файла
+        # 6. Возврат успешного ответа с именем файла
         logger.info(f"Файл '{request.file_name}' успешно сохранён как '{unique_filename}'.")
         
         return JSONResponse(
             status_code=200,
-            content={"success": True, "filename": unique_filename}
+            content={"success": True, "filename": unique_filename, "digest": digest, "deduplicated": False}
         )
 
     except (ValueError, IndexError) as e:
@@ -132,6 +277,64 @@ async def upload_file(request: UploadRequest, http_request: Request):
         logger.error(f"Произошла неизвестная ошибка при обработке загрузки файла: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {e}")
 
+# Ссылки, которые формирует api_server.py, используют путь /uploads/ — он обслуживается так же, как /Uploads/
+@app.api_route("/Uploads/{filename}", methods=["GET", "HEAD"])
+@app.api_route("/uploads/{filename}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_file(filename: str, request: Request):
+    """Отдаёт загруженный файл с долгим кешированием, ETag по содержимому и поддержкой Range."""
+    if os.path.basename(filename) != filename or filename.endswith(".tmp"):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    file_path = os.path.join(UPLOAD_DIR, filename)
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    content_addressed = bool(DIGEST_PATTERN.fullmatch(filename[:64]))
+
+    data = hot_cache.get(filename) if content_addressed else None
+    stat_result = None
+    if data is None:
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+    if content_addressed:
+        headers = {"ETag": f'"{filename[:64]}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    else:
+        # Файлы, сохранённые до перехода на имена по содержимому: ETag по времени изменения и размеру
+        headers = {"ETag": f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"', "Cache-Control": f"public, max-age={FILE_MAX_AGE_MINUTES * 60}"}
+    headers["Accept-Ranges"] = "bytes"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or headers["ETag"] in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+
+    if data is None and content_addressed and stat_result.st_size <= HOT_CACHE_MAX_FILE_BYTES:
+        try:
+            data = await asyncio.to_thread(_read_file, file_path)
+        except OSError:
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        hot_cache.put(filename, data)
+    if data is not None:
+        return cached_file_response(data, request, headers, media_type)
+    return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+@app.head("/blob/{digest}")
+async def blob_exists(digest: str, x_api_key: str | None = Header(default=None)):
+    """
+    Проверка перед загрузкой: есть ли файл с таким SHA-256 содержимого. При 200 имя файла возвращается
+    в заголовке X-File-Name, а срок хранения продлевается — тело загружать не нужно.
+    """
+    if API_KEY and x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="Недействительный API-ключ")
+    if not DIGEST_PATTERN.fullmatch(digest):
+        raise HTTPException(status_code=400, detail="Ожидается SHA-256 в шестнадцатеричном виде")
+    filename = find_blob(digest)
+    if filename is None:
+        return Response(status_code=404)
+    return Response(status_code=200, headers={"X-File-Name": filename})
+
 @app.get("/")
 def read_root():
     return {"message": "Сервер файлового хранилища LMArena Bridge работает."}
@@ -3,11 +3,18 @@
 # Это обновленный одноразовый HTTP-сервер, предназначенный для получения информации о сессии
 # от скрипта Tampermonkey в зависимости от выбранного пользователем режима
 # (DirectChat или Battle) и обновления этой информации в файле config.jsonc.
+#
+# Режим пула (python id_updater.py --pool): сервер работает постоянно, принимает множество захватов,
+# помечает каждый моделью, режимом и целью Battle и атомарно дописывает их без дубликатов
+# в model_endpoint_map.json. Работающий api_server.py подхватывает новые эндпоинты без перезапуска.
 
+import argparse
 import http.server
 import socketserver
 import json
 import re
+import sys
+import tempfile
 import threading
 import os
 import requests
@@ -16,6 +23,7 @@ import requests
 HOST = "127.0.0.1"
 PORT = 5103
 CONFIG_PATH = 'config.jsonc'
+ENDPOINT_MAP_PATH = 'model_endpoint_map.json'
 
 def read_config():
     """Читает и парсит файл config.jsonc, удаляя комментарии для корректного разбора."""
@@ -95,6 +103,78 @@ def save_session_ids(session_id, message_id):
     else:
         print(f"❌ Не удалось обновить идентификаторы. Проверьте сообщения об ошибках выше.")
 
+# --- Режим пула ---
+class CaptureContext:
+    """Текущие метки, которыми помечаются захваты в режиме пула. Меняются командами из консоли."""
+
+    def __init__(self, model: str, mode: str, battle_target: str | None):
+        self.lock = threading.Lock()
+        self.model = model
+        self.mode = mode
+        self.battle_target = battle_target
+        self.captured = 0
+
+    def describe(self) -> str:
+        target = f", цель: {self.battle_target}" if self.mode == 'battle' else ""
+        return f"модель: {self.model}, режим: {self.mode}{target}"
+
+_map_lock = threading.Lock()
+
+def append_endpoint(model: str, entry: dict, path: str = ENDPOINT_MAP_PATH) -> bool:
+    """
+    Добавляет эндпоинт в пул модели в model_endpoint_map.json.
+    Дубликаты (та же пара session_id/message_id) пропускаются. Запись атомарна:
+    файл пишется во временный файл рядом и заменяется через os.replace, поэтому
+    api_server.py никогда не прочитает частично записанный JSON.
+    Возвращает True, если запись добавлена.
+    """
+    with _map_lock:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            endpoint_map = json.loads(content) if content.strip() else {}
+        except FileNotFoundError:
+            endpoint_map = {}
+
+        existing = endpoint_map.get(model)
+        if existing is None:
+            pool = []
+        elif isinstance(existing, dict):
+            # Старый формат с единственным эндпоинтом превращается в список
+            pool = [existing]
+        else:
+            pool = list(existing)
+
+        key = (entry["session_id"], entry["message_id"])
+        if any((item.get("session_id"), item.get("message_id")) == key for item in pool if isinstance(item, dict)):
+            return False
+        pool.append(entry)
+        endpoint_map[model] = pool
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.model_endpoint_map.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(endpoint_map, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+def handle_pool_capture(context: CaptureContext, session_id: str, message_id: str):
+    """Сохраняет один захват в пул текущей модели."""
+    with context.lock:
+        entry = {"session_id": session_id, "message_id": message_id, "mode": context.mode}
+        if context.mode == 'battle':
+            entry["battle_target"] = context.battle_target or "A"
+        model = context.model
+    if append_endpoint(model, entry):
+        context.captured += 1
+        print(f"✅ [{context.captured}] Эндпоинт добавлен в пул '{model}': ...{session_id[-6:]} / ...{message_id[-6:]}")
+    else:
+        print(f"🤔 Эндпоинт ...{session_id[-6:]} уже есть в пуле '{model}', пропущен.")
+
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
     def _send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -117,6 +197,15 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
                 message_id = data.get('messageId')
 
                 if session_id and message_id:
+                    pool_context = getattr(self.server, "pool_context", None)
+                    if pool_context is not None:
+                        handle_pool_capture(pool_context, session_id, message_id)
+                        self.send_response(200)
+                        self._send_cors_headers()
+                        self.end_headers()
+                        self.wfile.write(b'{"status": "success", "persistent": true}')
+                        return
+
                     print("\n" + "=" * 50)
                     print("🎉 Идентификаторы успешно получены из браузера!")
                     print(f"  - Session ID: {session_id}")
@@ -161,13 +250,63 @@ def run_server():
         print("="*50)
         httpd.serve_forever()
 
-def notify_api_server():
-    """Уведомляет главный API-сервер о начале процесса захвата идентификаторов."""
-    api_server_url = "http://127.0.0.1:5102/internal/start_id_capture"
+class _PoolCaptureServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def run_pool_server(context: CaptureContext):
+    """
+    Долгоживущий режим захвата: сервер принимает захваты в фоновом потоке,
+    а консоль принимает команды для смены меток (модель, режим, цель Battle).
+    """
+    httpd = _PoolCaptureServer((HOST, PORT), RequestHandler)
+    httpd.pool_context = context
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    print("\n" + "=" * 50)
+    print("  🚀 Слушатель пула эндпоинтов запущен")
+    print(f"  - Адрес прослушивания: http://{HOST}:{PORT}")
+    print(f"  - Текущие метки: {context.describe()}")
+    print("  - Нажимайте 'Retry' на нужных ответах в LMArena — каждый захват добавляется в пул.")
+    print("  - Команды: 'model <имя>', 'mode direct_chat', 'mode battle <A|B>', 'status', 'quit'")
+    print("=" * 50)
+
     try:
-        response = requests.post(api_server_url, timeout=3)
+        for line in sys.stdin:
+            parts = line.strip().split()
+            if not parts:
+                continue
+            command = parts[0].lower()
+            with context.lock:
+                if command == 'model' and len(parts) > 1:
+                    context.model = " ".join(parts[1:])
+                elif command == 'mode' and len(parts) > 1 and parts[1] in ('direct_chat', 'battle'):
+                    context.mode = parts[1]
+                    if context.mode == 'battle':
+                        target = parts[2].upper() if len(parts) > 2 else (context.battle_target or "A")
+                        context.battle_target = target if target in ("A", "B") else "A"
+                elif command in ('quit', 'exit'):
+                    break
+                elif command != 'status':
+                    print("Неизвестная команда. Доступно: 'model <имя>', 'mode direct_chat', 'mode battle <A|B>', 'status', 'quit'")
+                    continue
+                print(f"Текущие метки: {context.describe()} (захвачено: {context.captured})")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notify_api_server(stop=True)
+        httpd.shutdown()
+        print(f"Сервер пула завершил работу. Добавлено эндпоинтов: {context.captured}.")
+
+def notify_api_server(persistent: bool = False, stop: bool = False):
+    """Уведомляет главный API-сервер о начале (или окончании) процесса захвата идентификаторов."""
+    endpoint = "stop_id_capture" if stop else "start_id_capture"
+    api_server_url = f"http://127.0.0.1:5102/internal/{endpoint}"
+    try:
+        response = requests.post(api_server_url, json={"persistent": persistent}, timeout=3)
         if response.status_code == 200:
-            print("✅ Главный сервер успешно уведомлён о запуске режима захвата идентификаторов.")
+            action = "завершении" if stop else "запуске"
+            print(f"✅ Главный сервер успешно уведомлён о {action} режима захвата идентификаторов.")
             return True
         else:
             print(f"⚠️ Не удалось уведомить главный сервер, код состояния: {response.status_code}.")
@@ -181,10 +320,30 @@ def notify_api_server():
         return False
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Захват идентификаторов сессии LMArena.")
+    parser.add_argument("--pool", action="store_true", help="долгоживущий режим: дописывать захваты в model_endpoint_map.json")
+    parser.add_argument("--model", help="модель, к пулу которой добавляются захваты (режим --pool)")
+    parser.add_argument("--mode", choices=["direct_chat", "battle"], help="режим сессии для захватов (режим --pool)")
+    parser.add_argument("--target", choices=["A", "B"], help="цель Battle для захватов (режим --pool)")
+    args = parser.parse_args()
+
     config = read_config()
     if not config:
         exit(1)
 
+    if args.pool:
+        model = args.model or input("Модель для пула эндпоинтов: ").strip()
+        if not model:
+            print("Имя модели обязательно в режиме пула.")
+            exit(1)
+        mode = args.mode or config.get("id_updater_last_mode", "direct_chat")
+        target = (args.target or config.get("id_updater_battle_target", "A")) if mode == 'battle' else None
+        if notify_api_server(persistent=True):
+            run_pool_server(CaptureContext(model, mode, target))
+        else:
+            print("\nРежим пула прерван из-за невозможности уведомить главный сервер.")
+        exit(0)
+
     # --- Получение выбора пользователя ---
     last_mode = config.get("id_updater_last_mode", "direct_chat")
     mode_map = {"a": "direct_chat", "b": "battle"}
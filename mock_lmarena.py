@@ -0,0 +1,87 @@
+# mock_lmarena.py
+#
+# Локальная имитация потокового API LMArena для проверки прямого транспорта (upstream_transport: "direct")
+# без браузера и без обращений к настоящему сайту. Принимает тот же PUT
+# /nextjs-api/stream/retry-evaluation-session-message/{session_id}/messages/{message_id}, что и вкладка,
+# проверяет cookies и тело запроса и отвечает строками a0:"..." / ad:{...} с заданной задержкой между блоками.
+# Без нужного cookie или с вероятностью --challenge-rate отвечает страницей проверки Cloudflare (403),
+# чтобы проверить переход запроса во вкладку браузера.
+#
+# Пример:
+#   python mock_lmarena.py --port 5190 --chunks 20 --delay 0.05
+#   в config.jsonc: "upstream_transport": "direct", "lmarena_base_url": "http://127.0.0.1:5190",
+#                   "direct_extra_cookies": "arena-auth-prod-v1=test"
+
+import argparse
+import asyncio
+import json
+import random
+from http.cookies import SimpleCookie
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+
+CHALLENGE_PAGE = (
+    "<!DOCTYPE html><html><head><title>Just a moment...</title></head>"
+    "<body>Enable JavaScript and cookies to continue</body></html>"
+)
+
+app = FastAPI()
+args = None
+stats = {"requests": 0, "challenges": 0, "http_versions": {}}
+
+
+@app.put("/nextjs-api/stream/retry-evaluation-session-message/{session_id}/messages/{message_id}")
+async def retry_message(session_id: str, message_id: str, request: Request):
+    stats["requests"] += 1
+    version = request.scope.get("http_version", "?")
+    stats["http_versions"][version] = stats["http_versions"].get(version, 0) + 1
+
+    cookies = SimpleCookie(request.headers.get("cookie", ""))
+    if args.require_cookie not in cookies or random.random() < args.challenge_rate:
+        stats["challenges"] += 1
+        return HTMLResponse(CHALLENGE_PAGE, status_code=403, headers={"cf-mitigated": "challenge"})
+
+    try:
+        body = json.loads(await request.body())
+        messages = body["messages"]
+        last = messages[-1]
+    except (ValueError, KeyError, IndexError):
+        return JSONResponse({"error": "Invalid request body"}, status_code=400)
+    if any(message.get("evaluationSessionId") != session_id for message in messages) or last.get("status") != "pending":
+        return JSONResponse({"error": "Invalid message chain"}, status_code=400)
+
+    # Последнее непустое сообщение пользователя (режим обхода добавляет в конец пустое)
+    prompt = next((m.get("content") for m in reversed(messages) if m.get("role") == "user" and (m.get("content") or "").strip()), "")
+    words = [f"[{body.get('modelId') or 'default'}] echo:"] + prompt.split()
+    # Ответ растягивается до --chunks блоков, чтобы задержка между блоками была заметна
+    while len(words) < args.chunks:
+        words.append(f"w{len(words)}")
+
+    async def stream():
+        for index, word in enumerate(words):
+            if args.delay:
+                await asyncio.sleep(args.delay)
+            yield f'a0:{json.dumps((" " if index else "") + word, ensure_ascii=False)}\n'
+        yield 'ad:{"finishReason":"stop"}\n'
+
+    return StreamingResponse(stream(), media_type="text/plain; charset=utf-8")
+
+
+@app.get("/stats")
+async def get_stats():
+    """Число запросов, проверок и версии HTTP, по которым пришли запросы."""
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Имитация потокового API LMArena для проверки прямого транспорта.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5190)
+    parser.add_argument("--chunks", type=int, default=20, help="минимальное число блоков ответа")
+    parser.add_argument("--delay", type=float, default=0.05, help="задержка перед каждым блоком, с")
+    parser.add_argument("--require-cookie", default="arena-auth-prod-v1", help="cookie, без которого запрос получает проверку")
+    parser.add_argument("--challenge-rate", type=float, default=0.0, help="доля запросов, получающих проверку Cloudflare")
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,347 @@
+# modules/batch_runner.py
+# Пакетные задания в стиле /v1/batches: входной JSONL сохраняется на диск и выполняется в фоне
+# с ограниченным параллелизмом. Пакетный трафик уступает интерактивным запросам.
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("validating", "in_progress", "cancelling")
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+class PriorityGate:
+    """
+    Учитывает активные интерактивные запросы. Пакетные задачи начинают очередной элемент
+    только когда интерактивных запросов меньше порога.
+    """
+
+    def __init__(self):
+        self.interactive_active = 0
+        self._changed = asyncio.Event()
+
+    def enter_interactive(self) -> "_InteractiveLease":
+        self.interactive_active += 1
+        return _InteractiveLease(self)
+
+    def _leave_interactive(self):
+        self.interactive_active -= 1
+        self._changed.set()
+
+    async def wait_for_batch_turn(self, threshold: int):
+        while self.interactive_active >= max(1, threshold):
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+
+class _InteractiveLease:
+    __slots__ = ("gate", "released")
+
+    def __init__(self, gate: PriorityGate):
+        self.gate = gate
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gate._leave_interactive()
+
+
+def _write_text_atomic(path: str, text: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _append_line(path: str, line: str):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+def _parse_input_line(line: str, index: int) -> tuple[str, dict]:
+    """Принимает строку в формате OpenAI Batch ({"custom_id", "body", ...}) или просто тело запроса чата."""
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError("строка должна содержать JSON-объект")
+    body = item.get("body") if isinstance(item.get("body"), dict) else item
+    custom_id = str(item.get("custom_id") or f"line-{index}")
+    return custom_id, body
+
+
+class BatchManager:
+    """
+    Хранит пакетные задания в каталоге storage_dir (по подкаталогу на задание):
+      meta.json     — состояние и счётчики;
+      input.jsonl   — исходные запросы;
+      results.jsonl — результаты (по строке на выполненный элемент, дописываются по мере готовности).
+    После перезапуска незавершённые задания продолжаются, уже выполненные элементы пропускаются.
+    Задание принадлежит ключу, которым оно создано (owner — SHA-256 ключа или None без авторизации).
+    """
+
+    def __init__(self, storage_dir: str, execute, gate: PriorityGate, settings=lambda: {}):
+        # execute(body, owner) -> (status_code, response_body) — выполняет один непотоковый запрос чата от имени ключа
+        self.storage_dir = storage_dir
+        self.execute = execute
+        self.gate = gate
+        self.settings = settings
+        self.batches: dict[str, dict] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._item_tasks: dict[str, set[asyncio.Task]] = {}  # batch_id -> выполняющиеся элементы
+        self._io_locks: dict[str, asyncio.Lock] = {}  # Запись файлов задания по порядку, вне цикла событий
+        self._progress: dict[str, asyncio.Event] = {}
+
+    # --- Пути ---
+    def _dir(self, batch_id: str) -> str:
+        return os.path.join(self.storage_dir, batch_id)
+
+    def input_path(self, batch_id: str) -> str:
+        return os.path.join(self._dir(batch_id), "input.jsonl")
+
+    def results_path(self, batch_id: str) -> str:
+        return os.path.join(self._dir(batch_id), "results.jsonl")
+
+    async def _save_meta(self, meta: dict):
+        # Снимок сериализуется в цикле событий (meta меняется элементами), запись на диск — в потоке
+        text = json.dumps(meta, ensure_ascii=False, indent=2)
+        async with self._io_locks.setdefault(meta["id"], asyncio.Lock()):
+            await asyncio.to_thread(_write_text_atomic, os.path.join(self._dir(meta["id"]), "meta.json"), text)
+
+    # --- Жизненный цикл ---
+    async def start(self):
+        """Загружает сохранённые задания и возобновляет незавершённые."""
+        os.makedirs(self.storage_dir, exist_ok=True)
+        for batch_id in sorted(os.listdir(self.storage_dir)):
+            meta_path = os.path.join(self._dir(batch_id), "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"BATCH: не удалось прочитать '{meta_path}': {e}")
+                continue
+            self.batches[batch_id] = meta
+            if meta.get("status") in ACTIVE_STATUSES:
+                logger.info(f"BATCH [{batch_id}]: возобновление незавершённого задания.")
+                self._launch(batch_id)
+
+    async def stop(self):
+        """Останавливает задания вместе с выполняющимися элементами, чтобы они не выполнились повторно после перезапуска."""
+        tasks = list(self._tasks.values())
+        for item_tasks in self._item_tasks.values():
+            tasks.extend(item_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._item_tasks.clear()
+
+    def _launch(self, batch_id: str):
+        self._progress.setdefault(batch_id, asyncio.Event())
+        self._tasks[batch_id] = asyncio.create_task(self._run(batch_id))
+
+    async def create(self, chunks, concurrency: int | None = None, metadata: dict | None = None, owner: str | None = None) -> dict:
+        """Сохраняет входной JSONL (асинхронный итератор байтовых блоков) на диск и запускает задание."""
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self._dir(batch_id))
+        input_path = self.input_path(batch_id)
+
+        total = 0
+        tail = b""
+        with open(input_path, 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                data = tail + chunk
+                total += data.count(b"\n")
+                tail = data.rsplit(b"\n", 1)[-1]
+        if tail.strip():
+            total += 1
+
+        meta = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": "validating",
+            "created_at": int(time.time()),
+            "completed_at": None,
+            "concurrency": concurrency,
+            "metadata": metadata or {},
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "owner": owner,
+        }
+        self.batches[batch_id] = meta
+        await self._save_meta(meta)
+        self._launch(batch_id)
+        logger.info(f"BATCH [{batch_id}]: создано задание из {total} строк.")
+        return meta
+
+    def get(self, batch_id: str, owner: str | None = None) -> dict | None:
+        """Задание ключа owner; задания других ключей не видны (None)."""
+        meta = self.batches.get(batch_id)
+        return meta if meta is not None and meta.get("owner") == owner else None
+
+    def list(self, owner: str | None = None) -> list[dict]:
+        owned = (meta for meta in self.batches.values() if meta.get("owner") == owner)
+        return sorted(owned, key=lambda m: m.get("created_at", 0), reverse=True)
+
+    async def cancel(self, batch_id: str, owner: str | None = None) -> dict | None:
+        meta = self.get(batch_id, owner)
+        if not meta:
+            return None
+        if meta["status"] in ACTIVE_STATUSES:
+            meta["status"] = "cancelling"
+            await self._save_meta(meta)
+        return meta
+
+    # --- Выполнение ---
+    def _completed_ids(self, batch_id: str) -> set[str]:
+        done = set()
+        path = self.results_path(batch_id)
+        if not os.path.exists(path):
+            return done
+        # Строка, записанная не полностью при аварийном завершении, отбрасывается, чтобы не склеиться со следующей
+        with open(path, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["custom_id"])
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    continue
+        return done
+
+    async def _append_result(self, batch_id: str, result: dict):
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        async with self._io_locks.setdefault(batch_id, asyncio.Lock()):
+            await asyncio.to_thread(_append_line, self.results_path(batch_id), line)
+
+    async def _run(self, batch_id: str):
+        meta = self.batches[batch_id]
+        try:
+            done = await asyncio.to_thread(self._completed_ids, batch_id)
+            # Отмена, начатая до перезапуска, доводится до конца: новые элементы не запускаются
+            if meta["status"] != "cancelling":
+                meta["status"] = "in_progress"
+            await self._save_meta(meta)
+
+            settings = self.settings()
+            concurrency = max(1, int(meta.get("concurrency") or settings.get("batch_concurrency", 2)))
+            threshold = int(settings.get("batch_yield_interactive_threshold", 1))
+            semaphore = asyncio.Semaphore(concurrency)
+            running = self._item_tasks.setdefault(batch_id, set())
+
+            with open(self.input_path(batch_id), 'r', encoding='utf-8') as f:
+                for index, line in enumerate(f):
+                    if not line.strip():
+                        continue
+                    if meta["status"] == "cancelling":
+                        break
+                    await semaphore.acquire()
+                    # Пакетный трафик уступает интерактивным запросам
+                    await self.gate.wait_for_batch_turn(threshold)
+                    task = asyncio.create_task(self._run_item(batch_id, index, line, done, semaphore))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+            meta["status"] = "cancelled" if meta["status"] == "cancelling" else "completed"
+            meta["completed_at"] = int(time.time())
+            await self._save_meta(meta)
+            logger.info(f"BATCH [{batch_id}]: задание завершено со статусом '{meta['status']}' ({meta['request_counts']}).")
+        except asyncio.CancelledError:
+            # Остановка сервера: статус остаётся in_progress, задание будет продолжено после перезапуска
+            raise
+        except Exception as e:
+            logger.error(f"BATCH [{batch_id}]: задание прервано ошибкой: {e}", exc_info=True)
+            meta["status"] = "failed"
+            meta["errors"] = {"message": str(e)}
+            await self._save_meta(meta)
+        finally:
+            self._tasks.pop(batch_id, None)
+            if not self._item_tasks.get(batch_id):
+                self._item_tasks.pop(batch_id, None)
+            self._signal(batch_id)
+
+    async def _run_item(self, batch_id: str, index: int, line: str, done: set[str], semaphore: asyncio.Semaphore):
+        meta = self.batches[batch_id]
+        counts = meta["request_counts"]
+        try:
+            try:
+                custom_id, body = _parse_input_line(line, index)
+            except (ValueError, json.JSONDecodeError) as e:
+                custom_id, body = f"line-{index}", None
+                error = {"code": "invalid_request", "message": f"Недействительная строка {index + 1}: {e}"}
+            if custom_id in done:
+                return
+
+            if body is not None:
+                try:
+                    status_code, response_body = await self.execute(body, meta.get("owner"))
+                except Exception as e:
+                    logger.error(f"BATCH [{batch_id}]: ошибка выполнения элемента '{custom_id}': {e}", exc_info=True)
+                    status_code, response_body = 500, {"error": {"message": str(e), "type": "internal_server_error"}}
+                error = None if status_code < 400 else {"code": "request_failed", "message": str(response_body)}
+            else:
+                status_code, response_body = 400, None
+
+            await self._append_result(batch_id, {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": custom_id,
+                "response": {"status_code": status_code, "body": response_body} if body is not None else None,
+                "error": error,
+            })
+            done.add(custom_id)
+            if error:
+                counts["failed"] += 1
+            else:
+                counts["completed"] += 1
+            await self._save_meta(meta)
+            self._signal(batch_id)
+        finally:
+            semaphore.release()
+
+    def _signal(self, batch_id: str):
+        event = self._progress.get(batch_id)
+        if event:
+            event.set()
+
+    async def stream_results(self, batch_id: str, follow: bool = False):
+        """
+        Отдаёт results.jsonl построчно. При follow=True продолжает отдавать новые строки,
+        пока задание не будет завершено.
+        """
+        path = self.results_path(batch_id)
+        position = 0
+        while True:
+            event = self._progress.setdefault(batch_id, asyncio.Event())
+            event.clear()
+            # Статус проверяется до чтения: результаты записываются раньше, чем задание помечается завершённым
+            finished = (self.batches.get(batch_id) or {}).get("status") in FINAL_STATUSES
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    data = f.read()
+                # Отдаём только целые строки, остаток дочитаем на следующей итерации
+                complete = data.rpartition(b"\n")
+                if complete[1]:
+                    yield complete[0] + b"\n"
+                    position += len(complete[0]) + 1
+            if not follow or finished:
+                break
+            try:
+                await asyncio.wait_for(event.wait(), timeout=5.0)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,863 @@
+# modules/broker.py
+# Брокер между "фронтом" (обработка OpenAI-запросов) и процессом, который держит WebSocket-соединения браузеров.
+#
+# - InMemoryBroker: всё в одном процессе (поведение по умолчанию).
+# - BrokerHubServer: запускается рядом с InMemoryBroker и принимает подключения фронтов по локальному сокету.
+# - SocketBroker: реализация для фронт-процессов (например, uvicorn --workers N), пересылающая запросы в хаб.
+#
+# Протокол между фронтом и хабом — JSON, по одному объекту на строку. Первая строка фронта — {"op": "hello", "token"}:
+# хаб сравнивает токен с broker_token и без совпадения закрывает соединение, не отправив ни одного кадра.
+#   фронт -> хаб: {"op": "dispatch", "request_id", "message"}, {"op": "abort", "request_id"}, {"op": "close", "request_id"},
+#                 {"op": "command", "command", "target", "options"}, {"op": "verification", "request_id"}
+#   хаб -> фронт: {"op": "frame", "request_id", "data"}, {"op": "status", "workers", "refreshing", "credentials"}
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+import uuid
+
+from modules import fast_json
+from modules.prefix_cache import PrefixCacheTracker
+from modules.request_registry import RequestRegistry, STATE_DISPATCHED, STATE_DONE, STATE_STREAMING, STATE_SUSPENDED
+
+logger = logging.getLogger(__name__)
+
+# Файл с токеном хаба, если broker_token не задан: хаб создаёт его (права 0600), фронты на той же машине читают
+BROKER_TOKEN_FILE = ".broker_token"
+HANDSHAKE_TIMEOUT = 5.0
+# Предел длины одной строки протокола хаба. Стандартные 64 КиБ StreamReader меньше обычной нагрузки:
+# длинная история диалога или изображения base64 (без файлового хранилища) занимают мегабайты в одной строке.
+STREAM_LINE_LIMIT = 256 * 1024 * 1024
+
+
+class BrowserUnavailable(Exception):
+    """Нет ни одного подключённого браузера, способного принять запрос."""
+
+
+class BrowserWorker:
+    """Одна вкладка браузера со скриптом Tampermonkey, подключённая к /ws."""
+    __slots__ = ("worker_id", "websocket", "connected_at", "in_flight", "prefix_cache",
+                 "heartbeat", "structured_stream", "resumable", "ping_seq", "ping_sent_at", "rtt", "missed_beats", "healthy", "last_seen")
+
+    def __init__(self, worker_id: str, websocket):
+        self.worker_id = worker_id
+        self.websocket = websocket
+        self.connected_at = time.time()
+        self.in_flight: set[str] = set()
+        # Зеркало кеша префиксов вкладки (None, пока скрипт не сообщил о поддержке)
+        self.prefix_cache: PrefixCacheTracker | None = None
+        # Пульс (ping/pong): включается, если скрипт сообщил о поддержке в приветствии
+        self.heartbeat = False
+        # Скрипт умеет сам разбирать поток LMArena и присылать типизированные события
+        self.structured_stream = False
+        # Скрипт нумерует кадры и после переподключения возобновляет свои запросы (сообщение "resume")
+        self.resumable = False
+        self.ping_seq = 0
+        self.ping_sent_at: float | None = None  # время отправки ещё не отвеченного ping
+        self.rtt: float | None = None
+        self.missed_beats = 0
+        self.healthy = True
+        self.last_seen = time.monotonic()
+
+    def health(self) -> dict:
+        now = time.monotonic()
+        return {
+            "worker_id": self.worker_id,
+            "healthy": self.healthy,
+            "heartbeat": self.heartbeat,
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            "missed_beats": self.missed_beats,
+            "in_flight": len(self.in_flight),
+            "connected_seconds": round(time.time() - self.connected_at, 1),
+            "last_seen_seconds": round(now - self.last_seen, 1),
+        }
+
+    async def send_json(self, message: dict) -> int:
+        text = fast_json.dumps(message)
+        await self.websocket.send_text(text)
+        return len(text)
+
+
+class BrowserBroker:
+    """Интерфейс брокера. Каналы ответа — объекты с корутиной put() (обычно asyncio.Queue)."""
+
+    mode = "base"
+
+    def __init__(self, record_ttl: float = 900.0):
+        # Реестр выполняющихся запросов (каналы ответа и статистика по ним)
+        self.registry = RequestRegistry()
+        self.record_ttl = record_ttl
+        self._reaper_task: asyncio.Task | None = None
+        # Cookies и заголовки страницы LMArena, экспортированные скриптом, для прямого транспорта (None — не получены)
+        self.upstream_credentials: dict | None = None
+
+    async def start(self):
+        self._reaper_task = asyncio.create_task(self._reap_loop())
+
+    async def stop(self):
+        if self._reaper_task:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(max(1.0, min(60.0, self.record_ttl / 4)))
+            try:
+                await self.reap_expired()
+            except Exception as e:
+                logger.error(f"Ошибка при очистке реестра запросов: {e}", exc_info=True)
+
+    async def reap_expired(self) -> int:
+        """
+        Закрывает запросы, по которым дольше record_ttl секунд нет активности: браузер не ответил,
+        или обработчик так и не начал читать канал. Ожидающий обработчик получает ошибку.
+        """
+        expired = self.registry.expired(self.record_ttl)
+        for record in expired:
+            logger.warning(f"Запрос {record.request_id[:8]} без активности более {self.record_ttl:.0f} с (состояние: {record.state}), запись удалена.")
+            try:
+                await record.channel.put({"error": "Запрос закрыт: истекло время ожидания активности."})
+            except Exception:
+                pass
+            self.close_channel(record.request_id)
+        return len(expired)
+
+    def has_workers(self) -> bool:
+        raise NotImplementedError
+
+    @property
+    def is_refreshing_for_verification(self) -> bool:
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        """{"workers": число вкладок, готовых принимать запросы, "refreshing": идёт ли проверка Cloudflare}."""
+        raise NotImplementedError
+
+    def worker_health(self) -> list[dict]:
+        """Состояние каждой подключённой вкладки (пульс, RTT, нагрузка). Во фронт-процессе вкладки не видны."""
+        return []
+
+    async def release_idle_workers(self) -> int:
+        """
+        Перезапуск сервера: отключает вкладки без выполняющихся запросов, чтобы они переподключились
+        к новому процессу. Возвращает число отключённых вкладок. Во фронт-процессе вкладок нет.
+        """
+        return 0
+
+    def open_channel(self, request_id: str, endpoint: str | None = None) -> asyncio.Queue:
+        raise NotImplementedError
+
+    def get_channel(self, request_id: str):
+        raise NotImplementedError
+
+    def close_channel(self, request_id: str):
+        raise NotImplementedError
+
+    async def dispatch(self, request_id: str, message: dict):
+        """Отправляет нагрузку запроса в браузер. При отсутствии браузера выбрасывает BrowserUnavailable."""
+        raise NotImplementedError
+
+    def abort(self, request_id: str):
+        """
+        Просит вкладку прервать выполнение запроса (истёк срок ответа или клиент отключился),
+        чтобы она не тратила время на ненужный ответ. Не ждёт отправки команды.
+        """
+        raise NotImplementedError
+
+    async def send_command(self, command: str, target: str = "any", options: dict | None = None) -> bool:
+        """
+        Отправляет служебную команду. target: 'any' — одной вкладке, 'all' — всем, либо worker_id.
+        options — дополнительные поля команды (например, {"persistent": true}).
+        """
+        raise NotImplementedError
+
+    async def request_verification_refresh(self, request_id: str) -> bool:
+        """
+        Обрабатывает обнаруженную проверку Cloudflare. Возвращает True, если обновление страницы
+        инициировано этим вызовом, и False, если обновление уже выполняется.
+        """
+        raise NotImplementedError
+
+
+class InMemoryBroker(BrowserBroker):
+    """Брокер, владеющий WebSocket-соединениями браузеров в текущем процессе."""
+
+    mode = "memory"
+
+    def __init__(self, record_ttl: float = 900.0, heartbeat_interval: float = 5.0,
+                 unhealthy_after_missed: int = 2, disconnect_after_missed: int = 6, resume_grace: float = 20.0):
+        super().__init__(record_ttl)
+        self.workers: dict[str, BrowserWorker] = {}
+        self.heartbeat_interval = heartbeat_interval
+        self.unhealthy_after_missed = unhealthy_after_missed
+        self.disconnect_after_missed = disconnect_after_missed
+        self._heartbeat_task: asyncio.Task | None = None
+        # Сколько секунд запросы отключившейся вкладки ждут её переподключения (0 — завершаются сразу)
+        self.resume_grace = resume_grace
+        self._suspended: dict[str, asyncio.Task] = {}  # request_id -> задача, завершающая запрос по истечении срока
+        # Полные нагрузки запросов, отправленных в дельта-виде, — на случай промаха кеша в браузере
+        # (нагрузка, ключ кеша, отправлен ли запрос в режиме structured)
+        self.pending_full_payloads: dict[str, tuple[dict, str | None, bool]] = {}
+        self._refreshing = False
+        self._status_listeners: list = []
+
+    async def start(self):
+        await super().start()
+        if self.heartbeat_interval > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        await super().stop()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+
+    # --- Состояние ---
+    def has_workers(self) -> bool:
+        # Вкладки, пропустившие несколько пульсов, не принимают новые запросы
+        return any(worker.healthy for worker in self.workers.values())
+
+    @property
+    def is_refreshing_for_verification(self) -> bool:
+        return self._refreshing
+
+    def add_status_listener(self, callback):
+        """callback() вызывается при подключении/отключении вкладок и смене флага проверки."""
+        self._status_listeners.append(callback)
+
+    def remove_status_listener(self, callback):
+        if callback in self._status_listeners:
+            self._status_listeners.remove(callback)
+
+    def _notify_status(self):
+        for callback in list(self._status_listeners):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике статуса брокера: {e}", exc_info=True)
+
+    def status(self) -> dict:
+        return {"workers": sum(1 for worker in self.workers.values() if worker.healthy), "refreshing": self._refreshing}
+
+    def worker_health(self) -> list[dict]:
+        return [worker.health() for worker in self.workers.values()]
+
+    # --- Пульс ---
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            for worker in list(self.workers.values()):
+                try:
+                    await self._beat(worker)
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить ping вкладке {worker.worker_id}: {e}")
+
+    async def _beat(self, worker: BrowserWorker):
+        if not worker.heartbeat:
+            return
+        if worker.ping_sent_at is not None:
+            # Предыдущий ping остался без ответа
+            worker.missed_beats += 1
+            if worker.healthy and worker.missed_beats >= self.unhealthy_after_missed:
+                worker.healthy = False
+                logger.warning(f"Вкладка {worker.worker_id} не отвечает на ping ({worker.missed_beats} пропущено), новые запросы ей не передаются.")
+                self._notify_status()
+            if self.disconnect_after_missed and worker.missed_beats >= self.disconnect_after_missed:
+                logger.warning(f"Вкладка {worker.worker_id} считается зависшей, соединение закрывается.")
+                await self.detach_worker(worker, reason="Вкладка браузера перестала отвечать во время операции", suspend=False)
+                asyncio.ensure_future(self._close_websocket(worker))
+                return
+        worker.ping_seq += 1
+        # Время отправки не перезаписывается, пока нет ответа: RTT считается от первого неотвеченного ping
+        if worker.ping_sent_at is None:
+            worker.ping_sent_at = time.monotonic()
+        ping = {"type": "ping", "seq": worker.ping_seq}
+        if worker.resumable:
+            # Подтверждения полученных кадров: вкладка удаляет их из буфера повторной отправки
+            acks = {}
+            for request_id in worker.in_flight:
+                record = self.registry.get(request_id)
+                if record is not None and record.last_seq:
+                    acks[request_id] = record.last_seq
+            if acks:
+                ping["acks"] = acks
+        await worker.send_json(ping)
+
+    @staticmethod
+    async def _close_websocket(worker: BrowserWorker, code: int = 1011):
+        try:
+            await worker.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def _handle_pong(self, worker: BrowserWorker):
+        if worker.ping_sent_at is not None:
+            worker.rtt = time.monotonic() - worker.ping_sent_at
+            worker.ping_sent_at = None
+        worker.missed_beats = 0
+        if not worker.healthy:
+            worker.healthy = True
+            logger.info(f"Вкладка {worker.worker_id} снова отвечает (RTT {worker.rtt * 1000:.0f} мс), приём запросов возобновлён.")
+            self._notify_status()
+
+    # --- Каналы ---
+    def open_channel(self, request_id: str, sink=None, endpoint: str | None = None):
+        channel = sink if sink is not None else asyncio.Queue()
+        self.registry.open(request_id, channel, endpoint)
+        return channel
+
+    def get_channel(self, request_id: str):
+        record = self.registry.get(request_id)
+        return record.channel if record else None
+
+    def close_channel(self, request_id: str):
+        record = self.registry.close(request_id)
+        self.pending_full_payloads.pop(request_id, None)
+        expiry = self._suspended.pop(request_id, None)
+        if expiry is not None:
+            expiry.cancel()
+        worker = self.workers.get(record.worker_id) if record and record.worker_id else None
+        if worker:
+            worker.in_flight.discard(request_id)
+
+    # --- Вкладки браузера ---
+    def attach_worker(self, websocket) -> BrowserWorker:
+        worker = BrowserWorker(uuid.uuid4().hex[:8], websocket)
+        self.workers[worker.worker_id] = worker
+        # Новое соединение означает завершение процесса проверки на человекоподобность (или его отсутствие)
+        if self._refreshing:
+            logger.info("✅ Установлено новое WebSocket-соединение, состояние проверки на человекоподобность автоматически сброшено.")
+            self._refreshing = False
+        self._notify_status()
+        return worker
+
+    async def detach_worker(self, worker: BrowserWorker, reason: str = "Браузер отключился во время операции", suspend: bool = True):
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+        # Завершаем ошибкой только запросы этой вкладки, чтобы избежать их зависания.
+        # Если скрипт умеет возобновлять потоки, запросы ждут его переподключения resume_grace секунд.
+        # Зависшая вкладка (suspend=False) уже не вернёт ответ, поэтому её запросы завершаются сразу.
+        suspend = suspend and worker.resumable and self.resume_grace > 0
+        suspended = 0
+        for request_id in list(worker.in_flight):
+            record = self.registry.get(request_id)
+            if suspend and record is not None and record.state != STATE_DONE:
+                record.state = STATE_SUSPENDED
+                self._suspended[request_id] = asyncio.ensure_future(self._expire_suspended(request_id, reason))
+                suspended += 1
+                continue
+            if record is not None:
+                await record.channel.put({"error": reason})
+            self.close_channel(request_id)
+        worker.in_flight.clear()
+        if suspended:
+            logger.info(f"Запросов вкладки {worker.worker_id}, ожидающих переподключения: {suspended} (до {self.resume_grace:.0f} с).")
+        self._notify_status()
+
+    async def _expire_suspended(self, request_id: str, reason: str):
+        await asyncio.sleep(self.resume_grace)
+        if self._suspended.get(request_id) is not asyncio.current_task():
+            return
+        del self._suspended[request_id]
+        logger.warning(f"Запрос {request_id[:8]}: вкладка не переподключилась за {self.resume_grace:.0f} с, запрос завершается ошибкой.")
+        record = self.registry.get(request_id)
+        if record is not None:
+            await record.channel.put({"error": reason})
+        self.close_channel(request_id)
+
+    async def _resume_requests(self, worker: BrowserWorker, requests: list):
+        """
+        Переподключившаяся вкладка сообщает свои выполняющиеся запросы: request_id и номер первого кадра,
+        оставшегося в её буфере. Запрос возобновляется, если канал ещё открыт и кадры после последнего
+        полученного сервером не потеряны. Вкладке отвечают номером последнего полученного кадра
+        (или null — запрос закрыт, fetch можно прервать), и она досылает недостающие кадры.
+        """
+        results = {}
+        for item in requests:
+            request_id = item.get("request_id")
+            if not request_id:
+                continue
+            record = self.registry.get(request_id)
+            if record is None:
+                results[request_id] = None
+                continue
+            if int(item.get("first_seq") or 1) > record.last_seq + 1:
+                # Буфер вкладки переполнился, пока не было соединения: часть ответа потеряна
+                logger.warning(f"Запрос {request_id[:8]}: часть кадров потеряна при переподключении, возобновление невозможно.")
+                await record.channel.put({"error": "Соединение с браузером было прервано, часть ответа потеряна."})
+                self.close_channel(request_id)
+                results[request_id] = None
+                continue
+            expiry = self._suspended.pop(request_id, None)
+            if expiry is not None:
+                expiry.cancel()
+            # Сервер мог ещё не заметить разрыв прежнего соединения
+            previous = self.workers.get(record.worker_id) if record.worker_id else None
+            if previous is not None and previous is not worker:
+                previous.in_flight.discard(request_id)
+            worker.in_flight.add(request_id)
+            record.worker_id = worker.worker_id
+            if record.state == STATE_SUSPENDED:
+                record.state = STATE_STREAMING if record.last_seq else STATE_DISPATCHED
+            results[request_id] = record.last_seq
+        if results:
+            resumed = sum(1 for value in results.values() if value is not None)
+            logger.info(f"Вкладка {worker.worker_id} переподключилась: возобновлено запросов {resumed} из {len(results)}.")
+        await worker.send_json({"type": "resume_ack", "requests": results})
+
+    async def release_idle_workers(self) -> int:
+        idle = [worker for worker in self.workers.values() if not worker.in_flight]
+        for worker in idle:
+            await self.detach_worker(worker)
+            # 1012 (Service Restart): скрипт Tampermonkey переподключается сразу, без перезагрузки страницы
+            asyncio.ensure_future(self._close_websocket(worker, code=1012))
+        return len(idle)
+
+    def _pick_worker(self) -> BrowserWorker | None:
+        healthy = [worker for worker in self.workers.values() if worker.healthy]
+        if not healthy:
+            return None
+        return min(healthy, key=lambda w: len(w.in_flight))
+
+    async def handle_browser_message(self, worker: BrowserWorker, message: dict, size: int | None = None):
+        """
+        Обрабатывает одно сообщение от вкладки: приветствие, промах кеша или блок данных ответа.
+        size — размер исходного кадра для статистики реестра (если не передан, оценивается по данным).
+        """
+        worker.last_seen = time.monotonic()
+        message_type = message.get("type")
+        if message_type == "pong":
+            self._handle_pong(worker)
+            return
+        # Служебное приветствие: скрипт сообщает о поддерживаемых возможностях
+        if message_type == "hello":
+            features = message.get("features") or []
+            if "prefix_cache" in features:
+                worker.prefix_cache = PrefixCacheTracker(message.get("prefix_cache_capacity", 32))
+                logger.info(f"Вкладка {worker.worker_id} поддерживает кеш префиксов истории (ёмкость: {worker.prefix_cache.capacity}).")
+            # Старые версии скрипта не отвечают на ping, поэтому пульс включается только по объявлению
+            worker.heartbeat = "heartbeat" in features
+            worker.structured_stream = "structured_stream" in features
+            worker.resumable = "resume" in features
+            return
+        if message_type == "resume":
+            await self._resume_requests(worker, message.get("requests") or [])
+            return
+        if message_type == "upstream_credentials":
+            self.upstream_credentials = {
+                "cookie": message.get("cookie") or "",
+                "user_agent": message.get("user_agent"),
+                "accept_language": message.get("accept_language"),
+                "received_at": time.time(),
+            }
+            logger.info(f"Вкладка {worker.worker_id} передала cookies страницы для прямого транспорта.")
+            self._notify_status()
+            return
+
+        request_id = message.get("request_id")
+        data = message.get("data")
+
+        if not request_id or data is None:
+            logger.warning(f"Получено недействительное сообщение от браузера: {message}")
+            return
+
+        seq = message.get("seq")
+        if seq is not None:
+            record = self.registry.get(request_id)
+            if record is not None:
+                if seq <= record.last_seq:
+                    return  # Повтор кадра, полученного до разрыва соединения
+                record.last_seq = seq
+
+        # Промах кеша префиксов в браузере: повторяем отправку полной нагрузки
+        if isinstance(data, dict) and data.get("prefix_cache_miss"):
+            full_payload, cache_key, structured = self.pending_full_payloads.pop(request_id, (None, None, False))
+            if worker.prefix_cache:
+                worker.prefix_cache.invalidate(data.get("key"))
+            record = self.registry.get(request_id)
+            if full_payload is not None and record is not None:
+                logger.warning(f"API CALL [ID: {request_id[:8]}]: Промах кеша префиксов в браузере, отправка полной нагрузки.")
+                resend_payload = {**full_payload, "cache_key": cache_key} if cache_key else full_payload
+                resend = {"request_id": request_id, "payload": resend_payload}
+                if structured:
+                    resend["structured"] = True
+                record.mark_sent(worker.worker_id, await worker.send_json(resend))
+            return
+        self.pending_full_payloads.pop(request_id, None)
+
+        # Помещаем полученные данные в соответствующий канал ответа
+        record = self.registry.get(request_id)
+        if record is not None:
+            final = data == "[DONE]" or (isinstance(data, dict) and "error" in data)
+            record.mark_received(size if size is not None else (len(data) if isinstance(data, str) else 0), final)
+            await record.channel.put(data)
+            if final and seq is not None:
+                # Последний кадр подтверждается сразу: вкладка освобождает буфер запроса
+                try:
+                    await worker.send_json({"type": "ack", "acks": {request_id: seq}})
+                except Exception as e:
+                    logger.debug(f"Не удалось подтвердить вкладке {worker.worker_id} последний кадр запроса {request_id[:8]}: {e}")
+        elif self.registry.was_recently_closed(request_id):
+            # Запоздавший блок уже завершённого запроса (например, клиент отключился раньше браузера)
+            logger.debug(f"Получен блок для уже закрытого запроса: {request_id}")
+        else:
+            logger.warning(f"⚠️ Получен ответ для неизвестного запроса: {request_id}")
+
+    # --- Отправка ---
+    async def dispatch(self, request_id: str, message: dict, prefix_cache_enabled: bool = True, structured_stream: bool = True):
+        worker = self._pick_worker()
+        if worker is None:
+            raise BrowserUnavailable("Клиент скрипта Tampermonkey не подключён.")
+
+        # Вкладка разбирает поток LMArena сама и присылает события вместо сырого текста
+        structured = structured_stream and worker.structured_stream
+        if structured:
+            message = {**message, "structured": True}
+        payload = message.get("payload")
+        if prefix_cache_enabled and worker.prefix_cache is not None and isinstance(payload, dict) and "message_templates" in payload:
+            # При поддержке кеша префиксов отправляем только ссылку на уже известную вкладке часть истории и новые сообщения
+            encoded = worker.prefix_cache.encode(payload["message_templates"])
+            if "prefix_ref" in encoded:
+                self.pending_full_payloads[request_id] = (payload, encoded.get("cache_key"), structured)
+            message = {**message, "payload": {**payload, **encoded}}
+
+        worker.in_flight.add(request_id)
+        size = await worker.send_json(message)
+        record = self.registry.get(request_id)
+        if record is not None:
+            record.mark_sent(worker.worker_id, size)
+
+    def abort(self, request_id: str):
+        record = self.registry.get(request_id)
+        worker = self.workers.get(record.worker_id) if record and record.worker_id else None
+        if worker is not None:
+            asyncio.ensure_future(self._send_abort(worker, request_id))
+
+    @staticmethod
+    async def _send_abort(worker: BrowserWorker, request_id: str):
+        try:
+            await worker.send_json({"command": "abort_request", "request_id": request_id})
+        except Exception as e:
+            logger.debug(f"Не удалось отправить вкладке {worker.worker_id} команду прерывания запроса {request_id[:8]}: {e}")
+
+    async def send_command(self, command: str, target: str = "any", options: dict | None = None) -> bool:
+        if target == "all":
+            targets = list(self.workers.values())
+        elif target in self.workers:
+            targets = [self.workers[target]]
+        else:
+            worker = self._pick_worker()
+            targets = [worker] if worker else []
+        if not targets:
+            return False
+        for worker in targets:
+            await worker.send_json({**(options or {}), "command": command})
+        return True
+
+    async def request_verification_refresh(self, request_id: str) -> bool:
+        if self._refreshing:
+            return False
+        self._refreshing = True
+        self._notify_status()
+        record = self.registry.get(request_id)
+        worker_id = record.worker_id if record else None
+        try:
+            await self.send_command("refresh", target=worker_id or "any")
+        except Exception as e:
+            logger.error(f"Не удалось отправить команду 'refresh': {e}")
+        return True
+
+
+def parse_broker_address(address: str) -> tuple[str, str | int]:
+    """'127.0.0.1:5105' -> ('127.0.0.1', 5105); 'unix:/path/to.sock' -> ('unix', '/path/to.sock')."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def read_broker_token(path: str = BROKER_TOKEN_FILE) -> str | None:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def load_or_create_broker_token(path: str = BROKER_TOKEN_FILE) -> str:
+    """Токен хаба из файла; при его отсутствии создаётся случайный токен, доступный только владельцу процесса."""
+    token = read_broker_token(path)
+    if token:
+        return token
+    token = secrets.token_hex(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(token)
+    return token
+
+
+async def _write_line(writer: asyncio.StreamWriter, obj: dict) -> int:
+    line = fast_json.dumps_bytes(obj) + b"\n"
+    writer.write(line)
+    await writer.drain()
+    return len(line)
+
+
+class _FrontChannel:
+    """Канал ответа на стороне хаба: пересылает данные во фронт, которому принадлежит запрос."""
+    __slots__ = ("writer", "request_id")
+
+    def __init__(self, writer: asyncio.StreamWriter, request_id: str):
+        self.writer = writer
+        self.request_id = request_id
+
+    async def put(self, data):
+        if self.writer.is_closing():
+            return
+        try:
+            await _write_line(self.writer, {"op": "frame", "request_id": self.request_id, "data": data})
+        except (ConnectionError, RuntimeError) as e:
+            logger.warning(f"HUB: не удалось переслать данные запроса {self.request_id[:8]} во фронт: {e}")
+
+
+class BrokerHubServer:
+    """Принимает подключения фронт-процессов и маршрутизирует их запросы через локальный InMemoryBroker."""
+
+    def __init__(self, broker: InMemoryBroker, address: str, token: str, prefix_cache_enabled=lambda: True, structured_stream_enabled=lambda: True):
+        self.broker = broker
+        self.address = address
+        self.token = token
+        self.prefix_cache_enabled = prefix_cache_enabled
+        self.structured_stream_enabled = structured_stream_enabled
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        kind, target = parse_broker_address(self.address)
+        if kind == "unix":
+            self._server = await asyncio.start_unix_server(self._handle_front, path=target, limit=STREAM_LINE_LIMIT)
+            os.chmod(target, 0o600)  # Подключаться к сокету может только владелец процесса
+        else:
+            self._server = await asyncio.start_server(self._handle_front, host=kind, port=target, limit=STREAM_LINE_LIMIT)
+        logger.info(f"HUB: брокер принимает подключения фронтов на {self.address}.")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_front(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        owned: set[str] = set()
+        peer = writer.get_extra_info("peername") or "unix"
+        if not await self._authenticate(reader):
+            logger.warning(f"HUB: отклонено подключение {peer}: неверный или отсутствующий broker_token.")
+            writer.close()
+            return
+        logger.info(f"HUB: подключился фронт {peer}.")
+
+        def push_status():
+            if not writer.is_closing():
+                writer.write(fast_json.dumps_bytes({"op": "status", **self.broker.status(), "credentials": self.broker.upstream_credentials}) + b"\n")
+
+        self.broker.add_status_listener(push_status)
+        push_status()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = fast_json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"HUB: получена некорректная строка от фронта {peer}.")
+                    continue
+                op = message.get("op")
+                request_id = message.get("request_id")
+
+                if op == "dispatch" and request_id:
+                    channel = self.broker.open_channel(request_id, sink=_FrontChannel(writer, request_id))
+                    owned.add(request_id)
+                    try:
+                        await self.broker.dispatch(request_id, message.get("message") or {}, prefix_cache_enabled=self.prefix_cache_enabled(), structured_stream=self.structured_stream_enabled())
+                    except Exception as e:
+                        await channel.put({"error": f"Не удалось передать запрос в браузер: {e}"})
+                        self.broker.close_channel(request_id)
+                        owned.discard(request_id)
+                elif op == "abort" and request_id:
+                    self.broker.abort(request_id)
+                elif op == "close" and request_id:
+                    self.broker.close_channel(request_id)
+                    owned.discard(request_id)
+                elif op == "command":
+                    await self.broker.send_command(message.get("command"), target=message.get("target", "any"), options=message.get("options"))
+                elif op == "verification" and request_id:
+                    await self.broker.request_verification_refresh(request_id)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except (asyncio.LimitOverrunError, ValueError) as e:
+            # readline() сообщает о строке длиннее STREAM_LINE_LIMIT через ValueError; соединение дальше не разобрать
+            logger.warning(f"HUB: соединение с фронтом {peer} закрыто: {e}")
+        finally:
+            self.broker.remove_status_listener(push_status)
+            for request_id in owned:
+                self.broker.close_channel(request_id)
+            writer.close()
+            logger.warning(f"HUB: фронт {peer} отключился, закрыто {len(owned)} его запросов.")
+
+    async def _authenticate(self, reader: asyncio.StreamReader) -> bool:
+        """Первая строка подключения должна содержать токен хаба."""
+        try:
+            hello = fast_json.loads(await asyncio.wait_for(reader.readline(), timeout=HANDSHAKE_TIMEOUT))
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            return False
+        token = hello.get("token") if isinstance(hello, dict) and hello.get("op") == "hello" else None
+        return isinstance(token, str) and hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+
+class SocketBroker(BrowserBroker):
+    """Брокер фронт-процесса: пересылает запросы в хаб по локальному сокету и получает ответы оттуда."""
+
+    mode = "front"
+
+    def __init__(self, address: str, token: str | None = None, token_file: str = BROKER_TOKEN_FILE, reconnect_delay: float = 2.0, record_ttl: float = 900.0):
+        super().__init__(record_ttl)
+        self.address = address
+        # Токен хаба: явно заданный broker_token или файл, который создаёт хаб (читается при каждом подключении)
+        self.token = token
+        self.token_file = token_file
+        self.reconnect_delay = reconnect_delay
+        self._writer: asyncio.StreamWriter | None = None
+        self._workers = 0
+        self._refreshing = False
+        self._task: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+
+    async def start(self):
+        await super().start()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        await super().stop()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._writer:
+            self._writer.close()
+
+    def has_workers(self) -> bool:
+        return self._writer is not None and self._workers > 0
+
+    def status(self) -> dict:
+        return {"workers": self._workers if self._writer is not None else 0, "refreshing": self._refreshing}
+
+    @property
+    def is_refreshing_for_verification(self) -> bool:
+        return self._refreshing
+
+    def open_channel(self, request_id: str, endpoint: str | None = None):
+        channel = asyncio.Queue()
+        self.registry.open(request_id, channel, endpoint)
+        return channel
+
+    def get_channel(self, request_id: str):
+        record = self.registry.get(request_id)
+        return record.channel if record else None
+
+    def close_channel(self, request_id: str):
+        if self.registry.close(request_id) is not None and self._writer is not None:
+            # Закрытие не критично: при обрыве связи хаб сам освободит все запросы фронта
+            asyncio.ensure_future(self._send({"op": "close", "request_id": request_id}))
+
+    async def _send(self, obj: dict) -> int:
+        if self._writer is None:
+            raise BrowserUnavailable("Нет соединения с хабом брокера.")
+        async with self._write_lock:
+            return await _write_line(self._writer, obj)
+
+    async def dispatch(self, request_id: str, message: dict, prefix_cache_enabled: bool = True, structured_stream: bool = True):
+        if not self.has_workers():
+            raise BrowserUnavailable("Хаб брокера недоступен или к нему не подключён ни один браузер.")
+        size = await self._send({"op": "dispatch", "request_id": request_id, "message": message})
+        record = self.registry.get(request_id)
+        if record is not None:
+            # Вкладку выбирает хаб, поэтому на стороне фронта она неизвестна
+            record.mark_sent(None, size)
+
+    def abort(self, request_id: str):
+        if request_id in self.registry and self._writer is not None:
+            asyncio.ensure_future(self._send({"op": "abort", "request_id": request_id}))
+
+    async def send_command(self, command: str, target: str = "any", options: dict | None = None) -> bool:
+        if not self.has_workers():
+            return False
+        await self._send({"op": "command", "command": command, "target": target, "options": options})
+        return True
+
+    async def request_verification_refresh(self, request_id: str) -> bool:
+        if self._refreshing:
+            return False
+        self._refreshing = True
+        try:
+            await self._send({"op": "verification", "request_id": request_id})
+        except Exception as e:
+            logger.error(f"Не удалось передать в хаб сигнал проверки на человекоподобность: {e}")
+        return True
+
+    async def _connect(self):
+        kind, target = parse_broker_address(self.address)
+        if kind == "unix":
+            return await asyncio.open_unix_connection(path=target, limit=STREAM_LINE_LIMIT)
+        return await asyncio.open_connection(host=kind, port=target, limit=STREAM_LINE_LIMIT)
+
+    async def _run(self):
+        while True:
+            token = self.token or read_broker_token(self.token_file)
+            if not token:
+                logger.warning(f"FRONT: токен хаба не задан (broker_token) и файл {self.token_file} ещё не создан хабом. Повтор через {self.reconnect_delay} с.")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            try:
+                reader, writer = await self._connect()
+                await _write_line(writer, {"op": "hello", "token": token})
+            except OSError as e:
+                logger.warning(f"FRONT: не удалось подключиться к хабу брокера {self.address}: {e}. Повтор через {self.reconnect_delay} с.")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            self._writer = writer
+            logger.info(f"FRONT: подключено к хабу брокера {self.address}.")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = fast_json.loads(line)
+                    op = message.get("op")
+                    if op == "frame":
+                        record = self.registry.get(message.get("request_id"))
+                        if record is not None:
+                            data = message.get("data")
+                            record.mark_received(len(line), data == "[DONE]" or (isinstance(data, dict) and "error" in data))
+                            await record.channel.put(data)
+                    elif op == "status":
+                        self._workers = message.get("workers", 0)
+                        self._refreshing = bool(message.get("refreshing"))
+                        self.upstream_credentials = message.get("credentials")
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+                # ValueError: некорректный JSON или строка длиннее STREAM_LINE_LIMIT — переподключаемся, как при обрыве
+                logger.warning(f"FRONT: соединение с хабом брокера прервано: {e}")
+            finally:
+                self._writer = None
+                self._workers = 0
+                writer.close()
+                # Запросы, ожидающие ответа через потерянное соединение, завершаем ошибкой.
+                # Запросы прямого транспорта (worker_id "direct") идут мимо хаба и продолжаются.
+                for record in self.registry.records():
+                    if record.worker_id == "direct":
+                        continue
+                    await record.channel.put({"error": "Соединение с хабом брокера потеряно во время операции"})
+                    self.registry.close(record.request_id)
+            await asyncio.sleep(self.reconnect_delay)
@@ -0,0 +1,87 @@
+# modules/context_budget.py
+# Проверка размера диалога до отправки в LMArena.
+#
+# Если история не помещается в контекст модели, LMArena обрывает ответ (мост сообщает об этом как
+# о content-filter), и весь запрос к браузеру оказывается напрасным. Здесь размер запроса оценивается
+# за один проход по сообщениям, и до отправки диалог либо отклоняется, либо из него удаляются
+# самые старые сообщения (системные и последнее сообщение всегда сохраняются).
+
+STRATEGY_OFF = "off"
+STRATEGY_REJECT = "reject"
+STRATEGY_TRIM_OLDEST = "trim_oldest"
+STRATEGIES = (STRATEGY_OFF, STRATEGY_REJECT, STRATEGY_TRIM_OLDEST)
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Роль и разделители сообщения
+IMAGE_TOKENS = 1000          # Изображение-вложение (оценка сверху для типичных скриншотов)
+
+
+class ContextTooLarge(Exception):
+    """Диалог не помещается в контекст модели даже после удаления истории."""
+
+    def __init__(self, estimated: int, limit: int):
+        self.estimated = estimated
+        self.limit = limit
+        super().__init__(f"Диалог (~{estimated} токенов) не помещается в контекст модели ({limit} токенов с учётом резерва на ответ).")
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Оценка без токенизатора: ~4 символа ASCII на токен, кириллица — ~2.4 символа, CJK — ~1.7 символа.
+    Каждый байт UTF-8 сверх первого добавляет 1/6 токена, поэтому оценка непрерывна для смешанного текста.
+    """
+    if text.isascii():
+        return len(text) // 4 + 1
+    extra_bytes = len(text.encode('utf-8')) - len(text)
+    return len(text) // 4 + extra_bytes // 6 + 1
+
+
+def estimate_message_tokens(message: dict) -> int:
+    content = message.get("content")
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    if isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                tokens += estimate_text_tokens(part.get("text") or "")
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+def fit_messages(messages: list, limit: int, strategy: str) -> tuple[list, int, int]:
+    """
+    Приводит диалог к бюджету limit (оценочные токены).
+    Возвращает (сообщения, число удалённых сообщений, оценка размера результата).
+    reject — ContextTooLarge, если диалог больше бюджета; trim_oldest — удаляет самые старые сообщения,
+    кроме системных и последнего, и ContextTooLarge, если и оставшегося слишком много.
+    """
+    costs = [estimate_message_tokens(message) for message in messages]
+    total = sum(costs)
+    if total <= limit:
+        return messages, 0, total
+    if strategy != STRATEGY_TRIM_OLDEST:
+        raise ContextTooLarge(total, limit)
+
+    last = len(messages) - 1
+    dropped = set()
+    for index, message in enumerate(messages):
+        if total <= limit:
+            break
+        if index == last or message.get("role") == "system":
+            continue
+        dropped.add(index)
+        total -= costs[index]
+    if total > limit:
+        raise ContextTooLarge(total, limit)
+    # История не должна начинаться с ответа ассистента, оставшегося без своего вопроса
+    for index, message in enumerate(messages):
+        if index in dropped or message.get("role") == "system":
+            continue
+        if message.get("role") == "assistant" and index != last and dropped:
+            dropped.add(index)
+            total -= costs[index]
+        break
+    return [message for index, message in enumerate(messages) if index not in dropped], len(dropped), total
@@ -0,0 +1,63 @@
+# modules/fast_json.py
+# Сериализация JSON на горячем пути (кадры WebSocket, разбор потока LMArena, SSE-блоки для клиента).
+# Если установлен orjson, используется он; иначе — стандартный json с тем же поведением:
+# компактный вывод без пробелов и без экранирования не-ASCII символов (как ensure_ascii=False).
+# Объекты с методом __json__() (например, дескрипторы спула запроса) сериализуются его результатом.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+JSONDecodeError = json.JSONDecodeError  # orjson.JSONDecodeError наследуется от него
+
+
+def _default(obj):
+    to_json = getattr(obj, "__json__", None)
+    if to_json is None:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return to_json()
+
+
+_std_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+_std_decode = json.JSONDecoder().decode
+
+
+def _std_loads(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('utf-8')
+    return _std_decode(data)
+
+
+def _std_dumps_bytes(obj) -> bytes:
+    return _std_encoder.encode(obj).encode('utf-8')
+
+
+if orjson is not None:
+    def loads(data):
+        """Разбирает JSON из bytes или str."""
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson строже стандартного модуля (например, к одиночным суррогатам в \\u-экранировании),
+            # поэтому при ошибке повторяем разбор через json, чтобы поведение не отличалось
+            return _std_loads(data)
+
+    def dumps_bytes(obj) -> bytes:
+        """Сериализует в UTF-8 bytes — для тел ответов и потоковых блоков."""
+        try:
+            return orjson.dumps(obj, default=_default)
+        except TypeError:
+            # Нестроковые ключи словаря, целые больше 64 бит и т.п. — то, что orjson не поддерживает
+            return _std_dumps_bytes(obj)
+
+    def dumps(obj) -> str:
+        """Сериализует в str — для WebSocket send_text."""
+        return dumps_bytes(obj).decode('utf-8')
+else:
+    loads = _std_loads
+    dumps_bytes = _std_dumps_bytes
+    dumps = _std_encoder.encode
@@ -1,4 +1,7 @@
 # modules/file_uploader.py
+import asyncio
+import base64
+import hashlib
 import httpx
 import logging
 
@@ -6,7 +9,28 @@ logger = logging.getLogger(__name__)
 
 from typing import Tuple
 
-async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: str | None = None) -> Tuple[str | None, str | None]:
+def _content_digest(file_data: str) -> str:
+    """SHA-256 декодированного содержимого data URI — под этим именем файловое хранилище сохраняет файл."""
+    return hashlib.sha256(base64.b64decode(file_data.split(',', 1)[1])).hexdigest()
+
+async def _find_existing(client: httpx.AsyncClient, file_data: str, upload_url: str, api_key: str | None) -> str | None:
+    """
+    Спрашивает хранилище (HEAD /blob/{sha256}), есть ли уже такой файл. Возвращает его имя или None
+    (файла нет, хранилище старой версии без /blob или проверка не удалась — тогда файл просто загружается).
+    """
+    try:
+        # Декодирование и хеширование нескольких мегабайт выполняются вне цикла событий
+        digest = await asyncio.to_thread(_content_digest, file_data)
+        blob_url = f"{upload_url.rsplit('/', 1)[0]}/blob/{digest}"
+        response = await client.head(blob_url, headers={"X-API-Key": api_key} if api_key else None)
+    except (ValueError, IndexError, httpx.RequestError) as e:
+        logger.debug(f"Проверка наличия файла в хранилище не выполнена: {e}")
+        return None
+    if response.status_code == 200:
+        return response.headers.get("x-file-name")
+    return None
+
+async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: str | None = None, check_existing: bool = True) -> Tuple[str | None, str | None]:
     """
     Загружает файл, закодированный в base64, на сервер файлового хранилища.
 
@@ -14,6 +38,7 @@ async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, ap
     :param file_data: Base64 data URI (например, "data:image/png;base64,...").
     :param upload_url: URL конечной точки /upload файлового хранилища.
     :param api_key: (Необязательно) API-ключ для аутентификации.
+    :param check_existing: Сначала проверить по хешу содержимого, нет ли файла в хранилище, и не загружать его повторно.
     :return: Кортеж (filename, error_message). При успехе filename — строка, error_message — None;
              при неудаче filename — None, error_message — строка с описанием ошибки.
     """
@@ -25,6 +50,12 @@ async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, ap
     
     try:
         async with httpx.AsyncClient(timeout=60.0) as client:
+            if check_existing:
+                existing_filename = await _find_existing(client, file_data, upload_url, api_key)
+                if existing_filename:
+                    logger.info(f"Файл '{file_name}' уже есть в файловом хранилище ({existing_filename}), загрузка не требуется.")
+                    return existing_filename, None
+
             response = await client.post(upload_url, json=payload)
             
             response.raise_for_status()  # Вызывает исключение при статусах 4xx или 5xx
@@ -0,0 +1,197 @@
+# modules/image_preprocessor.py
+# Уменьшение изображений-вложений перед отправкой: data URI из image_url декодируется, изображение
+# уменьшается до заданного разрешения и перекодируется в целевой формат так, чтобы уложиться в лимит байт
+# (LMArena отклоняет вложения больше ~5 МБ). Декодирование и сжатие выполняются в пуле процессов,
+# чтобы не занимать цикл событий; результаты кешируются по хешу содержимого.
+#
+# Pillow — необязательная зависимость: без неё вложения отправляются без изменений.
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from modules.request_spool import SpooledDataURI
+
+logger = logging.getLogger(__name__)
+
+# Целевой формат -> (формат Pillow, MIME-тип)
+TARGET_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+MIN_QUALITY = 40  # Ниже этого качество не снижается, вместо этого уменьшается разрешение
+
+
+def _split_data_uri(data_uri: str) -> tuple[str, bytes] | None:
+    """'data:image/png;base64,...' -> ('image/png', байты) или None, если это не base64-изображение."""
+    header, sep, encoded = data_uri.partition(",")
+    if not sep or not header.startswith("data:image/") or not header.endswith(";base64"):
+        return None
+    try:
+        return header[5:-7], base64.b64decode(encoded, validate=False)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def shrink_image(data_uri: str, max_dimension: int, target_format: str, quality: int, max_bytes: int) -> str | None:
+    """
+    Выполняется в процессе пула. Возвращает новый data URI или None, если изображение
+    уже укладывается в ограничения (или не может быть обработано) и отправляется как есть.
+    """
+    parsed = _split_data_uri(data_uri)
+    if parsed is None:
+        return None
+    content_type, raw = parsed
+    try:
+        image = Image.open(io.BytesIO(raw))
+        if getattr(image, "n_frames", 1) > 1:
+            return None  # Анимация при перекодировании потеряется — отправляем как есть
+        width, height = image.size
+        if max(width, height) <= max_dimension and len(raw) <= max_bytes:
+            return None
+        image.load()
+    except Exception:
+        return None
+
+    pil_format, mime = TARGET_FORMATS.get(target_format, TARGET_FORMATS["jpeg"])
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        # В JPEG нет прозрачности: накладываем изображение на белый фон
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    elif pil_format != "JPEG" and image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+
+    scale = min(1.0, max_dimension / max(width, height))
+    current_quality = quality
+    while True:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        resized = image if size == image.size else image.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        if pil_format == "PNG":
+            resized.save(buffer, format="PNG", optimize=True)
+        else:
+            resized.save(buffer, format=pil_format, quality=current_quality)
+        encoded = buffer.getvalue()
+        if len(encoded) <= max_bytes or max(size) <= 64:
+            break
+        # Сначала снижаем качество, затем разрешение
+        if pil_format != "PNG" and current_quality > MIN_QUALITY:
+            current_quality = max(MIN_QUALITY, current_quality - 15)
+        else:
+            scale *= 0.75
+    if len(encoded) >= len(raw) and max(width, height) <= max_dimension:
+        return None  # Перекодирование не помогло — исходные данные лучше
+    return f"data:{mime};base64,{base64.b64encode(encoded).decode('ascii')}"
+
+
+def shrink_image_file(path: str, *options) -> str | None:
+    """Как shrink_image, но data URI читается из файла спула запроса уже в процессе пула."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return shrink_image(f.read(), *options)
+
+
+class ImagePreprocessor:
+    """
+    Асинхронная обёртка над пулом процессов с LRU-кешем результатов.
+    Кеш ограничен суммарным размером data URI; ключ — хеш исходных данных и параметров сжатия.
+    """
+
+    def __init__(self, settings=lambda: {}, workers: int = 2, cache_bytes: int = 64 * 1024 * 1024, cache_entries: int = 1024):
+        self.settings = settings
+        self.workers = max(1, int(workers))
+        self.cache_bytes = cache_bytes
+        self.cache_entries = cache_entries
+        self._pool: ProcessPoolExecutor | None = None
+        self._cache: OrderedDict[bytes, str | None] = OrderedDict()
+        self._cached_size = 0
+        self._inflight: dict[bytes, asyncio.Future] = {}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def start(self):
+        if not self.available:
+            logger.warning("Предобработка изображений включена, но Pillow не установлен (pip install Pillow) — вложения отправляются без изменений.")
+            return
+        # spawn, а не fork: к моменту запуска в процессе уже работают потоки логирования и наблюдения за циклом,
+        # и копия их блокировок в дочернем процессе может остаться захваченной навсегда
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Предобработка изображений: пул из {self.workers} процессов запущен.")
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _options(self) -> tuple:
+        settings = self.settings()
+        return (
+            int(settings.get("image_max_dimension", 2048)),
+            str(settings.get("image_target_format", "jpeg")).lower(),
+            int(settings.get("image_quality", 85)),
+            int(settings.get("image_max_bytes", 4 * 1024 * 1024)),
+        )
+
+    def _remember(self, key: bytes, result: str | None):
+        size = len(result) if result else 0
+        if size > self.cache_bytes:
+            return
+        self._cache[key] = result
+        self._cached_size += size
+        # Запоминаются и отрицательные результаты ("не требует сжатия"), поэтому ограничено и число записей
+        while self._cached_size > self.cache_bytes or len(self._cache) > self.cache_entries:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_size -= len(evicted) if evicted else 0
+
+    async def process(self, data_uri: "str | SpooledDataURI") -> "str | SpooledDataURI":
+        """Возвращает уменьшенный data URI или исходный, если обработка не нужна или невозможна."""
+        if self._pool is None or not data_uri.startswith("data:image/"):
+            return data_uri
+        options = self._options()
+        spooled = isinstance(data_uri, SpooledDataURI)
+        content = data_uri.digest.encode() if spooled else data_uri.encode('ascii', 'ignore')
+        key = hashlib.blake2b(content + repr(options).encode(), digest_size=16).digest()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key] or data_uri
+
+        # Одинаковые изображения в параллельных запросах (например, n > 1) обрабатываются один раз
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if spooled:
+                # В процесс пула передаётся только путь к файлу, данные не копируются через цикл событий
+                future = loop.run_in_executor(self._pool, shrink_image_file, data_uri.path, *options)
+            else:
+                future = loop.run_in_executor(self._pool, shrink_image, data_uri, *options)
+            self._inflight[key] = future
+            try:
+                # shield: отмена одного запроса не должна отменять сжатие для остальных ожидающих
+                result = await asyncio.shield(future)
+            except Exception as e:
+                logger.warning(f"Предобработка изображений: ошибка при сжатии, вложение отправляется без изменений: {e}")
+                result = None
+            finally:
+                self._inflight.pop(key, None)
+            self._remember(key, result)
+            if result:
+                logger.info(f"Предобработка изображений: вложение уменьшено с {len(data_uri) // 1024} КБ до {len(result) // 1024} КБ (data URI).")
+        else:
+            try:
+                result = await asyncio.shield(future)
+            except Exception:
+                result = None
+        return result or data_uri
@@ -0,0 +1,82 @@
+# modules/log_setup.py
+# Асинхронное логирование: форматирование и вывод выполняются в фоновом потоке,
+# а "болтливые" сообщения отдельных запросов пишутся только для выборки запросов.
+import logging
+import logging.handlers
+import queue
+import zlib
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener: logging.handlers.QueueListener | None = None
+_request_sample_rate = 1.0
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке.
+    Стандартный prepare() вызывает format(), т.е. вся стоимость форматирования остаётся в цикле событий;
+    здесь в вызывающем потоке только сериализуется traceback (он не переживает передачу между потоками).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_async_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Заменяет обработчики корневого логгера на QueueHandler и запускает фоновый QueueListener.
+    Повторный вызов возвращает уже запущенный слушатель.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_async_logging():
+    """Останавливает фоновый слушатель, дописывая все записи из очереди."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def apply_log_settings(level_name: str | None, request_sample_rate: float | None):
+    """Применяет уровень логирования и долю запросов, для которых пишутся подробные логи."""
+    global _request_sample_rate
+    level = logging.getLevelName(str(level_name or "INFO").upper())
+    if isinstance(level, int):
+        logging.getLogger().setLevel(level)
+    try:
+        _request_sample_rate = min(1.0, max(0.0, float(request_sample_rate if request_sample_rate is not None else 1.0)))
+    except (TypeError, ValueError):
+        _request_sample_rate = 1.0
+
+
+def is_request_sampled(request_id: str) -> bool:
+    """
+    Детерминированно решает, попадает ли запрос в выборку подробного логирования.
+    Решение зависит только от request_id, поэтому все сообщения одного запроса либо пишутся, либо нет целиком.
+    """
+    if _request_sample_rate >= 1.0:
+        return True
+    if _request_sample_rate <= 0.0:
+        return False
+    return (zlib.crc32(request_id.encode('ascii', 'ignore')) % 10000) < _request_sample_rate * 10000
@@ -0,0 +1,166 @@
+# modules/loop_monitor.py
+# Наблюдение за задержкой цикла событий.
+#
+# Все потоки ответов обслуживаются одним циклом событий, поэтому любая синхронная работа в нём (чтение файла,
+# разбор большого HTML, запись JSON) останавливает выдачу блоков всем клиентам сразу. Здесь два инструмента:
+# - измерение задержки: задача раз в loop_lag_interval_ms засыпает и замеряет, насколько позже срока она
+#   проснулась; значения собираются в гистограмму (/internal/metrics, /internal/health);
+# - сторожевой поток: если цикл не выполняет поставленный им обратный вызов дольше slow_callback_threshold_ms,
+#   он снимает стек потока цикла и пишет в лог, какой код его занял.
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержки, в секундах (как у гистограмм Prometheus, последняя — +Inf)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+RECENT_STALLS = 20
+
+
+class LoopMonitor:
+    def __init__(self, settings=lambda: {}):
+        self.settings = settings
+        self.bucket_counts = [0] * (len(LAG_BUCKETS) + 1)
+        self.lag_count = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.stalls = 0
+        self.recent_stalls: deque = deque(maxlen=RECENT_STALLS)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop: threading.Event | None = None
+
+    def _interval(self) -> float:
+        return max(10.0, float(self.settings().get("loop_lag_interval_ms", 100))) / 1000
+
+    def _threshold(self) -> float:
+        return max(10.0, float(self.settings().get("slow_callback_threshold_ms", 100))) / 1000
+
+    def start(self):
+        """Запускается из цикла событий (в lifespan)."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.create_task(self._lag_loop())
+        self._stop = threading.Event()
+        threading.Thread(target=self._watchdog, args=(self._stop,), name="loop-watchdog", daemon=True).start()
+
+    async def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    # --- Задержка цикла ---
+    async def _lag_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            interval = self._interval()
+            scheduled = loop.time() + interval
+            await asyncio.sleep(interval)
+            self._observe(max(0.0, loop.time() - scheduled))
+
+    def _observe(self, lag: float):
+        index = 0
+        while index < len(LAG_BUCKETS) and lag > LAG_BUCKETS[index]:
+            index += 1
+        self.bucket_counts[index] += 1
+        self.lag_count += 1
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+
+    def _quantile(self, q: float) -> float | None:
+        """Верхняя граница корзины, в которую попадает квантиль q (оценка по гистограмме)."""
+        if not self.lag_count:
+            return None
+        rank = q * self.lag_count
+        seen = 0
+        for bound, count in zip(LAG_BUCKETS, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.lag_max
+
+    # --- Сторожевой поток ---
+    def _watchdog(self, stop: threading.Event):
+        loop, thread_id = self._loop, self._loop_thread_id
+        while not stop.wait(self._interval()):
+            threshold = self._threshold()
+            responded = threading.Event()
+            posted = time.monotonic()
+            try:
+                loop.call_soon_threadsafe(responded.set)
+            except RuntimeError:
+                return  # Цикл событий закрыт
+            if responded.wait(threshold):
+                continue
+            # Цикл занят дольше порога: стек снимается сейчас, пока блокирующий код ещё выполняется
+            frame = sys._current_frames().get(thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            location = _location(frame)
+            # Длительность известна после освобождения цикла; совсем зависший цикл сообщается не позже чем через 10 порогов
+            released = responded.wait(threshold * 9)
+            duration = time.monotonic() - posted
+            self.stalls += 1
+            self.recent_stalls.append({"at": time.time(), "duration_ms": round(duration * 1000, 1), "location": location, "ongoing": not released})
+            logger.warning(
+                f"LOOP: Цикл событий заблокирован не менее {duration * 1000:.0f} мс{'' if released else ' и всё ещё занят'} "
+                f"(порог {threshold * 1000:.0f} мс), место: {location}. Стек:\n{stack}"
+            )
+            while not released and not stop.is_set():
+                released = responded.wait(1.0)
+
+    # --- Вывод ---
+    def summary(self) -> dict:
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            "lag_samples": self.lag_count,
+            "lag_mean_ms": ms(self.lag_sum / self.lag_count) if self.lag_count else None,
+            "lag_p50_ms": ms(self._quantile(0.5)),
+            "lag_p99_ms": ms(self._quantile(0.99)),
+            "lag_max_ms": ms(self.lag_max),
+            "stalls": self.stalls,
+            "recent_stalls": list(self.recent_stalls),
+        }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus."""
+        lines = [
+            "# HELP lmarena_event_loop_lag_seconds Задержка пробуждения задачи в цикле событий.",
+            "# TYPE lmarena_event_loop_lag_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(LAG_BUCKETS, self.bucket_counts):
+            cumulative += count
+            lines.append(f'lmarena_event_loop_lag_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'lmarena_event_loop_lag_seconds_bucket{{le="+Inf"}} {self.lag_count}')
+        lines.append(f"lmarena_event_loop_lag_seconds_sum {self.lag_sum:.6f}")
+        lines.append(f"lmarena_event_loop_lag_seconds_count {self.lag_count}")
+        lines.append("# HELP lmarena_event_loop_stalls_total Блокировки цикла событий дольше slow_callback_threshold_ms.")
+        lines.append("# TYPE lmarena_event_loop_stalls_total counter")
+        lines.append(f"lmarena_event_loop_stalls_total {self.stalls}")
+        return "\n".join(lines) + "\n"
+
+
+def _location(frame) -> str:
+    """Самый глубокий кадр кода проекта (не стандартной библиотеки и не site-packages) — вероятный виновник."""
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        where = f"{filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+        if fallback is None:
+            fallback = where
+        if "site-packages" not in filename and not filename.startswith(sys.prefix) and not filename.startswith(sys.base_prefix):
+            return where
+        frame = frame.f_back
+    return fallback or "неизвестно"
@@ -0,0 +1,98 @@
+# modules/prefix_cache.py
+# Дельта-кодирование истории диалога между сервером и скриптом Tampermonkey.
+#
+# Браузер хранит ограниченный LRU-кеш уже полученных списков message_templates.
+# Сервер зеркально отслеживает содержимое этого кеша (без самих данных, только хеши),
+# поэтому для очередного хода можно отправить ссылку на закешированный префикс и только новые сообщения.
+import hashlib
+import json
+from collections import OrderedDict
+
+from modules.request_spool import SpooledDataURI
+
+
+def _canonical_default(obj):
+    # Выгруженные на диск вложения хешируются по хешу содержимого, без чтения файла
+    if isinstance(obj, SpooledDataURI):
+        return f"spooled:{obj.digest}"
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _template_digest(previous: bytes, template: dict) -> bytes:
+    """Скользящий хеш: хеш префикса зависит от всех сообщений до текущего включительно."""
+    canonical = json.dumps(template, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=_canonical_default)
+    return hashlib.blake2b(previous + canonical.encode('utf-8'), digest_size=16).digest()
+
+
+def chain_hashes(message_templates: list[dict]) -> list[str]:
+    """Возвращает хеши всех префиксов: элемент i — хеш сообщений [0..i]."""
+    hashes = []
+    current = b""
+    for template in message_templates:
+        current = _template_digest(current, template)
+        hashes.append(current.hex())
+    return hashes
+
+
+class PrefixCacheTracker:
+    """
+    Серверное зеркало кеша префиксов одного браузерного соединения.
+    Порядок вытеснения совпадает с LRU в скрипте Tampermonkey; при расхождении браузер
+    сообщает о промахе, и сервер повторяет отправку полной нагрузки.
+    """
+
+    def __init__(self, capacity: int = 32):
+        self.capacity = max(1, int(capacity))
+        # cache_key -> хеши всех префиксов сохранённого списка
+        self._entries: OrderedDict[str, list[str]] = OrderedDict()
+        # хеш префикса -> (cache_key, длина префикса)
+        self._index: dict[str, tuple[str, int]] = {}
+
+    def _evict(self, cache_key: str):
+        for prefix_hash in self._entries.pop(cache_key, []):
+            if self._index.get(prefix_hash, (None,))[0] == cache_key:
+                del self._index[prefix_hash]
+
+    def invalidate(self, cache_key: str | None):
+        """Удаляет запись, о промахе по которой сообщил браузер."""
+        if cache_key:
+            self._evict(cache_key)
+
+    def encode(self, message_templates: list[dict]) -> dict:
+        """
+        Возвращает поля нагрузки для отправки в браузер:
+        - cache_key: ключ, под которым браузер сохранит полный список;
+        - prefix_ref: {"key", "length"} — ссылка на закешированный префикс (только при попадании);
+        - message_templates: сообщения, не покрытые префиксом.
+        """
+        hashes = chain_hashes(message_templates)
+        if not hashes:
+            return {"message_templates": message_templates}
+
+        prefix_ref = None
+        for length in range(len(hashes), 0, -1):
+            hit = self._index.get(hashes[length - 1])
+            if hit:
+                ref_key, ref_length = hit
+                prefix_ref = {"key": ref_key, "length": ref_length}
+                # Браузер тоже переносит использованную запись в конец LRU
+                self._entries.move_to_end(ref_key)
+                break
+
+        cache_key = hashes[-1]
+        if cache_key in self._entries:
+            self._entries.move_to_end(cache_key)
+        else:
+            self._entries[cache_key] = hashes
+            for length, prefix_hash in enumerate(hashes, start=1):
+                self._index[prefix_hash] = (cache_key, length)
+            while len(self._entries) > self.capacity:
+                self._evict(next(iter(self._entries)))
+
+        if prefix_ref is None:
+            return {"message_templates": message_templates, "cache_key": cache_key}
+        return {
+            "message_templates": message_templates[prefix_ref["length"]:],
+            "prefix_ref": prefix_ref,
+            "cache_key": cache_key,
+        }
@@ -0,0 +1,188 @@
+# modules/rate_limiter.py
+# Квоты для нескольких API-ключей: token bucket по запросам и по оценочным токенам,
+# а также ограничение числа одновременных потоков на ключ.
+import hashlib
+import hmac
+import json
+import time
+
+
+class TokenBucket:
+    """Классический token bucket: пополняется со скоростью rate до ёмкости capacity."""
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Сколько секунд нужно подождать, прежде чем можно будет списать amount.
+        Запрос больше ёмкости корзины допускается при полной корзине (уходит "в долг"),
+        иначе крупный запрос никогда бы не прошёл.
+        """
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= amount
+
+
+class KeyQuota:
+    """Состояние квоты одного API-ключа."""
+    __slots__ = ("name", "key", "settings", "request_bucket", "token_bucket", "max_concurrent_streams", "active_streams")
+
+    def __init__(self, key: str, settings: dict):
+        self.key = key
+        self.active_streams = 0
+        self.apply(settings)
+
+    def apply(self, settings: dict):
+        """
+        Применяет (новые) настройки ключа. Объект сохраняется, поэтому уже выданные QuotaLease
+        освобождают слоты в том же счётчике active_streams.
+        """
+        self.settings = settings
+        self.name = settings.get("name") or f"key-{key_digest(self.key)[:8]}"
+        rps = settings.get("requests_per_second")
+        tps = settings.get("tokens_per_second")
+        self.request_bucket = TokenBucket(rps, settings.get("burst_requests", max(1.0, rps))) if rps else None
+        self.token_bucket = TokenBucket(tps, settings.get("burst_tokens", tps * 10)) if tps else None
+        self.max_concurrent_streams = settings.get("max_concurrent_streams")
+
+
+class QuotaLease:
+    """Занятый слот одновременного потока. release() идемпотентен."""
+    __slots__ = ("quota", "streams", "released")
+
+    def __init__(self, quota: KeyQuota | None, streams: int = 1):
+        self.quota = quota
+        self.streams = streams
+        self.released = quota is None
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.quota.active_streams -= self.streams
+
+
+class QuotaExceeded(Exception):
+    """Превышена квота ключа; retry_after — рекомендуемая задержка в секундах."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+
+def key_digest(key: str) -> str:
+    """SHA-256 ключа (hex) — идентификатор владельца, который можно хранить на диске вместо самого ключа."""
+    return _digest(key).hex()
+
+
+def estimate_request_tokens(openai_req: dict) -> int:
+    """Быстрая оценка числа токенов запроса: ~4 символа текста на токен."""
+    total_chars = 0
+    for message in openai_req.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            total_chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    total_chars += len(part.get("text") or "")
+    return total_chars // 4 + 1
+
+
+class QuotaRegistry:
+    """
+    Реестр ключей. Поиск выполняется за O(1) по SHA-256 от ключа,
+    окончательная проверка — сравнением за постоянное время (hmac.compare_digest).
+    """
+
+    def __init__(self):
+        self._by_digest: dict[bytes, KeyQuota] = {}
+        self._config_snapshot = None
+
+    def __bool__(self):
+        return bool(self._by_digest)
+
+    def configure(self, api_keys_config: dict | None):
+        """
+        Применяет раздел api_keys из конфигурации. Конфигурация перечитывается на каждый запрос,
+        поэтому состояние корзин сохраняется для ключей, чьи настройки не изменились.
+        """
+        snapshot = json.dumps(api_keys_config or {}, sort_keys=True)
+        if snapshot == self._config_snapshot:
+            return
+        self._config_snapshot = snapshot
+
+        new_map = {}
+        for key, settings in (api_keys_config or {}).items():
+            if not key:
+                continue
+            settings = settings if isinstance(settings, dict) else {}
+            digest = _digest(key)
+            existing = self._by_digest.get(digest)
+            if existing is None:
+                new_map[digest] = KeyQuota(key, settings)
+                continue
+            if existing.settings != settings:
+                existing.apply(settings)
+            new_map[digest] = existing
+        self._by_digest = new_map
+
+    def lookup(self, provided_key: str) -> KeyQuota | None:
+        quota = self._by_digest.get(_digest(provided_key))
+        if quota and hmac.compare_digest(quota.key.encode('utf-8'), provided_key.encode('utf-8')):
+            return quota
+        return None
+
+    def lookup_digest(self, digest_hex: str) -> KeyQuota | None:
+        """Квота по key_digest() — для запросов, которые выполняются позже от имени ключа (пакетные задания)."""
+        try:
+            return self._by_digest.get(bytes.fromhex(digest_hex))
+        except ValueError:
+            return None
+
+    def acquire(self, quota: KeyQuota, estimated_tokens: int, streams: int = 1) -> QuotaLease:
+        """
+        Проверяет все ограничения ключа и, только если проходят все, списывает их атомарно.
+        streams — число вызовов LMArena (ветвей), которые запрос займёт одновременно.
+        При превышении выбрасывает QuotaExceeded, ничего не списывая.
+        """
+        now = time.monotonic()
+        if quota.max_concurrent_streams is not None and quota.active_streams + streams > quota.max_concurrent_streams:
+            raise QuotaExceeded(f"Превышено число одновременных потоков ({quota.max_concurrent_streams}) для ключа '{quota.name}'.", 1.0)
+
+        if quota.request_bucket:
+            wait = quota.request_bucket.wait_time(streams, now)
+            if wait > 0:
+                raise QuotaExceeded(f"Превышен лимит запросов в секунду для ключа '{quota.name}'.", wait)
+        if quota.token_bucket:
+            wait = quota.token_bucket.wait_time(estimated_tokens, now)
+            if wait > 0:
+                raise QuotaExceeded(f"Превышен лимит токенов в секунду для ключа '{quota.name}'.", wait)
+
+        if quota.request_bucket:
+            quota.request_bucket.consume(streams)
+        if quota.token_bucket:
+            quota.token_bucket.consume(estimated_tokens)
+        # Потоки считаются и без лимита, чтобы добавленный позже max_concurrent_streams учитывал уже идущие
+        quota.active_streams += streams
+        return QuotaLease(quota, streams)
@@ -0,0 +1,234 @@
+# modules/request_profiler.py
+# Выборочное профилирование отдельных запросов в работающем сервере.
+#
+# Для выбранного запроса (доля profile_sample_rate или заголовок X-Profile-Token) фоновый поток раз в
+# profile_interval_ms снимает стек потока цикла событий. Снимок засчитывается запросу, если в этот момент
+# выполняется одна из его задач: задача обработчика или созданные из неё (ветви n > 1, потоковый ответ и т.п.).
+# Так в профиль попадает работа внутри сервера — преобразование нагрузки, обработка вложений, разбор потока
+# и кодирование SSE, — а не ожидание браузера.
+#
+# Результат — файл в формате свёрнутых стеков ("кадр;кадр;кадр число"), который понимают flamegraph.pl,
+# speedscope и inferno. Каталог ограничен числом файлов: самые старые удаляются.
+#
+# Пока ни один запрос не профилируется, поток выборки не работает и фабрика задач не установлена.
+import asyncio
+import contextvars
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = ".collapsed"
+MAX_STACK_DEPTH = 128
+
+# Профиль запроса, в контексте которого создаётся задача (наследуется дочерними задачами)
+_current_profile: contextvars.ContextVar["RequestProfile | None"] = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Снимки стеков одного запроса. release() завершает профиль и записывает файл (как слоты квот)."""
+
+    def __init__(self, profiler: "RequestProfiler", request_id: str, label: str):
+        self.profiler = profiler
+        self.request_id = request_id
+        self.label = label
+        self.started_at = time.time()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.active = True
+
+    def release(self):
+        if self.active:
+            self.active = False
+            self.profiler._finish(self)
+
+
+class RequestProfiler:
+    def __init__(self, settings=lambda: {}):
+        self.settings = settings
+        # Переключатель из /internal/profile: перекрывает profile_sample_rate из config.jsonc до истечения срока
+        self.override_rate: float | None = None
+        self.override_until: float | None = None
+        self._active: set[RequestProfile] = set()
+        self._tasks: "weakref.WeakKeyDictionary[asyncio.Task, RequestProfile]" = weakref.WeakKeyDictionary()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._previous_factory = None
+        self._stop: threading.Event | None = None  # Свой для каждого запуска потока выборки
+
+    # --- Настройки ---
+    @property
+    def directory(self) -> str:
+        return self.settings().get("profile_dir") or "profiles"
+
+    @property
+    def sample_rate(self) -> float:
+        if self.override_rate is not None:
+            if self.override_until is None or time.monotonic() < self.override_until:
+                return self.override_rate
+            self.override_rate = self.override_until = None
+        return float(self.settings().get("profile_sample_rate", 0) or 0)
+
+    def set_override(self, rate: float | None, duration: float | None = None):
+        """Включает профилирование доли запросов (None — вернуть значение из config.jsonc)."""
+        self.override_rate = None if rate is None else min(1.0, max(0.0, float(rate)))
+        self.override_until = time.monotonic() + duration if rate is not None and duration else None
+
+    def status(self) -> dict:
+        remaining = max(0.0, self.override_until - time.monotonic()) if self.override_until else None
+        return {
+            "sample_rate": self.sample_rate,
+            "override": self.override_rate is not None,
+            "override_remaining_seconds": round(remaining, 1) if remaining is not None else None,
+            "interval_ms": self._interval() * 1000,
+            "active_profiles": len(self._active),
+            "directory": self.directory,
+            "profiles": self.list_profiles(),
+        }
+
+    def _interval(self) -> float:
+        return max(1.0, float(self.settings().get("profile_interval_ms", 5))) / 1000
+
+    # --- Выбор запросов ---
+    def maybe_start(self, request_id: str, headers, label: str = "") -> RequestProfile | None:
+        """
+        Возвращает профиль, если запрос выбран для профилирования, иначе None.
+        Без заголовка и при нулевой доле — только одна проверка, без других затрат.
+        """
+        token = headers.get("x-profile-token")
+        rate = self.sample_rate
+        if token is None and not rate:
+            return None
+        forced = self.token_matches(token)
+        if not forced and (not rate or random.random() >= rate):
+            return None
+        return self._start(request_id, label)
+
+    def token_matches(self, token: str | None) -> bool:
+        """Совпадает ли значение заголовка X-Profile-Token с profile_token (пустой profile_token не совпадает ни с чем)."""
+        if token is None:
+            return False
+        expected = self.settings().get("profile_token") or ""
+        return bool(expected) and hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8'))
+
+    def _start(self, request_id: str, label: str) -> RequestProfile:
+        profile = RequestProfile(self, request_id, label)
+        if not self._active:
+            self._install()
+        self._active.add(profile)
+        _current_profile.set(profile)
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks[task] = profile
+        return profile
+
+    # --- Фабрика задач и поток выборки (работают, только пока есть активные профили) ---
+    def _install(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._previous_factory = self._loop.get_task_factory()
+        self._loop.set_task_factory(self._task_factory)
+        self._stop = threading.Event()
+        threading.Thread(target=self._sample_loop, args=(self._stop,), name="request-profiler", daemon=True).start()
+
+    def _uninstall(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        if self._loop is not None and self._loop.get_task_factory() == self._task_factory:
+            self._loop.set_task_factory(self._previous_factory)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        profile = _current_profile.get()
+        if profile is not None and profile.active:
+            self._tasks[task] = profile
+        return task
+
+    def _sample_loop(self, stop: threading.Event):
+        interval = self._interval()
+        loop, thread_id = self._loop, self._loop_thread_id
+        while not stop.wait(interval):
+            task = asyncio.current_task(loop)
+            profile = self._tasks.get(task) if task is not None else None
+            if profile is None or not profile.active:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            # Цикл событий мог переключиться на другую задачу, пока снимался стек
+            if frame is None or asyncio.current_task(loop) is not task:
+                continue
+            profile.stacks[_collapse(frame)] += 1
+            profile.samples += 1
+
+    def _finish(self, profile: RequestProfile):
+        self._active.discard(profile)
+        if not self._active:
+            self._uninstall()
+        if not profile.samples:
+            return
+        try:
+            self._write(profile)
+        except OSError as e:
+            logger.warning(f"PROFILE [ID: {profile.request_id[:8]}]: Не удалось сохранить профиль: {e}")
+
+    # --- Файлы профилей ---
+    def _write(self, profile: RequestProfile):
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(profile.started_at))
+        label = "".join(c if c.isalnum() or c in "-._" else "_" for c in profile.label)[:48]
+        name = f"{stamp}_{profile.request_id[:8]}" + (f"_{label}" if label else "") + PROFILE_SUFFIX
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            for stack, count in profile.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        elapsed = time.time() - profile.started_at
+        logger.info(f"PROFILE [ID: {profile.request_id[:8]}]: {profile.samples} снимков за {elapsed:.2f} с сохранено в {name}.")
+        self._prune(directory)
+
+    def _prune(self, directory: str):
+        limit = max(1, int(self.settings().get("profile_max_files", 100)))
+        files = sorted(
+            (entry for entry in os.scandir(directory) if entry.name.endswith(PROFILE_SUFFIX)),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in files[:-limit]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def list_profiles(self) -> list[dict]:
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(PROFILE_SUFFIX)]
+        except OSError:
+            return []
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [{"name": entry.name, "bytes": entry.stat().st_size, "created": entry.stat().st_mtime} for entry in entries]
+
+    def profile_path(self, name: str) -> str | None:
+        """Путь к файлу профиля или None, если имя недопустимо или файла нет."""
+        if os.path.basename(name) != name or not name.endswith(PROFILE_SUFFIX):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+def _collapse(frame) -> str:
+    """Стек от корня к вершине в формате свёрнутых стеков: 'файл:функция;файл:функция'."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
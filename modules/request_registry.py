@@ -0,0 +1,106 @@
+# modules/request_registry.py
+# Реестр выполняющихся запросов брокера: компактная запись на запрос (канал ответа, вкладка, эндпоинт,
+# время, объём данных, состояние) и фоновая очистка записей, по которым давно нет активности.
+import time
+from collections import OrderedDict
+
+# Состояния запроса
+STATE_OPEN = "open"              # канал создан, запрос ещё не передан браузеру
+STATE_DISPATCHED = "dispatched"  # нагрузка отправлена во вкладку, ответа ещё нет
+STATE_STREAMING = "streaming"    # идут блоки ответа
+STATE_DONE = "done"              # получен [DONE] или ошибка, ждём, пока обработчик закроет канал
+STATE_SUSPENDED = "suspended"    # вкладка отключилась, ждём её переподключения для возобновления потока
+
+
+class RequestRecord:
+    """Запись об одном запросе. __slots__ держат запись компактной при тысячах одновременных запросов."""
+    __slots__ = ("request_id", "channel", "worker_id", "endpoint", "created_at", "updated_at", "bytes_in", "bytes_out", "state", "last_seq")
+
+    def __init__(self, request_id: str, channel, endpoint: str | None = None):
+        self.request_id = request_id
+        self.channel = channel
+        self.worker_id: str | None = None
+        self.endpoint = endpoint
+        self.created_at = time.monotonic()
+        self.updated_at = self.created_at
+        self.bytes_in = 0   # получено от браузера
+        self.bytes_out = 0  # отправлено браузеру
+        self.state = STATE_OPEN
+        self.last_seq = 0   # номер последнего полученного кадра (скрипт нумерует кадры для возобновления)
+
+    def mark_sent(self, worker_id: str | None, size: int):
+        self.worker_id = worker_id
+        self.bytes_out += size
+        self.state = STATE_DISPATCHED
+        self.updated_at = time.monotonic()
+
+    def mark_received(self, size: int, final: bool = False):
+        self.bytes_in += size
+        self.state = STATE_DONE if final else STATE_STREAMING
+        self.updated_at = time.monotonic()
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "request_id": self.request_id,
+            "worker_id": self.worker_id,
+            "endpoint": self.endpoint,
+            "state": self.state,
+            "age_seconds": round(now - self.created_at, 3),
+            "idle_seconds": round(now - self.updated_at, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "last_seq": self.last_seq,
+        }
+
+
+class RequestRegistry:
+    """
+    request_id -> RequestRecord. Закрытые идентификаторы запоминаются в ограниченном списке,
+    чтобы запоздавшие блоки закрытых запросов отличались от действительно неизвестных.
+    """
+
+    def __init__(self, recently_closed_limit: int = 1024):
+        self._records: dict[str, RequestRecord] = {}
+        self._recently_closed: OrderedDict[str, None] = OrderedDict()
+        self._recently_closed_limit = recently_closed_limit
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, request_id: str):
+        return request_id in self._records
+
+    def open(self, request_id: str, channel, endpoint: str | None = None) -> RequestRecord:
+        record = RequestRecord(request_id, channel, endpoint)
+        self._records[request_id] = record
+        return record
+
+    def get(self, request_id: str) -> RequestRecord | None:
+        return self._records.get(request_id)
+
+    def close(self, request_id: str) -> RequestRecord | None:
+        record = self._records.pop(request_id, None)
+        if record is not None:
+            self._recently_closed[request_id] = None
+            if len(self._recently_closed) > self._recently_closed_limit:
+                self._recently_closed.popitem(last=False)
+        return record
+
+    def was_recently_closed(self, request_id: str) -> bool:
+        return request_id in self._recently_closed
+
+    def records(self) -> list[RequestRecord]:
+        return list(self._records.values())
+
+    def clear(self):
+        for request_id in list(self._records):
+            self.close(request_id)
+
+    def expired(self, ttl: float, now: float | None = None) -> list[RequestRecord]:
+        """Записи, по которым не было активности дольше ttl секунд."""
+        now = time.monotonic() if now is None else now
+        return [record for record in self._records.values() if now - record.updated_at > ttl]
+
+    def snapshot(self) -> list[dict]:
+        now = time.monotonic()
+        return [record.to_dict(now) for record in sorted(self._records.values(), key=lambda r: r.created_at)]
@@ -0,0 +1,278 @@
+# modules/request_spool.py
+# Потоковый разбор тела запроса чата с выгрузкой крупных data URI во временные файлы.
+#
+# Тело читается блоками; строковые значения JSON, начинающиеся с "data:", копируются не в память,
+# а в файл спула (как только превышают порог). В разобранной структуре вместо них (в полях "url") остаются лёгкие
+# дескрипторы SpooledDataURI, а сами данные читаются с диска только в момент отправки
+# (сериализация нагрузки для браузера, загрузка в файловое хранилище, сжатие изображения).
+# Так несколько мультимодальных запросов одновременно не держат в памяти по нескольку копий base64.
+import hashlib
+import os
+import tempfile
+
+from modules import fast_json
+
+_DATA_PREFIX = b'"data:'
+# Заглушка в скелете JSON: строка с NUL-символом не встречается в обычных запросах
+_MARKER_PREFIX = "\x00lmb-spool:"
+_MARKER_JSON = b'"\\u0000lmb-spool:%d"'
+HEAD_SIZE = 256  # Начало data URI (заголовок с MIME-типом) хранится в памяти
+
+
+class SpooledDataURI:
+    """Дескриптор data URI, выгруженного на диск. Содержимое читается только через read()."""
+    __slots__ = ("path", "size", "head", "digest")
+
+    def __init__(self, path: str, size: int, head: str, digest: str):
+        self.path = path
+        self.size = size
+        self.head = head
+        self.digest = digest
+
+    @property
+    def content_type(self) -> str:
+        return self.head[5:].split(';', 1)[0].split(',', 1)[0]
+
+    def startswith(self, prefix: str) -> bool:
+        return self.head.startswith(prefix)
+
+    def read(self) -> str:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def __json__(self) -> str:
+        # Вызывается fast_json при сериализации: данные материализуются только при отправке
+        return self.read()
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"<SpooledDataURI {self.content_type} {self.size} байт>"
+
+
+def materialize(value):
+    """Возвращает строку data URI для дескриптора спула и значение без изменений для всего остального."""
+    return value.read() if isinstance(value, SpooledDataURI) else value
+
+
+class RequestSpool:
+    """
+    Временные файлы одного запроса. release() удаляет их; объект передаётся в _release_when_done
+    вместе с остальными слотами запроса, поэтому файлы живут, пока идёт ответ (повторная отправка
+    полной нагрузки при промахе кеша префиксов тоже читает их).
+    """
+
+    def __init__(self, directory: str | None = None, threshold: int = 256 * 1024):
+        self.directory = directory
+        self.threshold = max(1, int(threshold))
+        self.handles: list[SpooledDataURI] = []
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        for handle in self.handles:
+            try:
+                os.remove(handle.path)
+            except OSError:
+                pass
+
+    async def parse(self, chunks):
+        """Разбирает тело запроса из асинхронного итератора байтовых блоков (request.stream())."""
+        scanner = _SpoolingScanner(self)
+        try:
+            async for chunk in chunks:
+                if chunk:
+                    scanner.feed(chunk)
+            skeleton = scanner.finish()
+            result = fast_json.loads(skeleton)
+        except BaseException:
+            scanner.abandon()
+            self.release()
+            raise
+        if self.handles:
+            result = _substitute(result, self.handles)
+        return result
+
+    def _new_file(self):
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="lmb-spool-", suffix=".txt", dir=self.directory)
+        return os.fdopen(fd, 'wb'), path
+
+
+class _SpoolingScanner:
+    """
+    Конечный автомат над байтами тела запроса. Разбирается только то, что нужно для поиска строк "data:...":
+    неэкранированная кавычка, за которой сразу идёт data:, в корректном JSON может быть только началом строки.
+    Всё остальное копируется в скелет как есть (поиск выполняется bytes.find, без побайтового цикла в Python).
+    """
+
+    def __init__(self, spool: RequestSpool):
+        self.spool = spool
+        self.skeleton = bytearray()
+        self.carry = b""             # Хвост блока, который может оказаться началом '"data:'
+        self.in_data = False         # Внутри строки data URI
+        self.buffer = bytearray()    # Начало строки, пока она меньше порога
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.hasher = None
+        self.head = b""
+        self.has_escapes = False
+        self.trailing_backslashes = 0
+
+    def feed(self, chunk: bytes):
+        data = self.carry + chunk if self.carry else chunk
+        self.carry = b""
+        position = 0
+        while position < len(data):
+            if self.in_data:
+                position = self._scan_string(data, position)
+            else:
+                index = data.find(_DATA_PREFIX, position)
+                if index == -1:
+                    # Оставляем хвост, который может быть началом разделённого между блоками '"data:'
+                    keep = _partial_prefix_length(data, position)
+                    self.skeleton += data[position:len(data) - keep]
+                    self.carry = data[len(data) - keep:]
+                    return
+                self.skeleton += data[position:index]
+                if _trailing_backslash_count(self.skeleton) % 2:
+                    # Экранированная кавычка внутри другой строки — это не начало data URI
+                    self.skeleton += data[index:index + 1]
+                    position = index + 1
+                    continue
+                self._start_string()
+                position = index + 1
+
+    def _start_string(self):
+        self.in_data = True
+        self.buffer = bytearray()
+        self.file = self.path = None
+        self.size = 0
+        self.hasher = hashlib.blake2b(digest_size=16)
+        self.head = b""
+        self.has_escapes = False
+        self.trailing_backslashes = 0
+
+    def _scan_string(self, data: bytes, position: int) -> int:
+        """Ищет закрывающую кавычку строки data URI, возвращает позицию после обработанной части."""
+        search_from = position
+        while True:
+            end = data.find(b'"', search_from)
+            if end == -1:
+                self._append(data[position:])
+                return len(data)
+            # Число обратных слэшей перед кавычкой (с учётом хвоста предыдущего блока)
+            run = 0
+            while end - run - 1 >= position and data[end - run - 1] == 0x5C:
+                run += 1
+            if end - run == position:
+                run += self.trailing_backslashes
+            if run % 2 == 0:
+                self._append(data[position:end])
+                self._finish_string()
+                return end + 1
+            search_from = end + 1
+
+    def _append(self, piece: bytes):
+        if not piece:
+            return
+        if b"\\" in piece:
+            self.has_escapes = True
+        run = len(piece) - len(piece.rstrip(b"\\"))
+        self.trailing_backslashes = run if run < len(piece) else self.trailing_backslashes + run
+        self.hasher.update(piece)
+        if len(self.head) < HEAD_SIZE:
+            self.head += piece[:HEAD_SIZE - len(self.head)]
+        self.size += len(piece)
+        if self.file is None:
+            self.buffer += piece
+            if len(self.buffer) >= self.spool.threshold:
+                self.file, self.path = self.spool._new_file()
+                self.file.write(self.buffer)
+                self.buffer = bytearray()
+        else:
+            self.file.write(piece)
+
+    def _finish_string(self):
+        self.in_data = False
+        if self.file is None:
+            # Короткая строка остаётся в теле запроса как есть
+            self.skeleton += b'"' + self.buffer + b'"'
+            self.buffer = bytearray()
+            return
+        self.file.close()
+        self.file = None
+        head = self.head.decode('utf-8', 'replace')
+        if self.has_escapes:
+            # Редкий случай: клиент экранировал символы (например, "\/"). Файл переписывается раскодированным.
+            with open(self.path, 'rb') as f:
+                text = fast_json.loads(b'"' + f.read() + b'"')
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            head = text[:HEAD_SIZE]
+            self.size = len(text)
+        handle = SpooledDataURI(self.path, self.size, head, self.hasher.hexdigest())
+        self.skeleton += _MARKER_JSON % len(self.spool.handles)
+        self.spool.handles.append(handle)
+
+    def finish(self) -> bytes:
+        if self.in_data:
+            raise fast_json.JSONDecodeError("Строка data URI не завершена", "", 0)
+        self.skeleton += self.carry
+        self.carry = b""
+        return bytes(self.skeleton)
+
+    def abandon(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def _partial_prefix_length(data: bytes, position: int) -> int:
+    """Длина хвоста data, совпадающего с началом '"data:' (не более длины префикса минус один)."""
+    for length in range(min(len(_DATA_PREFIX) - 1, len(data) - position), 0, -1):
+        if data.endswith(_DATA_PREFIX[:length]):
+            return length
+    return 0
+
+
+def _trailing_backslash_count(buffer: bytearray) -> int:
+    count = 0
+    while count < len(buffer) and buffer[-1 - count] == 0x5C:
+        count += 1
+    return count
+
+
+def _substitute(value, handles: list[SpooledDataURI], key=None):
+    """
+    Заменяет строки-заглушки в разобранной структуре на дескрипторы спула.
+    Дескрипторы остаются только в полях "url" (image_url и т.п.); длинные строки "data:..." в других полях
+    (например, в тексте сообщения) возвращаются обычными строками, чтобы не ломать обработку текста.
+    """
+    if isinstance(value, str):
+        if value.startswith(_MARKER_PREFIX):
+            try:
+                handle = handles[int(value[len(_MARKER_PREFIX):])]
+            except (ValueError, IndexError):
+                return value
+            return handle if key == "url" else handle.read()
+        return value
+    if isinstance(value, dict):
+        for item_key, item in value.items():
+            if isinstance(item, (str, dict, list)):
+                value[item_key] = _substitute(item, handles, item_key)
+        return value
+    if isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, (str, dict, list)):
+                value[index] = _substitute(item, handles)
+    return value
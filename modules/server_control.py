@@ -0,0 +1,182 @@
+# modules/server_control.py
+# Плавная остановка и перезапуск API-сервера без разрыва соединений.
+#
+# - Остановка (Ctrl+C, SIGTERM): сервер переходит в режим завершения — новые запросы получают 503
+#   с Retry-After, выполняющиеся ответы дорабатывают до срока drain_timeout_seconds. Повторный Ctrl+C
+#   завершает работу сразу.
+# - Перезапуск (простой, SIGHUP, /internal/reload): запускается новый процесс, которому передаётся
+#   слушающий сокет (номер дескриптора — в переменной окружения). Пока новый процесс загружается, старый
+#   продолжает принимать подключения, поэтому клиенты не получают отказа в соединении. Когда новый процесс
+#   готов, старый перестаёт принимать подключения и дорабатывает выполняющиеся запросы.
+import asyncio
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+LISTEN_FD_ENV = "LMARENA_LISTEN_FD"  # Слушающий сокет, унаследованный от предыдущего процесса
+READY_FD_ENV = "LMARENA_READY_FD"    # Канал, в который новый процесс сообщает о готовности
+
+SUPPORTS_HANDOFF = os.name == "posix"  # Передача дескрипторов дочернему процессу (pass_fds) есть только в POSIX
+
+
+def create_listen_socket(host: str, port: int) -> tuple[socket.socket, bool]:
+    """
+    Возвращает (сокет, унаследован ли он). Унаследованный сокет уже слушает порт, и подключения,
+    пришедшие во время запуска процесса, ждут в его очереди, а не отклоняются.
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        try:
+            sock = socket.socket(fileno=int(fd))
+            sock.setblocking(False)
+            return sock, True
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось принять слушающий сокет от предыдущего процесса ({e}), открывается новый.")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # После обычного перезапуска (execv) порт может быть ещё занят завершающимся процессом
+    for attempt in range(20):
+        try:
+            sock.bind((host, port))
+            break
+        except OSError:
+            if attempt == 19:
+                raise
+            time.sleep(0.5)
+    sock.listen(2048)
+    sock.setblocking(False)
+    return sock, False
+
+
+def notify_ready():
+    """Сообщает предыдущему процессу, что новый процесс загрузился и готов обрабатывать запросы."""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось уведомить предыдущий процесс о готовности: {e}")
+
+
+async def spawn_successor(sock: socket.socket, ready_timeout: float) -> subprocess.Popen | None:
+    """
+    Запускает новый процесс сервера с тем же сокетом и ждёт его готовности.
+    Возвращает процесс или None, если он не запустился за ready_timeout секунд.
+    """
+    read_fd, write_fd = os.pipe()
+    env = {**os.environ, LISTEN_FD_ENV: str(sock.fileno()), READY_FD_ENV: str(write_fd)}
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=(sock.fileno(), write_fd))
+    except OSError as e:
+        os.close(read_fd)
+        os.close(write_fd)
+        logger.error(f"Не удалось запустить новый процесс сервера: {e}")
+        return None
+    os.close(write_fd)
+
+    # read() вернёт пустую строку, если новый процесс завершится, не сообщив о готовности
+    reader = asyncio.ensure_future(asyncio.to_thread(os.read, read_fd, 1))
+    try:
+        ready = await asyncio.wait_for(asyncio.shield(reader), timeout=ready_timeout)
+    except asyncio.TimeoutError:
+        ready = b""
+    if ready != b"1":
+        logger.error(f"Новый процесс сервера (PID {process.pid}) не сообщил о готовности, перезапуск отменён.")
+        if process.poll() is None:
+            process.kill()
+        await reader  # После завершения процесса канал закрывается и поток чтения освобождается
+    os.close(read_fd)
+    return process if ready == b"1" else None
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    uvicorn.Server с плавным завершением: первый сигнал остановки запускает on_drain(),
+    и только после него начинается обычное завершение uvicorn (закрытие соединений, в том числе /ws).
+    """
+
+    def __init__(self, config: uvicorn.Config, on_drain, on_reload=None):
+        super().__init__(config)
+        self.on_drain = on_drain    # async on_drain() — ждёт завершения выполняющихся запросов
+        self.on_reload = on_reload  # async on_reload() — перезапуск с передачей сокета (SIGHUP)
+        self.after_exit: list = []  # Выполняются после полной остановки сервера (перезапуск, запуск обновления)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._drain_task: asyncio.Task | None = None
+
+    async def serve(self, sockets=None):
+        self._loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGHUP"):
+            self._loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
+        await super().serve(sockets)
+
+    def _on_sighup(self):
+        if self.on_reload:
+            asyncio.ensure_future(self.on_reload())
+
+    def handle_exit(self, sig, frame):
+        if self._drain_task is None and not self.should_exit and self._loop is not None:
+            self._captured_signals.append(sig)
+            logger.warning("Получен сигнал остановки: новые запросы не принимаются, выполняющиеся дорабатывают. Повторный Ctrl+C — немедленная остановка.")
+            self._loop.call_soon_threadsafe(self.request_drain)
+            return
+        super().handle_exit(sig, frame)
+
+    def request_drain(self):
+        """Запускает завершение работы после доработки выполняющихся запросов (можно вызывать из цикла событий)."""
+        if self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self._drain_then_exit())
+
+    async def _drain_then_exit(self):
+        try:
+            await self.on_drain()
+        except Exception as e:
+            logger.error(f"Ошибка при завершении выполняющихся запросов: {e}", exc_info=True)
+        finally:
+            self.should_exit = True
+
+    def stop_accepting(self):
+        """
+        Перестаёт принимать новые подключения. Свободные keep-alive соединения закрываются, чтобы клиенты
+        открыли новые (уже к новому процессу); соединения с незавершённым ответом закроются после него.
+        WebSocket-соединения вкладок не затрагиваются.
+        """
+        for server in self.servers:
+            server.close()
+        for connection in list(self.server_state.connections):
+            if hasattr(connection, "cycle"):  # HTTP-протокол uvicorn (h11/httptools)
+                connection.shutdown()
+
+
+class InflightCounter:
+    """Число выполняющихся клиентских запросов. enter() возвращает слот с release(), как и квоты."""
+
+    def __init__(self):
+        self.count = 0
+
+    def enter(self) -> "_InflightLease":
+        self.count += 1
+        return _InflightLease(self)
+
+
+class _InflightLease:
+    __slots__ = ("counter", "released")
+
+    def __init__(self, counter: InflightCounter):
+        self.counter = counter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.counter.count -= 1
@@ -0,0 +1,146 @@
+# modules/single_flight.py
+# Объединение одинаковых одновременных запросов (single-flight).
+#
+# Если клиент агрессивно повторяет запрос или несколько пользователей одновременно спрашивают одно и то же,
+# второй идентичный запрос не отправляется в LMArena, а подключается к уже идущему ответу: получает
+# уже выданное начало ответа, а затем — новые блоки по мере поступления. События ответа хранятся в одном
+# общем списке, и каждый подписчик читает его со своей позиции, поэтому поток не копируется для каждого клиента.
+import asyncio
+import hashlib
+import json
+import logging
+
+from modules.request_spool import SpooledDataURI
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical_default(obj):
+    # Выгруженные на диск вложения учитываются по хешу содержимого, без чтения файла
+    if isinstance(obj, SpooledDataURI):
+        return f"spooled:{obj.digest}"
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def canonical_key(payload: dict, **extra) -> str:
+    """
+    Ключ объединения: хеш преобразованной нагрузки для браузера без идентификаторов сессии
+    (одинаковый запрос может уйти в разные сессии пула) и без имён вложений (они генерируются случайно).
+    extra — параметры, влияющие на ответ, но не входящие в нагрузку (модель, n и т.п.).
+    """
+    templates = [
+        {**template, "attachments": [{k: v for k, v in attachment.items() if k != "name"} for attachment in template.get("attachments", [])]}
+        for template in payload.get("message_templates", [])
+    ]
+    canonical = {k: v for k, v in payload.items() if k not in ("session_id", "message_id", "message_templates")}
+    canonical.update(templates=templates, extra=extra)
+    encoded = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=_canonical_default)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class Flight:
+    """
+    Один выполняющийся запрос к LMArena и его подписчики.
+    Первый запрос (ведущий) создаёт Flight, отправляет нагрузку в браузер и вызывает start();
+    до этого повторные запросы ждут в wait_started(). Если ведущий не смог отправить запрос (fail()),
+    ожидающие отправляют свои запросы сами.
+    """
+
+    def __init__(self, key: str, registry: "SingleFlight"):
+        self.key = key
+        self.registry = registry
+        self.branches = None       # Ветви ведущего запроса (для индексов вариантов ответа)
+        self.events: list = []     # Все события ответа по порядку; общий для всех подписчиков
+        self.done = False
+        self.subscribers = 0
+        self.joined = 0            # Сколько повторных запросов подключилось
+        self._started = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._leases = ()
+
+    async def wait_started(self) -> bool:
+        """Ждёт, пока ведущий запрос будет отправлен в браузер. False — ведущий завершился ошибкой."""
+        return await asyncio.shield(self._started)
+
+    def start(self, branches, source, leases=()):
+        """
+        Запускает чтение событий source в фоновой задаче. leases (квота, приоритет, файлы спула ведущего)
+        освобождаются, когда ответ LMArena завершён, а не когда отключился ведущий клиент.
+        """
+        self.branches = branches
+        self._leases = leases
+        self._task = asyncio.create_task(self._run(source))
+        self._started.set_result(True)
+
+    def fail(self):
+        if not self._started.done():
+            self._started.set_result(False)
+        self.registry._discard(self)
+
+    async def _run(self, source):
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            self.events.append(('error', 'Запрос прерван: все клиенты отключились.', 0, 0))
+        except Exception as e:
+            logger.error(f"SINGLE-FLIGHT: Ошибка чтения ответа: {e}", exc_info=True)
+            self.events.append(('error', str(e), 0, 0))
+        finally:
+            self.done = True
+            self._notify()
+            self.registry._discard(self)
+            for lease in self._leases:
+                lease.release()
+
+    def _notify(self):
+        # Ожидающие подписчики держат ссылку на прежнее событие и просыпаются; новое ждёт следующих данных
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        """Выдаёт все события ответа с начала: уже полученные — сразу, новые — по мере поступления."""
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                if position < len(self.events):
+                    end = len(self.events)
+                    for index in range(position, end):
+                        yield self.events[index]
+                    position = end
+                    continue
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self._task is not None:
+                # Ответ больше никому не нужен: прерываем запрос (вкладке уходит команда прерывания)
+                self.registry._discard(self)
+                self._task.cancel()
+
+
+class SingleFlight:
+    """Реестр выполняющихся объединяемых запросов по ключу canonical_key()."""
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def get(self, key: str) -> Flight | None:
+        return self._flights.get(key)
+
+    def create(self, key: str) -> Flight:
+        flight = Flight(key, self)
+        self._flights[key] = flight
+        return flight
+
+    def _discard(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
@@ -0,0 +1,90 @@
+# modules/test_broker.py
+# Проверка связки хаб — фронт на локальном сокете: запрос и ответ крупнее стандартного предела
+# строки StreamReader (64 КиБ) проходят через хаб, а соединение фронта после них остаётся рабочим.
+#
+# Вместо вкладки браузера к InMemoryBroker хаба подключается заглушка WebSocket.
+#
+# Запуск из корня проекта: python -m pytest modules/test_broker.py
+#                       или python -m modules.test_broker
+import asyncio
+import json
+import os
+import tempfile
+
+from modules.broker import BrokerHubServer, InMemoryBroker, SocketBroker
+
+LARGE_SIZE = 300 * 1024  # Заметно больше 64 КиБ
+TOKEN = "test-token"
+
+
+class _FakeWebSocket:
+    """Заглушка соединения вкладки: кадры, отправленные во вкладку, складываются в очередь."""
+
+    def __init__(self):
+        self.sent: asyncio.Queue = asyncio.Queue()
+
+    async def send_text(self, text: str):
+        await self.sent.put(json.loads(text))
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+async def _wait_for(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("условие не выполнено за отведённое время")
+        await asyncio.sleep(0.01)
+
+
+async def _roundtrip(address: str):
+    hub_broker = InMemoryBroker(heartbeat_interval=0)
+    await hub_broker.start()
+    hub = BrokerHubServer(hub_broker, address, TOKEN)
+    await hub.start()
+    front = SocketBroker(address, token=TOKEN, reconnect_delay=0.1)
+    await front.start()
+    try:
+        websocket = _FakeWebSocket()
+        worker = hub_broker.attach_worker(websocket)
+        await _wait_for(front.has_workers)
+
+        for index in range(2):
+            request_id = f"large-{index}"
+            history = "x" * LARGE_SIZE
+            channel = front.open_channel(request_id)
+            await front.dispatch(request_id, {"request_id": request_id, "payload": {"history": history}}, prefix_cache_enabled=False)
+
+            sent = await asyncio.wait_for(websocket.sent.get(), 5)
+            assert sent["request_id"] == request_id
+            assert sent["payload"]["history"] == history
+
+            answer = "a0:" + json.dumps("y" * LARGE_SIZE) + "\n"
+            await hub_broker.handle_browser_message(worker, {"request_id": request_id, "data": answer})
+            await hub_broker.handle_browser_message(worker, {"request_id": request_id, "data": "[DONE]"})
+            assert await asyncio.wait_for(channel.get(), 5) == answer
+            assert await asyncio.wait_for(channel.get(), 5) == "[DONE]"
+            front.close_channel(request_id)
+
+        # Соединение фронта не разорвано и не переподключалось
+        assert front.has_workers()
+    finally:
+        await front.stop()
+        await hub.stop()
+        await hub_broker.stop()
+
+
+def test_large_lines_through_unix_socket_hub():
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(_roundtrip("unix:" + os.path.join(directory, "hub.sock")))
+
+
+def test_large_lines_through_tcp_hub():
+    asyncio.run(_roundtrip("127.0.0.1:51905"))
+
+
+if __name__ == "__main__":
+    test_large_lines_through_unix_socket_hub()
+    test_large_lines_through_tcp_hub()
+    print("broker: OK")
@@ -0,0 +1,56 @@
+# modules/test_rate_limiter.py
+# Проверка квот API-ключей: изменение настроек ключа во время идущих потоков не должно терять слоты
+# (уже выданные QuotaLease освобождают счётчик той же квоты, что видят новые запросы).
+#
+# Запуск из корня проекта: python -m pytest modules/test_rate_limiter.py
+#                       или python -m modules.test_rate_limiter
+from modules.rate_limiter import QuotaExceeded, QuotaRegistry
+
+KEY = "sk-test"
+
+
+def test_lease_released_after_settings_change():
+    registry = QuotaRegistry()
+    registry.configure({KEY: {"max_concurrent_streams": 1}})
+    lease = registry.acquire(registry.lookup(KEY), estimated_tokens=10)
+
+    # Ключу добавлен лимит запросов в секунду, пока поток ещё идёт
+    registry.configure({KEY: {"max_concurrent_streams": 1, "requests_per_second": 100}})
+    quota = registry.lookup(KEY)
+    assert quota.active_streams == 1
+    try:
+        registry.acquire(quota, estimated_tokens=10)
+    except QuotaExceeded:
+        pass
+    else:
+        raise AssertionError("второй поток сверх max_concurrent_streams должен отклоняться")
+
+    lease.release()
+    assert quota.active_streams == 0
+    registry.acquire(quota, estimated_tokens=10).release()
+    assert quota.active_streams == 0
+
+
+def test_limit_added_while_streams_run():
+    registry = QuotaRegistry()
+    registry.configure({KEY: {}})
+    lease = registry.acquire(registry.lookup(KEY), estimated_tokens=10)
+
+    registry.configure({KEY: {"max_concurrent_streams": 1}})
+    quota = registry.lookup(KEY)
+    try:
+        registry.acquire(quota, estimated_tokens=10)
+    except QuotaExceeded:
+        pass
+    else:
+        raise AssertionError("уже идущий поток должен учитываться новым лимитом")
+
+    lease.release()
+    lease.release()  # Повторное освобождение ничего не меняет
+    assert quota.active_streams == 0
+
+
+if __name__ == "__main__":
+    test_lease_released_after_settings_change()
+    test_limit_added_while_streams_run()
+    print("rate_limiter: OK")
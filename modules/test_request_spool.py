@@ -0,0 +1,131 @@
+# modules/test_request_spool.py
+# Проверка потокового разбора RequestSpool на случайных границах блоков.
+#
+# Тело запроса с data URI (короткими и длинными, с экранированием "\/" и "\\", с '"data:' внутри
+# обычного текста) режется на блоки случайной длины, включая 1 байт, и разбирается сканером.
+# Результат после materialize() должен совпадать с json.loads того же тела, а временные файлы
+# должны удаляться после release().
+#
+# Запуск из корня проекта: python -m pytest modules/test_request_spool.py
+#                       или python -m modules.test_request_spool
+import asyncio
+import base64
+import json
+import os
+import random
+import tempfile
+
+from modules.request_spool import RequestSpool, SpooledDataURI
+
+ITERATIONS = 300
+
+
+def _random_data_uri(rng: random.Random) -> str:
+    payload = base64.b64encode(rng.randbytes(rng.choice([0, 3, 20, 60, 200, 700]))).decode()
+    uri = f"data:image/{rng.choice(['png', 'jpeg', 'webp'])};base64,{payload}"
+    if rng.random() < 0.2:
+        # Экранированные символы внутри строки data URI
+        uri += rng.choice(['/', '\\', '"', ' '])
+    return uri
+
+
+def _random_text(rng: random.Random) -> str:
+    pieces = ["привет", "data:", '"data:', '\\"data:x', "\\", "\\\\", '"', "plain text", "ok"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+
+
+def _random_body(rng: random.Random) -> dict:
+    messages = []
+    for _ in range(rng.randint(1, 4)):
+        content = [{"type": "text", "text": _random_text(rng)}]
+        for _ in range(rng.randint(0, 3)):
+            content.append({"type": "image_url", "image_url": {"url": _random_data_uri(rng), "detail": "auto"}})
+        if rng.random() < 0.3:
+            # Длинный data URI в тексте сообщения должен вернуться обычной строкой
+            content.append({"type": "text", "text": _random_data_uri(rng)})
+        messages.append({"role": rng.choice(["user", "assistant"]), "content": content})
+    return {"model": "test-model", "stream": rng.random() < 0.5, "messages": messages}
+
+
+def _encode(body: dict, rng: random.Random) -> bytes:
+    text = json.dumps(body, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 1]))
+    if rng.random() < 0.5:
+        # Часть клиентов экранирует "/" как "\/"
+        text = text.replace("/", "\\/")
+    return text.encode("utf-8")
+
+
+def _split(data: bytes, rng: random.Random) -> list[bytes]:
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.choice([1, 1, 2, 5, rng.randint(1, 64), rng.randint(1, 4096)])
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+async def _iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def _materialize_all(value):
+    if isinstance(value, SpooledDataURI):
+        return value.read()
+    if isinstance(value, dict):
+        return {key: _materialize_all(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_materialize_all(item) for item in value]
+    return value
+
+
+def _check_text_fields(value, key=None):
+    """Дескрипторы допустимы только в полях "url"."""
+    if isinstance(value, SpooledDataURI):
+        assert key == "url"
+    elif isinstance(value, dict):
+        for item_key, item in value.items():
+            _check_text_fields(item, item_key)
+    elif isinstance(value, list):
+        for item in value:
+            _check_text_fields(item)
+
+
+def test_random_chunk_boundaries():
+    rng = random.Random(20240611)
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(ITERATIONS):
+            body = _random_body(rng)
+            data = _encode(body, rng)
+            spool = RequestSpool(directory, threshold=rng.choice([1, 16, 100, 1024]))
+            result = asyncio.run(spool.parse(_iterate(_split(data, rng))))
+            _check_text_fields(result)
+            for handle in spool.handles:
+                assert os.path.exists(handle.path)
+                text = handle.read()
+                if text.isascii():
+                    assert handle.size == len(text)
+            assert _materialize_all(result) == json.loads(data)
+            spool.release()
+        assert os.listdir(directory) == []
+
+
+def test_unterminated_data_uri_releases_files():
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as directory:
+        data = b'{"messages": [{"url": "data:image/png;base64,' + b"A" * 5000
+        spool = RequestSpool(directory, threshold=16)
+        try:
+            asyncio.run(spool.parse(_iterate(_split(data, rng))))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("незавершённая строка должна вызывать ошибку разбора")
+        assert os.listdir(directory) == []
+
+
+if __name__ == "__main__":
+    test_random_chunk_boundaries()
+    test_unterminated_data_uri_releases_files()
+    print("request_spool: OK")
@@ -0,0 +1,101 @@
+# modules/traffic_recorder.py
+# Запись входящих WebSocket-кадров от скрипта Tampermonkey в компактный файл для последующего воспроизведения.
+#
+# Формат файла (только дозапись):
+#   заголовок: MAGIC (8 байт) + время начала записи (float64, Unix time);
+#   запись:    RECORD_HEADER (kind, t, длина worker_id, длина request_id, длина данных) + worker_id + request_id + данные.
+# t — секунды от начала записи по монотонным часам; данные — исходный текст кадра в UTF-8 без изменений.
+import logging
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LMBRREC1"
+FILE_HEADER = struct.Struct("<d")
+RECORD_HEADER = struct.Struct("<BdBHI")
+
+KIND_FRAME = 0
+KIND_CONNECT = 1
+KIND_DISCONNECT = 2
+
+
+class TrafficRecorder:
+    """
+    Дописывает кадры в файл через буфер записи: в цикле событий выполняется только упаковка заголовка
+    и копирование в буфер, на диск данные сбрасываются блоками, при отключении вкладки и при остановке.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 256 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        last_t = 0.0
+        if not is_new:
+            # Дозапись в существующий файл: оборванная последняя запись отрезается,
+            # а время продолжается после последней записи, чтобы порядок сохранялся
+            last_t, valid_length = _scan(path)
+            with open(path, 'r+b') as f:
+                f.truncate(valid_length)
+        self.path = path
+        self._file = open(path, 'ab', buffering=buffer_size)
+        self._started = time.monotonic() - last_t
+        if is_new:
+            self._file.write(MAGIC + FILE_HEADER.pack(time.time()))
+        logger.info(f"Запись трафика WebSocket включена: '{path}'.")
+
+    def _write(self, kind: int, worker_id: str, request_id: str, data: bytes):
+        worker_bytes = worker_id.encode('utf-8')
+        request_bytes = request_id.encode('utf-8')
+        self._file.write(RECORD_HEADER.pack(kind, time.monotonic() - self._started, len(worker_bytes), len(request_bytes), len(data)))
+        self._file.write(worker_bytes)
+        self._file.write(request_bytes)
+        self._file.write(data)
+
+    def record_frame(self, worker_id: str, request_id: str | None, raw: str):
+        self._write(KIND_FRAME, worker_id, request_id or "", raw.encode('utf-8'))
+
+    def record_connect(self, worker_id: str):
+        self._write(KIND_CONNECT, worker_id, "", b"")
+
+    def record_disconnect(self, worker_id: str):
+        self._write(KIND_DISCONNECT, worker_id, "", b"")
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def _scan(path: str) -> tuple[float, int]:
+    """Возвращает время последней целой записи и длину файла без оборванного хвоста."""
+    last_t, valid_length = 0.0, len(MAGIC) + FILE_HEADER.size
+    for kind, t, worker_id, request_id, data in read_recording(path):
+        last_t = t
+        valid_length += RECORD_HEADER.size + len(worker_id.encode('utf-8')) + len(request_id.encode('utf-8')) + len(data)
+    return last_t, valid_length
+
+
+def read_recording(path: str):
+    """
+    Читает файл записи и выдаёт кортежи (kind, t, worker_id, request_id, data: bytes).
+    Запись, оборванная аварийным завершением сервера, молча отбрасывается.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{path}' не является файлом записи трафика LMArenaBridge.")
+        if len(f.read(FILE_HEADER.size)) < FILE_HEADER.size:
+            return
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, t, worker_len, request_len, data_len = RECORD_HEADER.unpack(header)
+            body = f.read(worker_len + request_len + data_len)
+            if len(body) < worker_len + request_len + data_len:
+                return
+            worker_id = body[:worker_len].decode('utf-8')
+            request_id = body[worker_len:worker_len + request_len].decode('utf-8')
+            yield kind, t, worker_id, request_id, body[worker_len + request_len:]
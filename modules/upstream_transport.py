@@ -0,0 +1,372 @@
+# modules/upstream_transport.py
+# Транспорт до LMArena: каким путём нагрузка запроса попадает в retry-evaluation-session-message.
+#
+# - BrowserTransport: через брокер во вкладку со скриптом Tampermonkey, которая сама выполняет fetch
+#   (путь по умолчанию: сервер -> вкладка -> LMArena -> вкладка -> сервер).
+# - DirectHttpTransport: сервер сам отправляет тот же PUT через пул соединений (HTTP/2, если установлен h2),
+#   с cookies и заголовками, которые экспортирует скрипт (сообщение "upstream_credentials"). Ответ LMArena
+#   попадает в тот же канал запроса, что и кадры вкладки, поэтому разбор потока не меняется, а вкладка
+#   не участвует в запросе и не ограничивает число одновременных fetch.
+# - UpstreamRouter выбирает транспорт по upstream_transport. Если LMArena отвечает проверкой Cloudflare,
+#   cookies истекли или соединение не удалось, запрос уходит во вкладку, а прямой путь отключается
+#   на direct_challenge_cooldown_seconds (или до того, как скрипт пришлёт новые cookies).
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+
+from modules import fast_json
+
+try:
+    import h2  # noqa: F401 — httpx использует HTTP/2, только если установлен пакет h2 (httpx[http2])
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT_BROWSER = "browser"
+TRANSPORT_DIRECT = "direct"
+TRANSPORTS = (TRANSPORT_BROWSER, TRANSPORT_DIRECT)
+
+DEFAULT_BASE_URL = "https://lmarena.ai"
+STREAM_PATH = "/nextjs-api/stream/retry-evaluation-session-message/{session_id}/messages/{message_id}"
+# Признаки страницы проверки Cloudflare (те же, что ищет разбор потока)
+CHALLENGE_MARKERS = ("<title>Just a moment...</title>", "Enable JavaScript and cookies to continue", "challenge-platform")
+ERROR_BODY_LIMIT = 2000
+
+
+class UpstreamUnavailable(Exception):
+    """Прямой запрос к LMArena не удался до начала ответа (проверка, истёкшие cookies, сеть) — нужен браузер."""
+
+
+def build_request_body(payload: dict) -> dict:
+    """Тело PUT-запроса LMArena из нагрузки convert_openai_to_lmarena_payload (как executeFetchAndStreamBack в скрипте)."""
+    templates = payload.get("message_templates") or []
+    session_id = payload.get("session_id")
+    is_image_request = payload.get("is_image_request")
+    now = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+    messages = []
+    parent_id = None
+    for index, template in enumerate(templates):
+        message_id = str(uuid.uuid4())
+        # Для генерации изображений все сообщения 'success', иначе последнее — 'pending'
+        status = 'success' if is_image_request or index < len(templates) - 1 else 'pending'
+        attachments = template.get("attachments")
+        messages.append({
+            "role": template.get("role"),
+            "content": template.get("content"),
+            "id": message_id,
+            "evaluationId": None,
+            "evaluationSessionId": session_id,
+            "parentMessageIds": [parent_id] if parent_id else [],
+            "experimental_attachments": attachments if isinstance(attachments, list) else [],
+            "failureReason": None,
+            "metadata": None,
+            "participantPosition": template.get("participantPosition") or "a",
+            "createdAt": now,
+            "updatedAt": now,
+            "status": status,
+        })
+        parent_id = message_id
+    return {"messages": messages, "modelId": payload.get("target_model_id")}
+
+
+class UpstreamTransport:
+    """Интерфейс транспорта: send() передаёт запрос, ответ поступает в канал брокера request_id."""
+
+    name = ""
+
+    def ready(self) -> bool:
+        raise NotImplementedError
+
+    async def send(self, request_id: str, message: dict):
+        raise NotImplementedError
+
+    def abort(self, request_id: str):
+        raise NotImplementedError
+
+    def status(self) -> dict:
+        return {}
+
+
+class BrowserTransport(UpstreamTransport):
+    """Вкладка браузера через брокер (broker — функция, так как брокер создаётся при запуске сервера)."""
+
+    name = TRANSPORT_BROWSER
+
+    def __init__(self, broker, settings=lambda: {}):
+        self.broker = broker
+        self.settings = settings
+
+    def ready(self) -> bool:
+        return self.broker().has_workers()
+
+    async def send(self, request_id: str, message: dict):
+        await self.broker().dispatch(
+            request_id, message,
+            prefix_cache_enabled=self.settings().get("prefix_cache_enabled", True),
+            structured_stream=self.settings().get("structured_stream_enabled", True),
+        )
+
+    def abort(self, request_id: str):
+        self.broker().abort(request_id)
+
+    def status(self) -> dict:
+        return {"workers": self.broker().status()["workers"]}
+
+
+class DirectHttpTransport(UpstreamTransport):
+    """Прямые запросы к LMArena с cookies страницы. Соединения переиспользуются между запросами."""
+
+    name = TRANSPORT_DIRECT
+
+    def __init__(self, broker, settings=lambda: {}):
+        self.broker = broker
+        self.settings = settings
+        self._client: httpx.AsyncClient | None = None
+        self._client_key = None
+        # Число ещё читаемых ответов каждого клиента: клиент, заменённый при смене direct_max_connections,
+        # закрывается, когда дочитан его последний ответ
+        self._client_users: dict[httpx.AsyncClient, int] = {}
+        self._tasks: dict[str, asyncio.Task] = {}  # request_id -> задача, читающая ответ LMArena
+        self.suspended_until = 0.0
+        self._suspended_cookie: str | None = None  # cookies, с которыми получена проверка
+        self.last_failure: str | None = None
+        self.sent = 0
+        self.fallbacks = 0
+
+    # --- Учётные данные ---
+    def credentials(self) -> dict | None:
+        """Cookies и заголовки от скрипта плюс direct_extra_cookies (например, HttpOnly-cookies, недоступные скрипту)."""
+        exported = self.broker().upstream_credentials or {}
+        extra = (self.settings().get("direct_extra_cookies") or "").strip().strip(';')
+        cookie = "; ".join(part for part in ((exported.get("cookie") or "").strip().strip(';'), extra) if part)
+        if not cookie:
+            return None
+        return {**exported, "cookie": cookie}
+
+    def ready(self) -> bool:
+        credentials = self.credentials()
+        if credentials is None:
+            return False
+        if time.monotonic() < self.suspended_until and credentials["cookie"] == self._suspended_cookie:
+            return False
+        return True
+
+    def _suspend(self, reason: str, cookie: str):
+        cooldown = float(self.settings().get("direct_challenge_cooldown_seconds", 300))
+        self.suspended_until = time.monotonic() + cooldown
+        self._suspended_cookie = cookie
+        self.last_failure = reason
+        logger.warning(f"DIRECT: {reason}. Прямые запросы приостановлены на {cooldown:.0f} с или до получения новых cookies от скрипта.")
+
+    # --- Клиент ---
+    def _base_url(self) -> str:
+        # Адрес страницы из сообщения /ws не используется: cookies уходят только на адрес из настроек
+        return (self.settings().get("lmarena_base_url") or DEFAULT_BASE_URL).rstrip('/')
+
+    def _get_client(self) -> httpx.AsyncClient:
+        max_connections = int(self.settings().get("direct_max_connections", 20))
+        key = (max_connections, HTTP2_AVAILABLE)
+        if self._client is None or self._client_key != key:
+            previous = self._client
+            self._client = None
+            if previous is not None and not self._client_users.get(previous):
+                asyncio.ensure_future(previous.aclose())
+            # Срок чтения не ограничен: паузы между блоками контролирует разбор потока (stream_response_timeout_seconds)
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=httpx.Timeout(connect=10.0, read=None, write=60.0, pool=30.0),
+            )
+            self._client_key = key
+        return self._client
+
+    def _acquire(self, client: httpx.AsyncClient):
+        self._client_users[client] = self._client_users.get(client, 0) + 1
+
+    def _release(self, client: httpx.AsyncClient):
+        users = self._client_users.get(client, 0) - 1
+        if users > 0:
+            self._client_users[client] = users
+            return
+        self._client_users.pop(client, None)
+        if client is not self._client:
+            asyncio.ensure_future(client.aclose())
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        clients = set(self._client_users)
+        if self._client is not None:
+            clients.add(self._client)
+            self._client = None
+        for client in clients:
+            await client.aclose()
+
+    # --- Отправка ---
+    async def send(self, request_id: str, message: dict):
+        """
+        Отправляет PUT и ждёт заголовков ответа. UpstreamUnavailable — ответ ещё не начался и запрос можно
+        передать во вкладку; после возврата тело ответа читается в фоне в канал запроса.
+        """
+        credentials = self.credentials()
+        if credentials is None:
+            raise UpstreamUnavailable("Нет cookies LMArena: скрипт Tampermonkey их ещё не прислал, direct_extra_cookies не задан.")
+        payload = message.get("payload") or {}
+        base_url = self._base_url()
+        url = base_url + STREAM_PATH.format(session_id=payload.get("session_id"), message_id=payload.get("message_id"))
+        body = fast_json.dumps_bytes(build_request_body(payload))
+        headers = {
+            "Content-Type": "text/plain;charset=UTF-8",  # LMArena использует text/plain
+            "Accept": "*/*",
+            "Cookie": credentials["cookie"],
+            "Origin": base_url,
+            "Referer": base_url + "/",
+        }
+        if credentials.get("user_agent"):
+            # cf_clearance привязан к User-Agent браузера, в котором пройдена проверка
+            headers["User-Agent"] = credentials["user_agent"]
+        if credentials.get("accept_language"):
+            headers["Accept-Language"] = credentials["accept_language"]
+
+        client = self._get_client()
+        timeout = float(self.settings().get("direct_response_timeout_seconds", 30))
+        self._acquire(client)
+        try:
+            response = await asyncio.wait_for(client.send(client.build_request("PUT", url, content=body, headers=headers), stream=True), timeout=timeout or None)
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            self._release(client)
+            self.fallbacks += 1
+            self.last_failure = f"{type(e).__name__}: {e}"
+            raise UpstreamUnavailable(f"LMArena недоступна напрямую ({type(e).__name__}: {e}).")
+        except BaseException:
+            self._release(client)
+            raise
+
+        if not response.is_success:
+            try:
+                error_body = (await response.aread()).decode('utf-8', 'replace')[:ERROR_BODY_LIMIT]
+            finally:
+                await response.aclose()
+                self._release(client)
+            if _is_challenge(response, error_body):
+                self.fallbacks += 1
+                self._suspend(f"LMArena ответила проверкой или отказом в доступе (статус {response.status_code})", credentials["cookie"])
+                raise UpstreamUnavailable(f"Прямой запрос получил проверку (статус {response.status_code}).")
+            # Прочие ошибки (413, 429, 400 и т.п.) браузер получил бы так же — передаём их как ошибку вкладки
+            await self._put(request_id, {"error": f"Сетевой ответ некорректен. Статус: {response.status_code}. Содержимое: {error_body}"}, final=True)
+            return
+
+        broker = self.broker()
+        record = broker.registry.get(request_id)
+        if record is not None:
+            record.mark_sent(TRANSPORT_DIRECT, len(body))
+        self.sent += 1
+        task = asyncio.create_task(self._pump(request_id, response))
+        self._tasks[request_id] = task
+        task.add_done_callback(lambda _: self._pump_done(request_id, client))
+
+    async def _put(self, request_id: str, data, final: bool = False, size: int = 0) -> bool:
+        record = self.broker().registry.get(request_id)
+        if record is None:
+            return False  # Запрос уже закрыт
+        record.mark_received(size, final)
+        await record.channel.put(data)
+        return True
+
+    async def _pump(self, request_id: str, response: httpx.Response):
+        """Пересылает тело ответа в канал запроса блоками по мере поступления (как вкладка в режиме сырого текста)."""
+        try:
+            async for chunk in response.aiter_text():
+                if chunk and not await self._put(request_id, chunk, size=len(chunk)):
+                    return
+            await self._put(request_id, "[DONE]", final=True)
+        except httpx.HTTPError as e:
+            logger.warning(f"DIRECT [ID: {request_id[:8]}]: Поток LMArena прерван: {type(e).__name__}: {e}")
+            await self._put(request_id, {"error": f"Поток LMArena прерван: {e}"}, final=True)
+        finally:
+            await response.aclose()
+
+    def _pump_done(self, request_id: str, client: httpx.AsyncClient):
+        self._tasks.pop(request_id, None)
+        self._release(client)
+
+    def owns(self, request_id: str) -> bool:
+        return request_id in self._tasks
+
+    def abort(self, request_id: str):
+        task = self._tasks.get(request_id)
+        if task is not None:
+            task.cancel()
+
+    def status(self) -> dict:
+        credentials = self.credentials()
+        exported = self.broker().upstream_credentials or {}
+        remaining = self.suspended_until - time.monotonic()
+        return {
+            "ready": self.ready(),
+            "http2": HTTP2_AVAILABLE,
+            "base_url": self._base_url(),
+            "has_cookies": credentials is not None,
+            "cookies_exported_at": exported.get("received_at"),
+            "suspended_seconds": round(remaining, 1) if remaining > 0 and not self.ready() else 0,
+            "last_failure": self.last_failure,
+            "in_flight": len(self._tasks),
+            "sent": self.sent,
+            "fallbacks": self.fallbacks,
+        }
+
+
+class UpstreamRouter:
+    """Выбор транспорта для запроса по upstream_transport и переход на вкладку браузера при отказе прямого пути."""
+
+    def __init__(self, browser: BrowserTransport, direct: DirectHttpTransport, settings=lambda: {}):
+        self.browser = browser
+        self.direct = direct
+        self.settings = settings
+
+    @property
+    def mode(self) -> str:
+        mode = self.settings().get("upstream_transport", TRANSPORT_BROWSER)
+        return mode if mode in TRANSPORTS else TRANSPORT_BROWSER
+
+    def direct_ready(self) -> bool:
+        return self.mode == TRANSPORT_DIRECT and self.direct.ready()
+
+    def browser_required(self) -> bool:
+        """Нужна ли запросу вкладка браузера (иначе его можно выполнить без подключённых вкладок)."""
+        return not self.direct_ready()
+
+    async def send(self, request_id: str, message: dict) -> str:
+        """Передаёт запрос и возвращает имя использованного транспорта. BrowserUnavailable — нет ни одного пути."""
+        if self.direct_ready():
+            try:
+                await self.direct.send(request_id, message)
+                return TRANSPORT_DIRECT
+            except UpstreamUnavailable as e:
+                logger.warning(f"DIRECT [ID: {request_id[:8]}]: {e} Запрос передаётся во вкладку браузера.")
+        await self.browser.send(request_id, message)
+        return TRANSPORT_BROWSER
+
+    def abort(self, request_id: str):
+        if self.direct.owns(request_id):
+            self.direct.abort(request_id)
+        else:
+            self.browser.abort(request_id)
+
+    def status(self) -> dict:
+        return {"mode": self.mode, "browser": self.browser.status(), "direct": self.direct.status()}
+
+
+def _is_challenge(response: httpx.Response, body: str) -> bool:
+    """Ответ, который вкладка браузера может пройти, а прямой запрос — нет: проверка Cloudflare или отказ в доступе."""
+    if response.headers.get("cf-mitigated") == "challenge":
+        return True
+    if response.status_code in (401, 403):
+        return True
+    return response.status_code == 503 and any(marker in body for marker in CHALLENGE_MARKERS)
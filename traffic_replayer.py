@@ -0,0 +1,156 @@
+# traffic_replayer.py
+#
+# Воспроизведение записанного трафика браузера (см. traffic_recording_enabled в config.jsonc).
+# Скрипт выступает одновременно клиентом API и поддельной вкладкой Tampermonkey:
+# для каждого записанного запроса он отправляет запрос в /v1/chat/completions, а когда сервер
+# передаёт его "браузеру", отвечает записанными кадрами с исходными границами и интервалами
+# (в реальном времени или с ускорением). Так парсер и потоковую часть сервера можно
+# проверять на реальных трассах LMArena без браузера.
+#
+# Пример: python traffic_replayer.py recordings/ws_traffic.lmbr --speed 10
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import aiohttp
+
+from modules.traffic_recorder import read_recording, KIND_FRAME
+
+
+def load_sessions(path: str) -> list[dict]:
+    """Группирует записанные кадры по request_id в порядке появления запросов."""
+    sessions: dict[str, dict] = {}
+    for kind, t, worker_id, request_id, data in read_recording(path):
+        if kind != KIND_FRAME or not request_id:
+            continue  # Служебные кадры (приветствие вкладки и т.п.) не относятся к запросам
+        raw = data.decode('utf-8')
+        frame_data = json.loads(raw).get("data")
+        if isinstance(frame_data, dict) and frame_data.get("prefix_cache_miss"):
+            continue  # Поддельная вкладка не объявляет кеш префиксов, промахи воспроизводить не нужно
+        session = sessions.get(request_id)
+        if session is None:
+            session = sessions[request_id] = {"request_id": request_id, "start": t, "frames": []}
+        session["frames"].append((t - session["start"], raw))
+    return list(sessions.values())
+
+
+class FakeBrowser:
+    """Поддельная вкладка: отвечает на запросы сервера записанными кадрами."""
+
+    def __init__(self, ws, speed: float):
+        self.ws = ws
+        self.speed = speed
+        self.pending: asyncio.Queue = asyncio.Queue()
+        self.tasks: set[asyncio.Task] = set()
+        self.replaying: set[str] = set()
+
+    async def run(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            message = json.loads(msg.data)
+            request_id = message.get("request_id")
+            if not request_id or "payload" not in message or request_id in self.replaying:
+                continue  # Команды сервера (refresh, reconnect и т.п.) и повторные отправки игнорируются
+            session = self.pending.get_nowait() if not self.pending.empty() else None
+            if session is None:
+                print(f"⚠️ Сервер прислал запрос {request_id[:8]}, для которого нет записанного ответа.")
+                continue
+            self.replaying.add(request_id)
+            task = asyncio.create_task(self._replay(request_id, session))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _replay(self, request_id: str, session: dict):
+        started = time.monotonic()
+        for offset, raw in session["frames"]:
+            if self.speed > 0:
+                delay = offset / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # Подменяется только идентификатор запроса, остальной текст кадра отправляется байт в байт
+            await self.ws.send_str(raw.replace(session["request_id"], request_id))
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+async def call_api(http: aiohttp.ClientSession, url: str, headers: dict, body: dict) -> dict:
+    """Выполняет потоковый запрос и измеряет время до первого байта и общее время."""
+    started = time.monotonic()
+    first_byte, received = None, 0
+    async with http.post(url, json=body, headers=headers) as response:
+        async for chunk in response.content.iter_any():
+            if first_byte is None:
+                first_byte = time.monotonic() - started
+            received += len(chunk)
+        status = response.status
+    return {"status": status, "ttfb": first_byte, "total": time.monotonic() - started, "bytes": received}
+
+
+async def replay(args):
+    sessions = load_sessions(args.recording)
+    if args.limit:
+        sessions = sessions[:args.limit]
+    if not sessions:
+        print("В записи нет запросов для воспроизведения.")
+        return
+    print(f"Загружено запросов: {len(sessions)}. Скорость: {'максимальная' if args.speed <= 0 else f'x{args.speed}'}.")
+
+    server = args.server.rstrip('/')
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    body = {"model": args.model, "stream": True, "messages": [{"role": "user", "content": "replay"}]}
+
+    async with aiohttp.ClientSession() as http:
+        ws = await http.ws_connect(server.replace("http", "ws", 1) + "/ws")
+        browser = FakeBrowser(ws, args.speed)
+        browser_task = asyncio.create_task(browser.run())
+
+        first_start = sessions[0]["start"]
+        replay_started = time.monotonic()
+
+        async def run_one(session):
+            # Запросы начинаются с теми же (масштабированными) интервалами, что и в записи
+            if args.speed > 0:
+                delay = (session["start"] - first_start) / args.speed - (time.monotonic() - replay_started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            browser.pending.put_nowait(session)
+            try:
+                return await call_api(http, f"{server}/v1/chat/completions", headers, body)
+            except aiohttp.ClientError as e:
+                return {"status": 0, "ttfb": None, "total": 0.0, "bytes": 0, "error": str(e)}
+
+        results = await asyncio.gather(*(run_one(session) for session in sessions))
+        elapsed = time.monotonic() - replay_started
+        browser_task.cancel()
+        await ws.close()
+
+    ok = [r for r in results if r["status"] == 200]
+    ttfbs = sorted(r["ttfb"] for r in ok if r["ttfb"] is not None)
+    totals = sorted(r["total"] for r in ok)
+    total_bytes = sum(r["bytes"] for r in results)
+    print(f"\nГотово за {elapsed:.2f} с: успешно {len(ok)} из {len(results)}.")
+    if ttfbs:
+        print(f"  Время до первого байта: медиана {statistics.median(ttfbs) * 1000:.1f} мс, p95 {percentile(ttfbs, 0.95) * 1000:.1f} мс")
+    if totals:
+        print(f"  Полное время ответа:    медиана {statistics.median(totals) * 1000:.1f} мс, p95 {percentile(totals, 0.95) * 1000:.1f} мс")
+    print(f"  Получено клиентом: {total_bytes / 1024:.1f} КБ ({total_bytes / 1024 / max(elapsed, 1e-9):.1f} КБ/с)")
+    for result in results:
+        if result["status"] != 200:
+            print(f"  ⚠️ Ошибка: статус {result['status']} {result.get('error', '')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика браузера против api_server.py.")
+    parser.add_argument("recording", help="файл записи (traffic_recording_path в config.jsonc)")
+    parser.add_argument("--server", default="http://127.0.0.1:5102", help="адрес api_server.py")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения (1 — реальное время, 0 — без пауз)")
+    parser.add_argument("--model", default="replay", help="модель в запросах к API (влияет только на выбор сессии)")
+    parser.add_argument("--api-key", help="API-ключ сервера, если он настроен")
+    parser.add_argument("--limit", type=int, help="воспроизвести только первые N запросов")
+    asyncio.run(replay(parser.parse_args()))